@@ -30,7 +30,8 @@ class EgoAlloTrainConfig:
 
     # Dataset arguments.
     batch_size: int = 256
-    """Effective batch size."""
+    """Effective batch size. With gradient accumulation, each forward pass
+    sees `batch_size // gradient_accumulation_steps` sequences."""
     num_workers: int = 2
     subseq_len: int = 128
     dataset_slice_strategy: Literal[
@@ -49,20 +50,14 @@ class EgoAlloTrainConfig:
     warmup_steps: int = 1000
     max_grad_norm: float = 1.0
 
-
-def get_experiment_dir(experiment_name: str, version: int = 0) -> Path:
-    """Creates a directory to put experiment files in, suffixed with a version
-    number. Similar to PyTorch lightning."""
-    experiment_dir = (
-        Path(__file__).absolute().parent
-        / "experiments"
-        / experiment_name
-        / f"v{version}"
-    )
-    if experiment_dir.exists():
-        return get_experiment_dir(experiment_name, version + 1)
-    else:
-        return experiment_dir
+    # Memory options. See `benchmarks/training_memory.py` for how these trade
+    # off memory against throughput.
+    activation_checkpointing: bool = False
+    """Whether to recompute transformer block activations in the backward
+    pass instead of storing them."""
+    gradient_accumulation_steps: int = 1
+    """Number of forward/backward passes to accumulate gradients over before
+    each optimizer step."""
 
 
 def run_training(
@@ -72,11 +67,15 @@ def run_training(
     # Set up experiment directory + HF accelerate.
     # We're getting to manage logging, checkpoint directories, etc manually,
     # and just use `accelerate` for distibuted training.
-    experiment_dir = get_experiment_dir(config.experiment_name)
+    experiment_dir = training_utils.get_experiment_dir(
+        Path(__file__).absolute().parent / "experiments", config.experiment_name
+    )
     assert not experiment_dir.exists()
+    assert config.batch_size % config.gradient_accumulation_steps == 0
     accelerator = Accelerator(
         project_config=ProjectConfiguration(project_dir=str(experiment_dir)),
         dataloader_config=DataLoaderConfiguration(split_batches=True),
+        gradient_accumulation_steps=config.gradient_accumulation_steps,
     )
     writer = (
         tensorboardX.SummaryWriter(logdir=str(experiment_dir), flush_secs=10)
@@ -111,6 +110,7 @@ def run_training(
 
     # Setup.
     model = network.EgoDenoiser(config.model)
+    model.activation_checkpointing = config.activation_checkpointing
     train_loader = torch.utils.data.DataLoader(
         dataset=EgoAmassHdf5Dataset(
             config.dataset_hdf5_path,
@@ -121,7 +121,7 @@ def run_training(
             slice_strategy=config.dataset_slice_strategy,
             random_variable_len_proportion=config.dataset_slice_random_variable_len_proportion,
         ),
-        batch_size=config.batch_size,
+        batch_size=config.batch_size // config.gradient_accumulation_steps,
         shuffle=True,
         num_workers=config.num_workers,
         persistent_workers=config.num_workers > 0,
@@ -168,22 +168,31 @@ def run_training(
     prev_checkpoint_path: Path | None = None
     while True:
         for train_batch in train_loader:
+            # With gradient accumulation, `accelerate` skips the optimizer
+            # and scheduler updates until the last micro-batch.
+            with accelerator.accumulate(model):
+                loss, log_outputs = loss_helper.compute_denoising_loss(
+                    model,
+                    unwrapped_model=accelerator.unwrap_model(model),
+                    train_batch=train_batch,
+                )
+                accelerator.backward(loss)
+                if accelerator.sync_gradients:
+                    accelerator.clip_grad_norm_(
+                        model.parameters(), config.max_grad_norm
+                    )
+                optim.step()
+                scheduler.step()
+                optim.zero_grad(set_to_none=True)
+
+            # Steps are counted in optimizer updates. Logged losses are from
+            # the last micro-batch.
+            if not accelerator.sync_gradients:
+                continue
             loop_metrics = next(loop_metrics_gen)
             step = loop_metrics.counter
-
-            loss, log_outputs = loss_helper.compute_denoising_loss(
-                model,
-                unwrapped_model=accelerator.unwrap_model(model),
-                train_batch=train_batch,
-            )
             log_outputs["learning_rate"] = scheduler.get_last_lr()[0]
             accelerator.log(log_outputs, step=step)
-            accelerator.backward(loss)
-            if accelerator.sync_gradients:
-                accelerator.clip_grad_norm_(model.parameters(), config.max_grad_norm)
-            optim.step()
-            scheduler.step()
-            optim.zero_grad(set_to_none=True)
 
             # The rest of the loop will only be executed by the main process.
             if not accelerator.is_main_process:
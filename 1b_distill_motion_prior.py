@@ -0,0 +1,255 @@
+"""Progressive distillation script for EgoAllo diffusion models.
+
+Starting from a trained denoiser, each round trains a student to match two
+deterministic DDIM steps of its teacher with a single step. The student then
+becomes the teacher for the next round. With the default config, a 16-step
+teacher schedule is distilled into students that need 8, 4, and 2 steps.
+
+Each round's student is written to `{experiment_dir}/{num_steps}_steps/`, which
+can be used like any other checkpoint directory. The schedule a student was
+trained for is saved next to its model config, and is picked up by
+`load_distilled_sampler_config()`.
+"""
+
+import copy
+import dataclasses
+from pathlib import Path
+from typing import Literal
+
+import tensorboardX
+import torch.optim.lr_scheduler
+import torch.utils.data
+import tyro
+import yaml
+from accelerate import Accelerator, DataLoaderConfiguration
+from accelerate.utils import ProjectConfiguration
+from loguru import logger
+
+from egoallo import network, training_loss, training_utils
+from egoallo.data.amass import EgoAmassHdf5Dataset
+from egoallo.data.dataclass import collate_dataclass
+from egoallo.inference_utils import load_denoiser
+from egoallo.sampling import (
+    DISTILLED_SAMPLER_CONFIG_FILENAME,
+    load_distilled_sampler_config,
+    make_distilled_sampler_config,
+    quadratic_ts,
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class EgoAlloDistillConfig:
+    experiment_name: str
+    teacher_checkpoint_dir: Path
+    dataset_hdf5_path: Path
+    dataset_files_path: Path
+
+    loss: training_loss.TrainingLossConfig = training_loss.TrainingLossConfig()
+
+    # Distillation arguments.
+    teacher_num_steps: int = 16
+    """Number of DDIM steps for the initial teacher. Ignored if the teacher is
+    itself a distilled student, in which case we use its schedule."""
+    student_num_steps: tuple[int, ...] = (8, 4, 2)
+    """Number of steps for the student trained in each round. Each should be
+    half of the previous round's."""
+    steps_per_round: int = 50_000
+    """Number of training steps for each round."""
+    checkpoint_interval: int = 5000
+
+    # Dataset arguments.
+    batch_size: int = 256
+    """Effective batch size."""
+    num_workers: int = 2
+    subseq_len: int = 128
+    dataset_slice_strategy: Literal[
+        "deterministic", "random_uniform_len", "random_variable_len"
+    ] = "random_uniform_len"
+    dataset_slice_random_variable_len_proportion: float = 0.3
+    """Only used if dataset_slice_strategy == 'random_variable_len'."""
+    train_splits: tuple[Literal["train", "val", "test", "just_humaneva"], ...] = (
+        "train",
+        "val",
+    )
+
+    # Optimizer options.
+    learning_rate: float = 5e-5
+    weight_decay: float = 1e-4
+    warmup_steps: int = 1000
+    max_grad_norm: float = 1.0
+
+
+def run_distillation(config: EgoAlloDistillConfig) -> None:
+    # Set up experiment directory + HF accelerate.
+    experiment_dir = training_utils.get_experiment_dir(
+        Path(__file__).absolute().parent / "experiments", config.experiment_name
+    )
+    assert not experiment_dir.exists()
+    accelerator = Accelerator(
+        project_config=ProjectConfiguration(project_dir=str(experiment_dir)),
+        dataloader_config=DataLoaderConfiguration(split_batches=True),
+    )
+    writer = (
+        tensorboardX.SummaryWriter(logdir=str(experiment_dir), flush_secs=10)
+        if accelerator.is_main_process
+        else None
+    )
+    device = accelerator.device
+
+    # Load the teacher, and the schedule it should be sampled with.
+    teacher = load_denoiser(config.teacher_checkpoint_dir).to(device)
+    teacher_sampler = load_distilled_sampler_config(config.teacher_checkpoint_dir)
+    teacher_ts = (
+        teacher_sampler.get_ts()
+        if teacher_sampler is not None
+        else quadratic_ts(config.teacher_num_steps)
+    )
+    num_teacher_steps = len(teacher_ts) - 1
+    for num_steps in config.student_num_steps:
+        assert num_teacher_steps == 2 * num_steps, (
+            f"Can't distill {num_teacher_steps} steps into {num_steps} steps."
+        )
+        num_teacher_steps = num_steps
+
+    # Initialize experiment.
+    if accelerator.is_main_process:
+        training_utils.pdb_safety_net()
+
+        # Save various things that might be useful.
+        experiment_dir.mkdir(exist_ok=True, parents=True)
+        (experiment_dir / "git_commit.txt").write_text(
+            training_utils.get_git_commit_hash()
+        )
+        (experiment_dir / "git_diff.txt").write_text(training_utils.get_git_diff())
+        (experiment_dir / "run_config.yaml").write_text(yaml.dump(config))
+
+        # Add hyperparameters to TensorBoard.
+        assert writer is not None
+        writer.add_hparams(
+            hparam_dict=training_utils.flattened_hparam_dict_from_dataclass(config),
+            metric_dict={},
+            name=".",  # Hack to avoid timestamped subdirectory.
+        )
+
+        # Write logs to file.
+        logger.add(experiment_dir / "trainlog.log", rotation="100 MB")
+
+    train_loader = torch.utils.data.DataLoader(
+        dataset=EgoAmassHdf5Dataset(
+            config.dataset_hdf5_path,
+            config.dataset_files_path,
+            splits=config.train_splits,
+            subseq_len=config.subseq_len,
+            cache_files=True,
+            slice_strategy=config.dataset_slice_strategy,
+            random_variable_len_proportion=config.dataset_slice_random_variable_len_proportion,
+        ),
+        batch_size=config.batch_size,
+        shuffle=True,
+        num_workers=config.num_workers,
+        persistent_workers=config.num_workers > 0,
+        pin_memory=True,
+        collate_fn=collate_dataclass,
+        drop_last=True,
+    )
+    loss_helper = training_loss.TrainingLossComputer(config.loss, device=device)
+
+    # Run distillation rounds! `step` counts across rounds, for logging.
+    step = 0
+    for num_steps in config.student_num_steps:
+        student_ts = teacher_ts[::2]
+        round_dir = experiment_dir / f"{num_steps}_steps"
+        if accelerator.is_main_process:
+            round_dir.mkdir()
+            (round_dir / "model_config.yaml").write_text(yaml.dump(teacher.config))
+            (round_dir / DISTILLED_SAMPLER_CONFIG_FILENAME).write_text(
+                yaml.dump(make_distilled_sampler_config(student_ts))
+            )
+            logger.info(f"Distilling {teacher_ts.tolist()} into {student_ts.tolist()}")
+
+        # The student is initialized from the teacher.
+        teacher.eval().requires_grad_(False)
+        model = network.EgoDenoiser(teacher.config)
+        model.load_state_dict(teacher.state_dict())
+        optim = torch.optim.AdamW(  # type: ignore
+            model.parameters(),
+            lr=config.learning_rate,
+            weight_decay=config.weight_decay,
+        )
+        scheduler = torch.optim.lr_scheduler.LambdaLR(
+            optim, lr_lambda=lambda step: min(1.0, step / config.warmup_steps)
+        )
+        model, round_loader, optim, scheduler = accelerator.prepare(
+            model, train_loader, optim, scheduler
+        )
+
+        def batches():
+            while True:
+                yield from round_loader
+
+        loop_metrics_gen = training_utils.loop_metric_generator()
+        for round_step, train_batch in zip(
+            range(1, config.steps_per_round + 1), batches()
+        ):
+            loop_metrics = next(loop_metrics_gen)
+            step += 1
+
+            loss, log_outputs = loss_helper.compute_distillation_loss(
+                model,
+                unwrapped_model=accelerator.unwrap_model(model),
+                teacher=teacher,
+                teacher_ts=teacher_ts,
+                train_batch=train_batch,
+            )
+            log_outputs["learning_rate"] = scheduler.get_last_lr()[0]
+            log_outputs["student_num_steps"] = num_steps
+            accelerator.log(log_outputs, step=step)
+            accelerator.backward(loss)
+            if accelerator.sync_gradients:
+                accelerator.clip_grad_norm_(model.parameters(), config.max_grad_norm)
+            optim.step()
+            scheduler.step()
+            optim.zero_grad(set_to_none=True)
+
+            # The rest of the loop will only be executed by the main process.
+            if not accelerator.is_main_process:
+                continue
+
+            # Logging.
+            if step % 10 == 0:
+                assert writer is not None
+                for k, v in log_outputs.items():
+                    writer.add_scalar(k, v, step)
+
+            # Print status update to terminal.
+            if step % 20 == 0:
+                mem_info = ""
+                if torch.cuda.is_available():
+                    mem_free, mem_total = torch.cuda.mem_get_info()
+                    mem_info = f" mem: {(mem_total - mem_free) / 1024**3:.2f}/{mem_total / 1024**3:.2f}G"
+                logger.info(
+                    f"student steps: {num_steps} step: {round_step}"
+                    f" ({loop_metrics.iterations_per_sec:.2f} it/sec){mem_info}"
+                    f" lr: {scheduler.get_last_lr()[0]:.7f}"
+                    f" loss: {loss.item():.6f}"
+                )
+
+            # Checkpointing. Only the student weights are saved, in the same
+            # format as `1_train_motion_prior.py` checkpoints.
+            if (
+                round_step % config.checkpoint_interval == 0
+                or round_step == config.steps_per_round
+            ):
+                checkpoint_path = round_dir / f"checkpoints_{round_step}"
+                accelerator.save_model(model, str(checkpoint_path))
+                logger.info(f"Saved checkpoint to {checkpoint_path}")
+
+        # The student is the teacher for the next round.
+        accelerator.wait_for_everyone()
+        teacher = copy.deepcopy(accelerator.unwrap_model(model))
+        teacher_ts = student_ts
+        accelerator.free_memory()
+
+
+if __name__ == "__main__":
+    tyro.cli(run_distillation)
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import contextlib
 import dataclasses
 import time
 from pathlib import Path
+from typing import Literal
 
 import numpy as np
 import torch
@@ -10,8 +12,9 @@ import viser
 import yaml
 
 from egoallo import fncsmpl, fncsmpl_extensions
+from egoallo.compiled_denoiser import StaticShapeDenoiser
 from egoallo.data.aria_mps import load_point_cloud_and_find_ground
-from egoallo.guidance_optimizer_jax import GuidanceMode
+from egoallo.guidance_optimizer_jax import GuidanceMode, enable_compilation_cache
 from egoallo.hand_detection_structs import (
     CorrespondedAriaHandWristPoseDetections,
     CorrespondedHamerDetections,
@@ -21,7 +24,17 @@ from egoallo.inference_utils import (
     InferenceTrajectoryPaths,
     load_denoiser,
 )
-from egoallo.sampling import run_sampling_with_stitching
+from egoallo.network import InferencePrecision, LocalAttentionConfig
+from egoallo.profiling import SamplingProfiler
+from egoallo.sampling import (
+    AdaptiveStepSkipping,
+    Denoiser,
+    SamplerConfig,
+    WarmStart,
+    load_distilled_sampler_config,
+    run_sampling_with_stitching,
+)
+from egoallo.stitching_plan import StitchingPlan, StitchingPlanner
 from egoallo.transforms import SE3, SO3
 from egoallo.vis_helpers import visualize_traj_and_hand_detections
 
@@ -57,6 +70,73 @@ class Args:
     up debugging/experiments, or if we only care about foot skating losses."""
     guidance_post: bool = True
     """Whether to apply guidance optimizer after diffusion sampling."""
+    persistent_guidance: bool = False
+    """Whether to warm-start inner guidance from the previous denoising step's
+    solution, and stop each optimization early once it converges. See
+    `GuidanceSession`."""
+    guidance_chunk_size: int | None = None
+    """If set, guidance for longer trajectories is solved in overlapping chunks
+    of this many timesteps, in parallel. This bounds memory use for very long
+    trajectories. See `JaxGuidanceParams.chunk_size`."""
+    batch_windows: bool = False
+    """Whether to denoise all overlapping windows in a single batched forward
+    pass. This is faster for long trajectories."""
+    auto_plan: bool = False
+    """Whether to choose window sizes and how many windows/samples to batch
+    together automatically, from `planner`'s memory budget. Overrides
+    `batch_windows`."""
+    planner: StitchingPlanner = StitchingPlanner()
+    """Memory budget and window size limits for `auto_plan`."""
+    cache_encoder: bool = False
+    """Whether to run the denoiser's encoder once for all noise levels before
+    sampling, instead of at every step. Helps most with multiple samples."""
+    sampler: SamplerConfig = SamplerConfig()
+    """Diffusion sampler and number of denoising steps. For students from
+    `1b_distill_motion_prior.py`, the schedule they were distilled for is used
+    unless `ts` is set."""
+    precision: InferencePrecision = "float32"
+    """Precision for the denoiser's layers. `bfloat16` is faster on recent
+    CPUs and GPUs; rotation projection and sampler updates stay in float32."""
+    quantize_int8: bool = False
+    """Whether to dynamically quantize the denoiser's linear layers to int8.
+    This is for CPU inference, and requires `--device cpu`. Quantized weights
+    are cached next to the checkpoint."""
+    fused_modality_heads: bool = False
+    """Whether to fuse the denoiser's per-modality encoder and decoder MLPs,
+    which reduces the number of kernel launches per forward pass."""
+    compile_denoiser: Literal["off", "compile", "export"] = "off"
+    """Whether to compile the denoiser for a static window shape, with either
+    `torch.compile()` or `torch.export`. Compilation takes a while, so this
+    pays off for long sequences or repeated runs."""
+    local_attention: bool = False
+    """Whether to denoise the whole trajectory in a single pass with banded
+    local attention, instead of stitching together overlapping windows. See
+    `EgoDenoiser.local_attention`. Overrides `batch_windows` and `auto_plan`."""
+    step_skipping_tolerance: float | None = None
+    """If set, windows stop being denoised once their clean predictions
+    change by less than this between steps. See `AdaptiveStepSkipping`."""
+    warm_start_npz: Path | None = None
+    """Previous output from this script, under `egoallo_outputs/`, to
+    warm-start from. Frames it covers are re-noised to `warm_start_noise_level`
+    and only the remaining denoising steps are run; other frames are sampled
+    from scratch. Useful for overlapping ranges, or for re-running with
+    different guidance settings."""
+    warm_start_noise_level: int = 100
+    """Noise level for `warm_start_npz`, out of 1000. Lower values stay closer
+    to the previous output, and run fewer denoising steps."""
+    device: str = "cuda"
+    """Device to run the denoiser and body model on."""
+    jax_compilation_cache_dir: Path | None = None
+    """If set, compiled guidance optimizers are cached in this directory and
+    reused across runs. Common shapes can be compiled ahead of time with
+    `3a_prewarm_guidance.py`."""
+    profile: bool = False
+    """Whether to record per-phase sampling times. If `save_traj` is set, a
+    JSON summary is written next to the output trajectory."""
+    profile_torch_trace: bool = False
+    """Whether to also record a `torch.profiler` trace. Requires `profile`."""
+    profile_jax_trace: bool = False
+    """Whether to also record a `jax.profiler` trace. Requires `profile`."""
     save_traj: bool = True
     """Whether to save the output trajectory, which will be placed under `traj_dir/egoallo_outputs/some_name.npz`."""
     visualize_traj: bool = False
@@ -64,7 +144,9 @@ class Args:
 
 
 def main(args: Args) -> None:
-    device = torch.device("cuda")
+    device = torch.device(args.device)
+    if args.jax_compilation_cache_dir is not None:
+        enable_compilation_cache(args.jax_compilation_cache_dir)
 
     traj_paths = InferenceTrajectoryPaths.find(args.traj_root)
     if traj_paths.splat_path is not None:
@@ -128,22 +210,120 @@ def main(args: Args) -> None:
         server = viser.ViserServer()
         server.gui.configure_theme(dark_mode=True)
 
-    denoiser_network = load_denoiser(args.checkpoint_dir).to(device)
+    assert not args.quantize_int8 or device.type == "cpu", (
+        "int8 quantization is only supported on CPU."
+    )
+    denoiser_network = load_denoiser(
+        args.checkpoint_dir,
+        args.precision,
+        quantize_int8=args.quantize_int8,
+        fused_modality_heads=args.fused_modality_heads,
+    ).to(device)
     body_model = fncsmpl.SmplhModel.load(args.smplh_npz_path).to(device)
 
-    traj = run_sampling_with_stitching(
-        denoiser_network,
-        body_model=body_model,
-        guidance_mode=args.guidance_mode,
-        guidance_inner=args.guidance_inner,
-        guidance_post=args.guidance_post,
-        Ts_world_cpf=Ts_world_cpf,
-        hamer_detections=hamer_detections,
-        aria_detections=aria_detections,
-        num_samples=args.num_samples,
-        device=device,
-        floor_z=floor_z,
+    sampler = args.sampler
+    distilled_sampler = load_distilled_sampler_config(args.checkpoint_dir)
+    if distilled_sampler is not None and sampler.ts is None:
+        print(f"Using sampler for distilled checkpoint: {distilled_sampler}")
+        sampler = distilled_sampler
+
+    plan = None
+    if args.local_attention:
+        assert not args.cache_encoder and args.compile_denoiser == "off", (
+            "Local attention doesn't support encoder caching or compilation."
+        )
+        denoiser_network.local_attention = LocalAttentionConfig()
+        plan = StitchingPlan(window_size=Ts_world_cpf.shape[0] - 1, overlap_size=0)
+    elif args.auto_plan:
+        plan = args.planner.plan(
+            denoiser_network,
+            seq_lens=[Ts_world_cpf.shape[0] - 1],
+            num_samples=args.num_samples,
+            device=device,
+            cache_encoder=args.cache_encoder,
+            num_steps=len(sampler.get_ts()) - 1,
+        )
+
+    sampling_denoiser: Denoiser = denoiser_network
+    if args.compile_denoiser != "off":
+        shape_plan = (
+            plan
+            if plan is not None
+            else StitchingPlan(windows_per_batch=None if args.batch_windows else 1)
+        )
+        sampling_denoiser = StaticShapeDenoiser(
+            denoiser_network,
+            batch_size=shape_plan.get_forward_batch_size(
+                [Ts_world_cpf.shape[0] - 1], args.num_samples
+            ),
+            window_size=shape_plan.window_size,
+            backend=args.compile_denoiser,
+        )
+
+    profiler = None
+    if args.profile:
+        trace_dir = (
+            args.traj_root
+            / "egoallo_outputs"
+            / ("profile_" + time.strftime("%Y%m%d-%H%M%S"))
+        )
+        profiler = SamplingProfiler(
+            torch_trace_path=trace_dir / "torch_trace.json"
+            if args.profile_torch_trace
+            else None,
+            jax_trace_dir=trace_dir / "jax_trace" if args.profile_jax_trace else None,
+        )
+
+    warm_start = None
+    if args.warm_start_npz is not None:
+        warm_start = WarmStart.load(
+            args.warm_start_npz,
+            frame_nums=np.arange(
+                args.start_index, args.start_index + Ts_world_cpf.shape[0] - 1
+            ),
+            include_hands=denoiser_network.config.include_hands,
+        ).to(device)
+        assert warm_start.x_0_packed.shape[0] in (1, args.num_samples), (
+            "Warm start should have one sample, or as many samples as `num_samples`."
+        )
+
+    step_skipping = (
+        None
+        if args.step_skipping_tolerance is None
+        else AdaptiveStepSkipping(args.step_skipping_tolerance)
     )
+    with profiler.trace() if profiler is not None else contextlib.nullcontext():
+        traj = run_sampling_with_stitching(
+            sampling_denoiser,
+            body_model=body_model,
+            guidance_mode=args.guidance_mode,
+            guidance_inner=args.guidance_inner,
+            guidance_post=args.guidance_post,
+            Ts_world_cpf=Ts_world_cpf,
+            hamer_detections=hamer_detections,
+            aria_detections=aria_detections,
+            num_samples=args.num_samples,
+            device=device,
+            floor_z=floor_z,
+            batch_windows=args.batch_windows,
+            cache_encoder=args.cache_encoder,
+            sampler=sampler,
+            profiler=profiler,
+            plan=plan,
+            step_skipping=step_skipping,
+            warm_start=warm_start,
+            warm_start_noise_level=args.warm_start_noise_level,
+            persistent_guidance=args.persistent_guidance,
+            guidance_chunk_size=args.guidance_chunk_size,
+        )
+
+    if profiler is not None:
+        profiler.print_summary()
+    if step_skipping is not None:
+        print(
+            f"Step skipping saved {step_skipping.forwards_saved}"
+            f"/{step_skipping.forwards_total} window forward passes"
+        )
 
     # Save outputs in case we want to visualize later.
     if args.save_traj:
@@ -157,6 +337,10 @@ def main(args: Args) -> None:
         (args.traj_root / "egoallo_outputs" / (save_name + "_args.yaml")).write_text(
             yaml.dump(dataclasses.asdict(args))
         )
+        if profiler is not None:
+            profiler.save_json(
+                args.traj_root / "egoallo_outputs" / (save_name + "_timing.json")
+            )
 
         posed = traj.apply_to_body(body_model)
         Ts_world_root = fncsmpl_extensions.get_T_world_root_from_cpf_pose(
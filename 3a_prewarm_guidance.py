@@ -0,0 +1,76 @@
+"""Compile guidance optimizers ahead of time.
+
+Guidance optimizers are compiled for each guidance mode, phase, and shape
+bucket; see `get_guidance_bucket_length()`. Compilation can take much longer
+than the optimization itself, which dominates short inference jobs. This script
+compiles the common configurations into JAX's persistent compilation cache.
+Later runs of `3_aria_inference.py` or `5_eval_body_metrics.py` reuse them when
+passed the same `--jax-compilation-cache-dir`.
+
+Example:
+
+    python 3a_prewarm_guidance.py --seq-lens 32 128 --num-samples 1 4
+    python 3_aria_inference.py --traj-root ... \\
+        --jax-compilation-cache-dir ./jax_compilation_cache
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Literal
+
+import torch
+import tyro
+
+from egoallo import fncsmpl
+from egoallo.guidance_optimizer_jax import (
+    GuidanceMode,
+    enable_compilation_cache,
+    get_jax_body_model,
+    prewarm_guidance,
+)
+
+
+def main(
+    jax_compilation_cache_dir: Path = Path("./jax_compilation_cache"),
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    guidance_modes: tuple[GuidanceMode, ...] = ("no_hands",),
+    phases: tuple[Literal["inner", "post"], ...] = ("inner", "post"),
+    seq_lens: tuple[int, ...] = (32, 128),
+    num_samples: tuple[int, ...] = (1,),
+    persistent_guidance: bool = False,
+    guidance_chunk_size: int | None = None,
+    device: str = "cuda",
+) -> None:
+    """Compile guidance optimizers for each combination of `guidance_modes`,
+    `phases`, and the shape buckets of `seq_lens` and `num_samples`.
+
+    Compiled optimizers also depend on how many hands are detected in each
+    sequence, so only optimizers for sequences without hand detections are
+    compiled. Modes other than `no_hands` only benefit when no hands are
+    detected.
+
+    `persistent_guidance` and `guidance_chunk_size` should match the
+    settings used for inference, since they change what's compiled."""
+    enable_compilation_cache(jax_compilation_cache_dir)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch.device(device))
+
+    start_time = time.time()
+    prewarm_guidance(
+        get_jax_body_model(body_model),
+        guidance_modes=guidance_modes,
+        phases=phases,
+        seq_lens=seq_lens,
+        num_samples=num_samples,
+        persistent_guidance=persistent_guidance,
+        chunk_size=guidance_chunk_size,
+    )
+    print(
+        f"Compiled guidance in {time.time() - start_time:.1f}sec, cached to"
+        f" {jax_compilation_cache_dir}"
+    )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
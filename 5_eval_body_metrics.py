@@ -22,6 +22,7 @@ For --subseq-len 32:
      foot_skate 0.185 +/- 0.005          (not reported in paper)
 """
 
+import time
 from pathlib import Path
 
 import jax.tree
@@ -32,16 +33,17 @@ import tyro
 
 from egoallo import fncsmpl
 from egoallo.data.amass import EgoAmassHdf5Dataset
-from egoallo.fncsmpl_extensions import get_T_world_root_from_cpf_pose
+from egoallo.guidance_optimizer_jax import enable_compilation_cache
 from egoallo.inference_utils import load_denoiser
-from egoallo.metrics_helpers import (
-    compute_foot_contact,
-    compute_foot_skate,
-    compute_head_trans,
-    compute_mpjpe,
+from egoallo.metrics_helpers import compute_body_metrics
+from egoallo.network import EgoDenoiseTraj, InferencePrecision
+from egoallo.sampling import (
+    AdaptiveStepSkipping,
+    SamplerConfig,
+    load_distilled_sampler_config,
+    run_sampling_batched,
 )
-from egoallo.sampling import run_sampling_with_stitching
-from egoallo.transforms import SE3, SO3
+from egoallo.stitching_plan import StitchingPlanner
 
 
 def main(
@@ -52,12 +54,50 @@ def main(
     checkpoint_dir: Path = Path("./egoallo_checkpoint_april13/checkpoints_3000000/"),
     smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
     num_samples: int = 1,
+    sampler: SamplerConfig = SamplerConfig(),
+    batch_size: int = 1,
+    auto_plan: bool = False,
+    planner: StitchingPlanner = StitchingPlanner(),
+    precision: InferencePrecision = "float32",
+    device: str = "cuda",
+    step_skipping_tolerance: float | None = None,
+    jax_compilation_cache_dir: Path | None = None,
 ) -> None:
-    """Compute body metrics on the test split of the AMASS dataset."""
-    device = torch.device("cuda")
+    """Compute body metrics on the test split of the AMASS dataset.
+
+    `sampler` can be used to evaluate faster samplers or fewer denoising steps;
+    see `benchmarks/sampler_accuracy_vs_speed.py` for a sweep. `batch_size`
+    sets how many sequences are denoised together. With `auto_plan`, the
+    number of windows and samples per forward pass is chosen to fit in
+    `planner`'s memory budget.
+
+    `precision` runs the denoiser under bfloat16 or float16 autocast. Each
+    batch is seeded by its index and sampling time is reported alongside the
+    metrics, so runs with different precisions (or devices) can be compared
+    directly; see `benchmarks/precision_accuracy_vs_speed.py` for a sweep.
+
+    If `step_skipping_tolerance` is set, windows stop being denoised once
+    their clean predictions converge; see `AdaptiveStepSkipping`. Each batch
+    is then also sampled without skipping, from the same seed, and we report
+    the number of forward passes saved and the change in MPJPE.
+
+    Students from `1b_distill_motion_prior.py` are sampled with the schedule
+    they were distilled for, unless `sampler.ts` is set.
+
+    If `jax_compilation_cache_dir` is set, compiled guidance optimizers are
+    cached there and reused across runs; see `3a_prewarm_guidance.py`."""
+    torch_device = torch.device(device)
+    if jax_compilation_cache_dir is not None:
+        enable_compilation_cache(jax_compilation_cache_dir)
+    distilled_sampler = load_distilled_sampler_config(checkpoint_dir)
+    if distilled_sampler is not None and sampler.ts is None:
+        print(f"Using sampler for distilled checkpoint: {distilled_sampler}")
+        sampler = distilled_sampler
 
     # Setup.
-    denoiser_network = load_denoiser(checkpoint_dir).to(device)
+    denoiser_network = load_denoiser(checkpoint_dir, precision=precision).to(
+        torch_device
+    )
     dataset = EgoAmassHdf5Dataset(
         dataset_hdf5_path,
         dataset_files_path,
@@ -68,97 +108,115 @@ def main(
         slice_strategy="deterministic",
         random_variable_len_proportion=0.0,
     )
-    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(device)
-
-    metrics = list[dict[str, np.ndarray]]()
-
-    for i in range(len(dataset)):
-        sequence = dataset[i].to(device)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch_device)
 
-        samples = run_sampling_with_stitching(
+    plan = None
+    if auto_plan:
+        plan = planner.plan(
             denoiser_network,
-            body_model=body_model,
-            guidance_mode="no_hands",
-            guidance_inner=guidance_inner,
-            guidance_post=True,
-            Ts_world_cpf=sequence.T_world_cpf,
-            hamer_detections=None,
-            aria_detections=None,
+            seq_lens=[subseq_len] * batch_size,
             num_samples=num_samples,
-            floor_z=0.0,
-            device=device,
-            guidance_verbose=False,
+            device=torch_device,
+            num_steps=len(sampler.get_ts()) - 1,
         )
 
-        assert samples.hand_rotmats is not None
-        assert samples.betas.shape == (num_samples, subseq_len, 16)
-        assert samples.body_rotmats.shape == (num_samples, subseq_len, 21, 3, 3)
-        assert samples.hand_rotmats.shape == (num_samples, subseq_len, 30, 3, 3)
-        assert sequence.hand_quats is not None
-
-        # We'll only use the body joint rotations.
-        pred_posed = body_model.with_shape(samples.betas).with_pose(
-            T_world_root=SE3.identity(device, torch.float32).wxyz_xyz,
-            local_quats=SO3.from_matrix(
-                torch.cat([samples.body_rotmats, samples.hand_rotmats], dim=2)
-            ).wxyz,
-        )
-        pred_posed = pred_posed.with_new_T_world_root(
-            get_T_world_root_from_cpf_pose(pred_posed, sequence.T_world_cpf[1:, ...])
-        )
-
-        label_posed = body_model.with_shape(sequence.betas[1:, ...]).with_pose(
-            sequence.T_world_root[1:, ...],
-            torch.cat(
-                [
-                    sequence.body_quats[1:, ...],
-                    sequence.hand_quats[1:, ...],
-                ],
-                dim=1,
-            ),
-        )
-
-        metrics.append(
-            {
-                "mpjpe": compute_mpjpe(
-                    label_T_world_root=label_posed.T_world_root,
-                    label_Ts_world_joint=label_posed.Ts_world_joint[:, :21, :],
-                    pred_T_world_root=pred_posed.T_world_root,
-                    pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
-                    per_frame_procrustes_align=False,
-                ),
-                "pampjpe": compute_mpjpe(
-                    label_T_world_root=label_posed.T_world_root,
-                    label_Ts_world_joint=label_posed.Ts_world_joint[:, :21, :],
-                    pred_T_world_root=pred_posed.T_world_root,
-                    pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
-                    per_frame_procrustes_align=True,
-                ),
-                # We didn't report foot skating metrics in the paper. It's not
-                # really meaningful: since we optimize foot skating in the
-                # guidance optimizer, it's easy to "cheat" this metric.
-                "foot_skate": compute_foot_skate(
-                    pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
-                ),
-                "foot_contact (GND)": compute_foot_contact(
-                    pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
-                ),
-                "T_head": compute_head_trans(
-                    label_Ts_world_joint=label_posed.Ts_world_joint[:, :21, :],
-                    pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
-                ),
-            }
-        )
+    metrics = list[dict[str, np.ndarray]]()
+    sampling_times = list[float]()
+    step_skipping = (
+        None
+        if step_skipping_tolerance is None
+        else AdaptiveStepSkipping(step_skipping_tolerance)
+    )
+    mpjpe_without_skipping = list[np.ndarray]()
+
+    for batch_start in range(0, len(dataset), batch_size):
+        sequences = [
+            dataset[i].to(torch_device)
+            for i in range(batch_start, min(batch_start + batch_size, len(dataset)))
+        ]
+
+        def sample(
+            step_skipping: AdaptiveStepSkipping | None,
+        ) -> list[EgoDenoiseTraj]:
+            torch.manual_seed(batch_start)
+            return run_sampling_batched(
+                denoiser_network,
+                body_model=body_model,
+                guidance_mode="no_hands",
+                guidance_inner=guidance_inner,
+                guidance_post=True,
+                Ts_world_cpf=[sequence.T_world_cpf for sequence in sequences],
+                hamer_detections=None,
+                aria_detections=None,
+                num_samples=num_samples,
+                floor_z=[0.0] * len(sequences),
+                device=torch_device,
+                guidance_verbose=False,
+                batch_windows=True,
+                sampler=sampler,
+                plan=plan,
+                step_skipping=step_skipping,
+            )
+
+        if torch_device.type == "cuda":
+            torch.cuda.synchronize(torch_device)
+        start_time = time.perf_counter()
+        samples_list = sample(step_skipping)
+        if torch_device.type == "cuda":
+            torch.cuda.synchronize(torch_device)
+        sampling_times.append((time.perf_counter() - start_time) / len(sequences))
+
+        if step_skipping is not None:
+            for sequence, samples in zip(sequences, sample(None)):
+                mpjpe_without_skipping.append(
+                    compute_body_metrics(body_model, sequence, samples)["mpjpe"]
+                )
+
+        for sequence, samples in zip(sequences, samples_list):
+            assert samples.hand_rotmats is not None
+            assert samples.betas.shape == (num_samples, subseq_len, 16)
+            assert samples.body_rotmats.shape == (num_samples, subseq_len, 21, 3, 3)
+            assert samples.hand_rotmats.shape == (num_samples, subseq_len, 30, 3, 3)
+            metrics.append(compute_body_metrics(body_model, sequence, samples))
 
         print("=" * 80)
         print("=" * 80)
         print("=" * 80)
-        print(f"Metrics ({i}/{len(dataset)} processed)")
+        print(f"Metrics ({len(metrics)}/{len(dataset)} processed)")
         for k, v in jax.tree.map(
-            lambda *x: f"{np.mean(x):.3f} +/- {np.std(x) / np.sqrt(len(metrics) * num_samples):.3f}",
+            lambda *x: (
+                f"{np.mean(x):.3f} +/- {np.std(x) / np.sqrt(len(metrics) * num_samples):.3f}"
+            ),
             *metrics,
         ).items():
             print("\t", k, v)
+        # The first batch includes warmup, so we exclude it if possible.
+        print(
+            f"\t sampling time ({precision}, {torch_device.type})",
+            f"{np.mean(sampling_times[1:] or sampling_times):.3f} s/seq",
+        )
+        if step_skipping is not None:
+            mpjpe_deltas = [
+                m["mpjpe"] - m_ref for m, m_ref in zip(metrics, mpjpe_without_skipping)
+            ]
+            print(
+                "\t step skipping: saved",
+                f"{step_skipping.forwards_saved}/{step_skipping.forwards_total}",
+                f"({step_skipping.forwards_saved / step_skipping.forwards_total:.1%})",
+                "window forward passes",
+            )
+            if guidance_inner:
+                print(
+                    "\t step skipping: skipped",
+                    f"{step_skipping.guidance_solves_skipped}/"
+                    f"{step_skipping.guidance_solves_skipped + step_skipping.guidance_solves_run}",
+                    "inner guidance solves",
+                )
+            print(
+                "\t step skipping: mpjpe",
+                f"{np.mean(mpjpe_without_skipping):.3f} without skipping,",
+                f"change {np.mean(mpjpe_deltas):+.3f} +/- {np.std(mpjpe_deltas) / np.sqrt(len(metrics) * num_samples):.3f}",
+            )
         print("=" * 80)
         print("=" * 80)
         print("=" * 80)
@@ -0,0 +1,69 @@
+"""Shared helpers for the benchmark scripts in this directory.
+
+Benchmarks can be run without a checkpoint: runtime doesn't depend on the
+weights, so we fall back to a randomly initialized denoiser.
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch
+from jaxtyping import Float
+from torch import Tensor
+
+from egoallo import network
+from egoallo.transforms import SE3, SO3
+
+
+def make_denoiser(
+    checkpoint_dir: Path | None, device: torch.device
+) -> network.EgoDenoiser:
+    """Load a denoiser from a checkpoint, or randomly initialize one."""
+    if checkpoint_dir is None:
+        model = network.EgoDenoiser(network.EgoDenoiserConfig())
+    else:
+        from egoallo.inference_utils import load_denoiser
+
+        model = load_denoiser(checkpoint_dir)
+    return model.to(device).eval()
+
+
+def make_synthetic_Ts_world_cpf(
+    num_frames: int, device: torch.device, seed: int = 0
+) -> Float[Tensor, "num_frames 7"]:
+    """Make a smooth, walking-like head trajectory. This is useful for timing,
+    but shouldn't be used for measuring accuracy."""
+    generator = torch.Generator().manual_seed(seed)
+    yaw = torch.cumsum(torch.randn((num_frames,), generator=generator) * 0.02, dim=0)
+    velocity = torch.stack([torch.cos(yaw), torch.sin(yaw), torch.zeros_like(yaw)], -1)
+    position = torch.cumsum(velocity / 30.0, dim=0)
+    position[:, 2] = 1.6
+    R_world_cpf = SO3.from_z_radians(yaw) @ SO3.from_x_radians(
+        torch.tensor(-np.pi / 2.0)
+    )
+    return (
+        SE3.from_rotation_and_translation(R_world_cpf, position)
+        .parameters()
+        .to(torch.float32)
+        .to(device)
+    )
+
+
+def time_fn(fn: Callable[[], object], device: torch.device, num_repeats: int) -> float:
+    """Call a function a few times, and return the median runtime in seconds.
+    We run it once first to warm up."""
+    fn()
+    times = []
+    for _ in range(num_repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start_time = time.perf_counter()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
@@ -0,0 +1,129 @@
+"""Check parity and latency of static-shape compiled denoisers against eager PyTorch.
+
+For each backend, we report:
+- Time to compile or export.
+- Max difference in denoiser outputs for one stitched denoising step.
+- Max difference in final samples after a full sampling run, with the same seed.
+- Latency of one stitched denoising step, and the speedup over eager.
+
+Example:
+
+    python benchmarks/compiled_denoiser_parity.py --seq-len 1000 --num-samples 4 --device cuda
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Literal
+
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf, time_fn
+
+from egoallo.compiled_denoiser import StaticShapeDenoiser
+from egoallo.sampling import (
+    Denoiser,
+    StitchedWindows,
+    denoise_with_stitching,
+    run_sampling_with_stitching,
+)
+from egoallo.stitching_plan import StitchingPlan
+from egoallo.transforms import SE3
+
+
+def main(
+    seq_len: int = 1000,
+    num_samples: int = 1,
+    backends: tuple[Literal["compile", "export"], ...] = ("compile", "export"),
+    windows_per_batch: int | None = None,
+    num_repeats: int = 10,
+    device: str = "cuda",
+    checkpoint_dir: Path | None = None,
+) -> None:
+    torch_device = torch.device(device)
+    denoiser_network = make_denoiser(checkpoint_dir, torch_device)
+    plan = StitchingPlan(windows_per_batch=windows_per_batch)
+
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len + 1, torch_device)
+    T_cpf_tm1_cpf_t = (
+        SE3(Ts_world_cpf[:-1, :]).inverse() @ SE3(Ts_world_cpf[1:, :])
+    ).wxyz_xyz
+    windows = StitchedWindows.make(
+        denoiser_network,
+        T_cpf_tm1_cpf_t,
+        T_world_cpf=Ts_world_cpf[1:, :],
+        window_size=plan.window_size,
+        overlap_size=plan.overlap_size,
+    )
+    x_t_packed = torch.randn(
+        (num_samples, seq_len, denoiser_network.get_d_state()), device=torch_device
+    )
+
+    def denoise_step(denoiser: Denoiser) -> torch.Tensor:
+        with torch.inference_mode():
+            return denoise_with_stitching(
+                denoiser,
+                x_t_packed,
+                t=500,
+                windows=windows,
+                windows_per_batch=plan.windows_per_batch,
+            )
+
+    def sample(denoiser: Denoiser) -> torch.Tensor:
+        torch.manual_seed(0)
+        return run_sampling_with_stitching(
+            denoiser,
+            body_model=None,  # type: ignore
+            guidance_mode="off",
+            guidance_post=False,
+            guidance_inner=False,
+            Ts_world_cpf=Ts_world_cpf,
+            floor_z=0.0,
+            hamer_detections=None,
+            aria_detections=None,
+            num_samples=num_samples,
+            device=torch_device,
+            guidance_verbose=False,
+            plan=plan,
+        ).pack()
+
+    eager_step = denoise_step(denoiser_network)
+    eager_samples = sample(denoiser_network)
+    eager_time = time_fn(
+        lambda: denoise_step(denoiser_network), torch_device, num_repeats
+    )
+
+    rows = []
+    for backend in backends:
+        start_time = time.perf_counter()
+        compiled = StaticShapeDenoiser(
+            denoiser_network,
+            batch_size=plan.get_forward_batch_size([seq_len], num_samples),
+            window_size=plan.window_size,
+            backend=backend,
+        )
+        # Compilation with `torch.compile()` happens on the first call.
+        compiled_step = denoise_step(compiled)
+        compile_time = time.perf_counter() - start_time
+
+        step_diff = torch.max(torch.abs(compiled_step - eager_step)).item()
+        samples_diff = torch.max(torch.abs(sample(compiled) - eager_samples)).item()
+        step_time = time_fn(lambda: denoise_step(compiled), torch_device, num_repeats)
+        rows.append((backend, compile_time, step_diff, samples_diff, step_time))
+
+    print(
+        f"{'backend':>8} {'compile (s)':>12} {'step diff':>10} {'sample diff':>12}"
+        f" {'step (ms)':>10} {'speedup':>8}"
+    )
+    print(f"{'eager':>8} {'':>12} {'':>10} {'':>12} {eager_time * 1000:>10.2f}")
+    for backend, compile_time, step_diff, samples_diff, step_time in rows:
+        print(
+            f"{backend:>8} {compile_time:>12.1f} {step_diff:>10.2e}"
+            f" {samples_diff:>12.2e} {step_time * 1000:>10.2f}"
+            f" {eager_time / step_time:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,100 @@
+"""Benchmark per-step denoising latency with and without the encoder/cross-attention cache.
+
+The cache is built once per sampling run; we report its build time separately,
+as well as the amortized per-step latency over the full DDIM schedule.
+
+Example:
+
+    python benchmarks/decoder_cache_latency.py --seq-lens 128 1024 --num-samples 1 4
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf, time_fn
+
+from egoallo import network
+from egoallo.sampling import StitchedWindows, denoise_with_stitching, quadratic_ts
+from egoallo.transforms import SE3
+
+
+def main(
+    seq_lens: tuple[int, ...] = (128, 1024),
+    num_samples: tuple[int, ...] = (1, 4),
+    batch_windows: bool = True,
+    device: str = "cpu",
+    num_repeats: int = 3,
+    checkpoint_dir: Path | None = None,
+) -> None:
+    torch_device = torch.device(device)
+    denoiser_network = make_denoiser(checkpoint_dir, torch_device)
+    ts = quadratic_ts()
+    num_steps = len(ts) - 1
+    step_index = num_steps // 2
+
+    print(
+        f"{'seq_len':>8} {'samples':>8} {'no cache (s/step)':>18} {'cached (s/step)':>16}"
+        f" {'build (s)':>10} {'amortized (s/step)':>19} {'cache (MB)':>11} {'max abs diff':>13}"
+    )
+    for seq_len in seq_lens:
+        Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len + 1, torch_device)
+        windows = StitchedWindows.make(
+            denoiser_network,
+            (SE3(Ts_world_cpf[:-1, :]).inverse() @ SE3(Ts_world_cpf[1:, :])).wxyz_xyz,
+            T_world_cpf=Ts_world_cpf[1:, :],
+            window_size=128,
+            overlap_size=32,
+        )
+
+        with torch.inference_mode():
+            start_time = time.perf_counter()
+            decoder_cache = denoiser_network.precompute_decoder_cache(
+                torch.from_numpy(ts[:-1].copy()).to(torch_device),
+                cond_latent=windows.cond_latent,
+                mask=windows.mask,
+            )
+            build_time = time.perf_counter() - start_time
+        cache_mb = (
+            sum(kv.numel() * kv.element_size() for kv in decoder_cache.xattn_kv)
+            / 1024**2
+        )
+        step_cache = decoder_cache.map(lambda x: x[step_index])
+
+        for n in num_samples:
+            x_t_packed = torch.randn(
+                (n, seq_len, denoiser_network.get_d_state()), device=torch_device
+            )
+            outputs: dict[bool, torch.Tensor] = {}
+            timings: dict[bool, float] = {}
+            for use_cache in (False, True):
+                cache: network.EgoDenoiserDecoderCache | None = (
+                    step_cache if use_cache else None
+                )
+
+                def step() -> None:
+                    with torch.inference_mode():
+                        outputs[use_cache] = denoise_with_stitching(
+                            denoiser_network,
+                            x_t_packed,
+                            t=int(ts[step_index]),
+                            windows=windows,
+                            windows_per_batch=None if batch_windows else 1,
+                            decoder_cache=cache,
+                        )
+
+                timings[use_cache] = time_fn(step, torch_device, num_repeats)
+
+            max_diff = torch.max(torch.abs(outputs[True] - outputs[False])).item()
+            print(
+                f"{seq_len:>8} {n:>8} {timings[False]:>18.4f} {timings[True]:>16.4f}"
+                f" {build_time:>10.4f} {timings[True] + build_time / num_steps:>19.4f}"
+                f" {cache_mb:>11.1f} {max_diff:>13.2e}"
+            )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
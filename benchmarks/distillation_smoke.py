@@ -0,0 +1,172 @@
+"""Smoke test for progressive distillation, on a tiny randomly initialized
+denoiser.
+
+This runs one distillation round like `1b_distill_motion_prior.py`: a student
+is initialized from the teacher, and takes optimizer steps on
+`compute_distillation_loss()`. The student is then saved in the same layout as
+a distilled checkpoint, loaded back, and sampled with the schedule from
+`load_distilled_sampler_config()`. We also compute the loss for a teacher
+schedule with small steps near t=1000, where the distillation targets would
+blow up without `TrainingLossConfig.distillation_min_denominator`. The script
+fails if losses, gradients, or samples aren't finite, or if the samples have
+the wrong shape.
+
+Inputs are synthetic, so losses aren't meaningful. This runs in under a minute
+on CPU.
+
+Example:
+
+    python benchmarks/distillation_smoke.py --device cpu
+"""
+
+from __future__ import annotations
+
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+import tyro
+import yaml
+from bench_utils import make_synthetic_Ts_world_cpf
+from safetensors.torch import save_file
+from training_memory import make_synthetic_train_batch
+
+from egoallo import network, training_loss
+from egoallo.inference_utils import load_denoiser
+from egoallo.sampling import (
+    DISTILLED_SAMPLER_CONFIG_FILENAME,
+    load_distilled_sampler_config,
+    make_distilled_sampler_config,
+    quadratic_ts,
+    run_sampling_with_stitching,
+)
+
+
+def main(
+    teacher_num_steps: int = 4,
+    optimizer_steps: int = 2,
+    batch_size: int = 4,
+    subseq_len: int = 32,
+    seq_len: int = 48,
+    num_samples: int = 2,
+    device: str = "cpu",
+) -> None:
+    torch_device = torch.device(device)
+    torch.manual_seed(0)
+    config = network.EgoDenoiserConfig(
+        d_latent=32,
+        d_feedforward=64,
+        d_noise_emb=64,
+        num_heads=2,
+        encoder_layers=1,
+        decoder_layers=1,
+    )
+    teacher = network.EgoDenoiser(config).to(torch_device)
+    teacher_ts = quadratic_ts(teacher_num_steps)
+    student_ts = teacher_ts[::2]
+
+    # One distillation round, like `1b_distill_motion_prior.py`.
+    teacher.eval().requires_grad_(False)
+    model = network.EgoDenoiser(config).to(torch_device).train()
+    model.load_state_dict(teacher.state_dict())
+    optim = torch.optim.AdamW(model.parameters(), lr=1e-4)  # type: ignore
+    loss_helper = training_loss.TrainingLossComputer(
+        training_loss.TrainingLossConfig(), device=torch_device
+    )
+    train_batch = make_synthetic_train_batch(batch_size, subseq_len, torch_device)
+    for step in range(optimizer_steps):
+        loss, _ = loss_helper.compute_distillation_loss(
+            model,
+            unwrapped_model=model,
+            teacher=teacher,
+            teacher_ts=teacher_ts,
+            train_batch=train_batch,
+        )
+        assert torch.isfinite(loss), f"Non-finite loss at step {step}: {loss}"
+        loss.backward()
+        optim.step()
+        optim.zero_grad(set_to_none=True)
+        print(f"step {step}: loss {loss.item():.6f}")
+
+    # Small teacher steps near t=1000, where the unclamped targets divide by
+    # as little as 0.016. All but the last student step are clamped.
+    high_t_teacher_ts = np.array([*range(1000, 915, -5), 500, 0])
+    high_t_model = network.EgoDenoiser(config).to(torch_device).train()
+    high_t_model.load_state_dict(teacher.state_dict())
+    loss, log_outputs = loss_helper.compute_distillation_loss(
+        high_t_model,
+        unwrapped_model=high_t_model,
+        teacher=teacher,
+        teacher_ts=high_t_teacher_ts,
+        train_batch=train_batch,
+    )
+    loss.backward()
+    grad_norm = torch.linalg.vector_norm(
+        torch.stack(
+            [
+                torch.linalg.vector_norm(p.grad)
+                for p in high_t_model.parameters()
+                if p.grad is not None
+            ]
+        )
+    )
+    assert torch.isfinite(loss), f"Non-finite high-t loss: {loss}"
+    assert torch.isfinite(grad_norm), f"Non-finite high-t gradient: {grad_norm}"
+    assert log_outputs["distillation_clamped_frac"] > 0.0
+    print(
+        f"high t: loss {loss.item():.6f}, grad norm {grad_norm.item():.6f},"
+        f" clamped {float(log_outputs['distillation_clamped_frac']):.2f}"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Save the student like a distilled checkpoint, and load it back.
+        round_dir = Path(tmp) / f"{len(student_ts) - 1}_steps"
+        checkpoint_dir = round_dir / f"checkpoints_{optimizer_steps}"
+        checkpoint_dir.mkdir(parents=True)
+        (round_dir / "model_config.yaml").write_text(yaml.dump(config))
+        (round_dir / DISTILLED_SAMPLER_CONFIG_FILENAME).write_text(
+            yaml.dump(make_distilled_sampler_config(student_ts))
+        )
+        save_file(model.state_dict(), str(checkpoint_dir / "model.safetensors"))
+
+        student = load_denoiser(checkpoint_dir).to(torch_device).eval()
+        sampler = load_distilled_sampler_config(checkpoint_dir)
+    assert sampler is not None
+    assert sampler.get_ts().tolist() == student_ts.tolist()
+    print(f"Sampling with {student_ts.tolist()}")
+
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len + 1, torch_device)
+    with torch.no_grad():
+        traj = run_sampling_with_stitching(
+            student,
+            body_model=None,  # type: ignore
+            guidance_mode="off",
+            guidance_post=False,
+            guidance_inner=False,
+            Ts_world_cpf=Ts_world_cpf,
+            floor_z=0.0,
+            hamer_detections=None,
+            aria_detections=None,
+            num_samples=num_samples,
+            device=torch_device,
+            guidance_verbose=False,
+            sampler=sampler,
+        )
+    assert traj.body_rotmats.shape == (num_samples, seq_len, 21, 3, 3)
+    assert traj.hand_rotmats is not None
+    assert traj.hand_rotmats.shape == (num_samples, seq_len, 30, 3, 3)
+    assert traj.betas.shape == (num_samples, seq_len, 16)
+    assert traj.contacts.shape == (num_samples, seq_len, 21)
+    for name, value in (
+        ("betas", traj.betas),
+        ("body_rotmats", traj.body_rotmats),
+        ("contacts", traj.contacts),
+        ("hand_rotmats", traj.hand_rotmats),
+    ):
+        assert torch.all(torch.isfinite(value)), f"Non-finite {name}."
+    print("OK")
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,116 @@
+"""Compare latency of fused and per-modality encoder/decoder heads in the denoiser.
+
+The fused model is built from the unfused one with
+`fuse_modality_heads_state_dict()`. For each batch size (number of windows
+per forward pass), we report:
+- Max difference in denoiser outputs.
+- Latency of the modality encoders and decoders alone.
+- Latency of a full denoiser forward pass.
+
+Example:
+
+    python benchmarks/fused_modality_heads.py --device cpu --batch-sizes 1 8 32
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import torch
+import tyro
+from bench_utils import make_denoiser, time_fn
+from torch import Tensor
+
+from egoallo import network
+
+
+def run_heads(
+    denoiser: network.EgoDenoiser, x_t_packed: Tensor, latent: Tensor
+) -> Tensor:
+    """Run the modality encoders on `x_t_packed` and the decoders on `latent`."""
+    if isinstance(denoiser.encoders, network.FusedModalityEncoders):
+        assert isinstance(denoiser.decoders, network.FusedModalityDecoders)
+        return denoiser.encoders(x_t_packed) + denoiser.decoders(latent).sum()
+    assert isinstance(denoiser.decoders, torch.nn.ModuleDict)
+    modality_dims = network.get_modality_dims(denoiser.config.include_hands)
+    encoded = sum(
+        encoder(x)
+        for encoder, x in zip(
+            denoiser.encoders.values(),
+            torch.split(x_t_packed, list(modality_dims.values()), dim=-1),
+        )
+    )
+    decoded = torch.cat([decoder(latent) for decoder in denoiser.decoders.values()], -1)
+    assert isinstance(encoded, Tensor)
+    return encoded + decoded.sum()
+
+
+def main(
+    batch_sizes: tuple[int, ...] = (1, 8, 32),
+    window_size: int = 128,
+    num_repeats: int = 20,
+    device: str = "cpu",
+    checkpoint_dir: Path | None = None,
+) -> None:
+    torch_device = torch.device(device)
+    unfused = make_denoiser(checkpoint_dir, torch_device)
+    config = unfused.config
+    fused = network.EgoDenoiser(config, fused_modality_heads=True)
+    fused.load_state_dict(
+        network.fuse_modality_heads_state_dict(
+            unfused.state_dict(), config.include_hands
+        )
+    )
+    fused = fused.to(torch_device).eval()
+    models = {"unfused": unfused, "fused": fused}
+
+    print(
+        f"{'batch':>6} {'max diff':>10} {'heads unfused (ms)':>19}"
+        f" {'heads fused (ms)':>17} {'fwd unfused (ms)':>17} {'fwd fused (ms)':>15}"
+    )
+    for batch in batch_sizes:
+        x_t_packed = torch.randn(
+            (batch, window_size, unfused.get_d_state()), device=torch_device
+        )
+        cond_latent = torch.randn(
+            (batch, window_size, config.d_latent), device=torch_device
+        )
+        t = torch.full((batch,), 500, device=torch_device)
+
+        def forward(model: network.EgoDenoiser) -> Tensor:
+            with torch.inference_mode():
+                return model.forward(
+                    x_t_packed,
+                    t,
+                    T_world_cpf=None,
+                    T_cpf_tm1_cpf_t=None,
+                    project_output_rotmats=False,
+                    hand_positions_wrt_cpf=None,
+                    mask=None,
+                    cond_latent=cond_latent,
+                )
+
+        def heads(model: network.EgoDenoiser) -> Tensor:
+            with torch.inference_mode():
+                return run_heads(model, x_t_packed, cond_latent)
+
+        max_diff = torch.max(torch.abs(forward(fused) - forward(unfused))).item()
+        heads_times = {
+            name: time_fn(lambda: heads(model), torch_device, num_repeats)
+            for name, model in models.items()
+        }
+        forward_times = {
+            name: time_fn(lambda: forward(model), torch_device, num_repeats)
+            for name, model in models.items()
+        }
+        print(
+            f"{batch:>6} {max_diff:>10.2e}"
+            f" {heads_times['unfused'] * 1000:>19.2f}"
+            f" {heads_times['fused'] * 1000:>17.2f}"
+            f" {forward_times['unfused'] * 1000:>17.2f}"
+            f" {forward_times['fused'] * 1000:>15.2f}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,166 @@
+"""Compare per-call overhead of guidance optimization with and without the
+cached JAX body model and DLPack input transfers.
+
+`numpy` is the previous behavior: the JAX body model is rebuilt from NumPy
+copies of the PyTorch body model on every call, and inputs go through NumPy.
+`cached` uses `get_jax_body_model()` and DLPack, which is what
+`do_guidance_optimization()` does now. We report:
+- Time to convert inputs and the body model to JAX arrays, until they are
+  ready on device.
+- Time for a full `do_guidance_optimization()` call, including the
+  optimization itself. Inner guidance runs one of these per denoising step.
+- Max difference between the optimized rotations of the two paths.
+
+Example:
+
+    python benchmarks/guidance_call_overhead.py --seq-len 128 --device cuda
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import cast
+
+import jax
+import numpy as onp
+import torch
+import tyro
+from bench_utils import make_synthetic_Ts_world_cpf, time_fn
+
+from egoallo import fncsmpl, fncsmpl_jax, network
+from egoallo.guidance_optimizer_jax import (
+    do_guidance_optimization,
+    do_guidance_optimization_numpy,
+    get_jax_body_model,
+    jax_from_torch,
+)
+from egoallo.transforms import SO3
+
+
+def numpy_jax_body_model(body_model: fncsmpl.SmplhModel) -> fncsmpl_jax.SmplhModel:
+    """Convert a body model through NumPy, like guidance calls used to."""
+    return fncsmpl_jax.SmplhModel(
+        faces=cast(jax.Array, body_model.faces.numpy(force=True)),
+        J_regressor=cast(jax.Array, body_model.J_regressor.numpy(force=True)),
+        parent_indices=cast(jax.Array, onp.array(body_model.parent_indices)),
+        weights=cast(jax.Array, body_model.weights.numpy(force=True)),
+        posedirs=cast(jax.Array, body_model.posedirs.numpy(force=True)),
+        v_template=cast(jax.Array, body_model.v_template.numpy(force=True)),
+        shapedirs=cast(jax.Array, body_model.shapedirs.numpy(force=True)),
+    )
+
+
+def main(
+    seq_len: int = 128,
+    num_samples: int = 1,
+    num_repeats: int = 10,
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    device: str = "cuda",
+) -> None:
+    torch_device = torch.device(device)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch_device)
+
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len, torch_device)
+    generator = torch.Generator().manual_seed(0)
+    traj = network.EgoDenoiseTraj(
+        betas=torch.zeros((num_samples, seq_len, 16)),
+        body_rotmats=SO3.exp(
+            torch.randn((num_samples, seq_len, 21, 3), generator=generator) * 0.2
+        ).as_matrix(),
+        contacts=torch.rand((num_samples, seq_len, 21), generator=generator),
+        hand_rotmats=SO3.exp(
+            torch.randn((num_samples, seq_len, 30, 3), generator=generator) * 0.2
+        ).as_matrix(),
+    ).to(torch_device)
+    assert traj.hand_rotmats is not None
+    hand_rotmats = traj.hand_rotmats
+
+    def convert_numpy() -> None:
+        inputs = [
+            jax.numpy.asarray(x.numpy(force=True))
+            for x in (
+                Ts_world_cpf,
+                traj.betas,
+                traj.body_rotmats,
+                hand_rotmats,
+                traj.contacts,
+            )
+        ]
+        body = jax.tree_util.tree_map(
+            jax.numpy.asarray, numpy_jax_body_model(body_model)
+        )
+        jax.block_until_ready((inputs, body))
+
+    def convert_cached() -> None:
+        inputs = [
+            jax_from_torch(x)
+            for x in (
+                Ts_world_cpf,
+                traj.betas,
+                traj.body_rotmats,
+                hand_rotmats,
+                traj.contacts,
+            )
+        ]
+        body = get_jax_body_model(body_model)
+        jax.block_until_ready((inputs, body))
+
+    def guidance_numpy() -> onp.ndarray:
+        quats, _ = do_guidance_optimization_numpy(
+            Ts_world_cpf=Ts_world_cpf.numpy(force=True),
+            betas=traj.betas.numpy(force=True),
+            body_rotmats=traj.body_rotmats.numpy(force=True),
+            hand_rotmats=hand_rotmats.numpy(force=True),
+            contacts=traj.contacts.numpy(force=True),
+            body=numpy_jax_body_model(body_model),
+            guidance_mode="no_hands",
+            phase="inner",
+            hamer_detections=None,
+            aria_detections=None,
+            verbose=False,
+        )
+        return quats
+
+    def guidance_cached() -> onp.ndarray:
+        out, _ = do_guidance_optimization(
+            Ts_world_cpf=Ts_world_cpf,
+            traj=traj,
+            body_model=body_model,
+            guidance_mode="no_hands",
+            phase="inner",
+            hamer_detections=None,
+            aria_detections=None,
+            verbose=False,
+        )
+        assert out.hand_rotmats is not None
+        return SO3.from_matrix(
+            torch.cat([out.body_rotmats, out.hand_rotmats], dim=-3)
+        ).wxyz.numpy(force=True)
+
+    # Quaternions from the matrix round-trip can flip sign.
+    quats_numpy = guidance_numpy()
+    quats_cached = guidance_cached()
+    max_diff = onp.max(
+        onp.minimum(
+            onp.abs(quats_numpy - quats_cached), onp.abs(quats_numpy + quats_cached)
+        )
+    )
+
+    times = {
+        "numpy": (
+            time_fn(convert_numpy, torch_device, num_repeats),
+            time_fn(guidance_numpy, torch_device, num_repeats),
+        ),
+        "cached": (
+            time_fn(convert_cached, torch_device, num_repeats),
+            time_fn(guidance_cached, torch_device, num_repeats),
+        ),
+    }
+    print(f"max quaternion diff: {max_diff:.2e}\n")
+    print(f"{'path':>8} {'convert (ms)':>13} {'call (ms)':>10}")
+    for name, (convert_time, call_time) in times.items():
+        print(f"{name:>8} {convert_time * 1000:>13.2f} {call_time * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,174 @@
+"""Compare memory and latency of chunked and monolithic guidance against
+sequence length.
+
+`monolithic` optimizes the whole sequence at once. `chunked` splits it into
+overlapping chunks that are optimized in parallel, blends them, and refines
+the seams; see `JaxGuidanceParams.chunk_size`. For each sequence length and
+mode, we report:
+- Time for the first call, which includes compilation.
+- Median time for later calls.
+- Peak memory. On GPU, this is JAX's peak device memory. On CPU, it's the
+  peak resident memory of the process.
+- Max and mean quaternion difference of `chunked` from `monolithic`.
+
+Each configuration runs in a fresh process, so peak memory isn't shared
+between them. Runs that fail, for example from running out of memory, are
+reported as such.
+
+Example:
+
+    python benchmarks/guidance_chunking.py --seq-lens 512 2048 8192 --device cuda
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses
+import multiprocessing
+import resource
+import time
+from pathlib import Path
+
+import jax
+import numpy as onp
+import torch
+import tyro
+from bench_utils import make_synthetic_Ts_world_cpf, time_fn
+
+from egoallo import fncsmpl, network
+from egoallo.guidance_optimizer_jax import (
+    GuidanceLinearSolver,
+    JaxGuidanceParams,
+    do_guidance_optimization,
+)
+from egoallo.transforms import SO3
+
+
+def run_guidance(
+    seq_len: int,
+    chunk_size: int | None,
+    chunk_overlap: int,
+    linear_solver: GuidanceLinearSolver,
+    num_samples: int,
+    num_repeats: int,
+    smplh_npz_path: Path,
+    device: str,
+) -> tuple[float, float, float, onp.ndarray]:
+    """Run post-sampling `no_hands` guidance in this process. Returns the
+    first call time, median call time, peak memory in MB, and optimized body
+    quaternions."""
+    torch_device = torch.device(device)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch_device)
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len, torch_device)
+    generator = torch.Generator().manual_seed(0)
+    traj = network.EgoDenoiseTraj(
+        betas=torch.zeros((num_samples, seq_len, 16)),
+        body_rotmats=SO3.exp(
+            torch.randn((num_samples, seq_len, 21, 3), generator=generator) * 0.2
+        ).as_matrix(),
+        contacts=torch.rand((num_samples, seq_len, 21), generator=generator),
+        hand_rotmats=SO3.exp(
+            torch.randn((num_samples, seq_len, 30, 3), generator=generator) * 0.2
+        ).as_matrix(),
+    ).to(torch_device)
+    guidance_params = dataclasses.replace(
+        JaxGuidanceParams.defaults("no_hands", "post"),
+        linear_solver=linear_solver,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+
+    def guidance() -> onp.ndarray:
+        out, _ = do_guidance_optimization(
+            Ts_world_cpf=Ts_world_cpf,
+            traj=traj,
+            body_model=body_model,
+            guidance_mode="no_hands",
+            phase="post",
+            hamer_detections=None,
+            aria_detections=None,
+            verbose=False,
+            guidance_params=guidance_params,
+        )
+        return SO3.from_matrix(out.body_rotmats).wxyz.numpy(force=True)
+
+    start_time = time.perf_counter()
+    quats = guidance()
+    first_call_time = time.perf_counter() - start_time
+    call_time = time_fn(guidance, torch_device, num_repeats)
+
+    memory_stats = jax.devices()[0].memory_stats()
+    if memory_stats is not None and "peak_bytes_in_use" in memory_stats:
+        peak_mb = memory_stats["peak_bytes_in_use"] / 1024**2
+    else:
+        # Kilobytes on Linux.
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return first_call_time, call_time, peak_mb, quats
+
+
+def main(
+    seq_lens: tuple[int, ...] = (512, 2048, 8192),
+    chunk_size: int = 256,
+    chunk_overlap: int = 32,
+    linear_solver: GuidanceLinearSolver = "conjugate_gradient",
+    num_samples: int = 1,
+    num_repeats: int = 3,
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    device: str = "cuda",
+) -> None:
+    rows = []
+    for seq_len in seq_lens:
+        quats = dict[str, onp.ndarray]()
+        for mode, mode_chunk_size in (("monolithic", None), ("chunked", chunk_size)):
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                try:
+                    first_call_time, call_time, peak_mb, quats[mode] = executor.submit(
+                        run_guidance,
+                        seq_len=seq_len,
+                        chunk_size=mode_chunk_size,
+                        chunk_overlap=chunk_overlap,
+                        linear_solver=linear_solver,
+                        num_samples=num_samples,
+                        num_repeats=num_repeats,
+                        smplh_npz_path=smplh_npz_path,
+                        device=device,
+                    ).result()
+                except Exception as e:
+                    print(f"{mode} failed for {seq_len=}: {e!r}")
+                    rows.append((seq_len, mode, None))
+                    continue
+            rows.append((seq_len, mode, (first_call_time, call_time, peak_mb)))
+
+        if len(quats) == 2:
+            # Quaternions from the matrix round-trip can flip sign.
+            diff = onp.max(
+                onp.minimum(
+                    onp.abs(quats["chunked"] - quats["monolithic"]),
+                    onp.abs(quats["chunked"] + quats["monolithic"]),
+                ),
+                axis=-1,
+            )
+            print(
+                f"{seq_len=}: chunked vs monolithic quaternion diff max"
+                f" {diff.max():.2e}, mean {diff.mean():.2e}"
+            )
+
+    print(
+        f"\n{'seq_len':>8} {'mode':>11} {'first call (s)':>15} {'call (ms)':>10}"
+        f" {'peak (MB)':>10}"
+    )
+    for seq_len, mode, result in rows:
+        if result is None:
+            print(f"{seq_len:>8} {mode:>11} {'failed':>15}")
+            continue
+        first_call_time, call_time, peak_mb = result
+        print(
+            f"{seq_len:>8} {mode:>11} {first_call_time:>15.2f}"
+            f" {call_time * 1000:>10.2f} {peak_mb:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,125 @@
+"""Compare convergence and latency of linear solvers for guidance optimization.
+
+`conjugate_gradient` is the jaxls solver we've always used.
+`block_banded` factorizes the block-banded normal equations directly.
+For each sequence length, solver, and number of Levenberg-Marquardt
+iterations, we report:
+- Time for the first call, which includes compilation.
+- Time for later calls.
+- Max quaternion difference from a reference solution. The reference is
+  computed with `block_banded` and `--reference-iters` iterations.
+
+We run post-sampling `no_hands` guidance, which only has body costs. Inputs
+are random poses along a walking-like head trajectory.
+
+Example:
+
+    python benchmarks/guidance_linear_solver.py --seq-lens 128 2048 --device cuda
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import jax_dataclasses as jdc
+import numpy as onp
+import torch
+import tyro
+from bench_utils import make_synthetic_Ts_world_cpf, time_fn
+
+from egoallo import fncsmpl, network
+from egoallo.guidance_optimizer_jax import (
+    GuidanceLinearSolver,
+    JaxGuidanceParams,
+    do_guidance_optimization,
+)
+from egoallo.transforms import SO3
+
+
+def main(
+    seq_lens: tuple[int, ...] = (128, 2048),
+    max_iters: tuple[int, ...] = (5, 20),
+    reference_iters: int = 100,
+    num_samples: int = 1,
+    num_repeats: int = 3,
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    device: str = "cuda",
+) -> None:
+    torch_device = torch.device(device)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch_device)
+
+    rows = []
+    for seq_len in seq_lens:
+        Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len, torch_device)
+        generator = torch.Generator().manual_seed(0)
+        traj = network.EgoDenoiseTraj(
+            betas=torch.zeros((num_samples, seq_len, 16)),
+            body_rotmats=SO3.exp(
+                torch.randn((num_samples, seq_len, 21, 3), generator=generator) * 0.2
+            ).as_matrix(),
+            contacts=torch.rand((num_samples, seq_len, 21), generator=generator),
+            hand_rotmats=SO3.exp(
+                torch.randn((num_samples, seq_len, 30, 3), generator=generator) * 0.2
+            ).as_matrix(),
+        ).to(torch_device)
+
+        def guidance(
+            linear_solver: GuidanceLinearSolver,
+            iters: int,
+        ) -> onp.ndarray:
+            out, _ = do_guidance_optimization(
+                Ts_world_cpf=Ts_world_cpf,
+                traj=traj,
+                body_model=body_model,
+                guidance_mode="no_hands",
+                phase="post",
+                hamer_detections=None,
+                aria_detections=None,
+                verbose=False,
+                guidance_params=jdc.replace(
+                    JaxGuidanceParams.defaults("no_hands", "post"),
+                    linear_solver=linear_solver,
+                    max_iters=iters,
+                ),
+            )
+            return SO3.from_matrix(out.body_rotmats).wxyz.numpy(force=True)
+
+        reference = guidance("block_banded", reference_iters)
+        linear_solver: GuidanceLinearSolver
+        for linear_solver in ("conjugate_gradient", "block_banded"):
+            for iters in max_iters:
+                start_time = time.perf_counter()
+                quats = guidance(linear_solver, iters)
+                first_call_time = time.perf_counter() - start_time
+                call_time = time_fn(
+                    lambda: guidance(linear_solver, iters), torch_device, num_repeats
+                )
+                # Quaternions from the matrix round-trip can flip sign.
+                max_diff = onp.max(
+                    onp.minimum(onp.abs(quats - reference), onp.abs(quats + reference))
+                )
+                rows.append(
+                    (
+                        seq_len,
+                        linear_solver,
+                        iters,
+                        first_call_time,
+                        call_time,
+                        max_diff,
+                    )
+                )
+
+    print(
+        f"\n{'seq_len':>8} {'solver':>19} {'iters':>6} {'first call (s)':>15}"
+        f" {'call (ms)':>10} {'diff from ref':>14}"
+    )
+    for seq_len, solver, iters, first_call_time, call_time, max_diff in rows:
+        print(
+            f"{seq_len:>8} {solver:>19} {iters:>6} {first_call_time:>15.2f}"
+            f" {call_time * 1000:>10.2f} {max_diff:>14.2e}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,145 @@
+"""Compare inner guidance with and without a persistent `GuidanceSession`.
+
+Inner guidance runs once per denoising step, on clean predictions that
+converge as sampling goes on. We imitate this with a fixed trajectory plus
+noise that shrinks at each step. `cold` calls `do_guidance_optimization()`
+from scratch at each step, and `session` warm-starts each call from the
+previous one. For each linear solver, we report:
+- Total time for all steps, after a warmup run that compiles everything.
+- Max quaternion difference between the two paths, at the last step.
+
+Example:
+
+    python benchmarks/guidance_warm_start.py --seq-len 128 --device cuda
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import jax_dataclasses as jdc
+import numpy as onp
+import torch
+import tyro
+from bench_utils import make_synthetic_Ts_world_cpf
+
+from egoallo import fncsmpl, network
+from egoallo.guidance_optimizer_jax import (
+    GuidanceLinearSolver,
+    GuidanceSession,
+    JaxGuidanceParams,
+    do_guidance_optimization,
+)
+from egoallo.transforms import SO3
+
+
+def main(
+    seq_len: int = 128,
+    num_samples: int = 1,
+    num_steps: int = 30,
+    max_iters: int = 5,
+    cost_tolerance: float = 1e-3,
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    device: str = "cuda",
+) -> None:
+    torch_device = torch.device(device)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch_device)
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len, torch_device)
+
+    # Clean predictions for each step, with noise that shrinks to zero.
+    generator = torch.Generator().manual_seed(0)
+    target = SO3.exp(
+        torch.randn((num_samples, seq_len, 21, 3), generator=generator) * 0.2
+    )
+    preds = [
+        network.EgoDenoiseTraj(
+            betas=torch.zeros((num_samples, seq_len, 16)),
+            body_rotmats=(
+                target
+                @ SO3.exp(
+                    torch.randn((num_samples, seq_len, 21, 3), generator=generator)
+                    * 0.3
+                    * (1.0 - i / num_steps)
+                )
+            ).as_matrix(),
+            contacts=torch.rand((num_samples, seq_len, 21), generator=generator),
+            hand_rotmats=SO3.exp(
+                torch.randn((num_samples, seq_len, 30, 3), generator=generator) * 0.2
+            ).as_matrix(),
+        ).to(torch_device)
+        for i in range(num_steps)
+    ]
+
+    def run(
+        linear_solver: GuidanceLinearSolver,
+        use_session: bool,
+    ) -> tuple[float, onp.ndarray]:
+        guidance_params = jdc.replace(
+            JaxGuidanceParams.defaults("no_hands", "inner"),
+            linear_solver=linear_solver,
+            max_iters=max_iters,
+            cost_tolerance=cost_tolerance,
+        )
+        session = GuidanceSession(
+            Ts_world_cpf=Ts_world_cpf,
+            body_model=body_model,
+            guidance_mode="no_hands",
+            phase="inner",
+            hamer_detections=None,
+            aria_detections=None,
+            verbose=False,
+            guidance_params=guidance_params,
+        )
+        start_time = time.perf_counter()
+        out = None
+        for pred in preds:
+            if use_session:
+                out, _ = session(pred)
+            else:
+                out, _ = do_guidance_optimization(
+                    Ts_world_cpf=Ts_world_cpf,
+                    traj=pred,
+                    body_model=body_model,
+                    guidance_mode="no_hands",
+                    phase="inner",
+                    hamer_detections=None,
+                    aria_detections=None,
+                    verbose=False,
+                    guidance_params=guidance_params,
+                )
+        total_time = time.perf_counter() - start_time
+        assert out is not None
+        return total_time, SO3.from_matrix(out.body_rotmats).wxyz.numpy(force=True)
+
+    rows = []
+    linear_solver: GuidanceLinearSolver
+    for linear_solver in ("conjugate_gradient", "block_banded"):
+        # Warmup, for compilation.
+        run(linear_solver, use_session=False)
+        run(linear_solver, use_session=True)
+
+        cold_time, cold_quats = run(linear_solver, use_session=False)
+        session_time, session_quats = run(linear_solver, use_session=True)
+        # Quaternions from the matrix round-trip can flip sign.
+        max_diff = onp.max(
+            onp.minimum(
+                onp.abs(cold_quats - session_quats),
+                onp.abs(cold_quats + session_quats),
+            )
+        )
+        rows.append((linear_solver, cold_time, session_time, max_diff))
+
+    print(
+        f"\n{'solver':>19} {'cold (s)':>9} {'session (s)':>12}"
+        f" {'diff at last step':>18}"
+    )
+    for linear_solver, cold_time, session_time, max_diff in rows:
+        print(
+            f"{linear_solver:>19} {cold_time:>9.2f} {session_time:>12.2f}"
+            f" {max_diff:>18.2e}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
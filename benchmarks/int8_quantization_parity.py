@@ -0,0 +1,159 @@
+"""Compare a dynamically int8-quantized denoiser to the float32 model on AMASS test windows.
+
+For each window, ground-truth motion is noised to a few noise levels, and both
+models predict the clean trajectory. We report the per-modality relative error
+of the int8 predictions against float32, the body rotation error after SVD
+projection, the joint position error, and the time per forward pass.
+
+Dynamic quantization needs no calibration data: activation ranges are computed
+on the fly. This script is the check that quantized outputs stay close enough
+to float32 before enabling `--quantize-int8` for inference.
+
+Example:
+
+    python benchmarks/int8_quantization_parity.py \\
+        --dataset-hdf5-path ./data/egoalgo_no_skating_dataset.hdf5 \\
+        --dataset-files-path ./data/egoalgo_no_skating_dataset_files.txt
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import tyro
+
+from egoallo import fncsmpl, network
+from egoallo.data.amass import EgoAmassHdf5Dataset
+from egoallo.inference_utils import load_denoiser
+from egoallo.sampling import CosineNoiseScheduleConstants
+from egoallo.transforms import SO3
+
+
+def main(
+    dataset_hdf5_path: Path,
+    dataset_files_path: Path,
+    subseq_len: int = 128,
+    max_windows: int = 50,
+    noise_levels: tuple[int, ...] = (1000, 500, 100, 10),
+    checkpoint_dir: Path = Path("./egoallo_checkpoint_april13/checkpoints_3000000/"),
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    cache_quantized: bool = True,
+) -> None:
+    device = torch.device("cpu")
+    float_network = load_denoiser(checkpoint_dir).to(device).eval()
+    int8_network = load_denoiser(
+        checkpoint_dir, quantize_int8=True, cache_quantized=cache_quantized
+    )
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(device)
+    include_hands = float_network.config.include_hands
+    noise_constants = CosineNoiseScheduleConstants.compute(timesteps=1000).to(device)
+
+    dataset = EgoAmassHdf5Dataset(
+        dataset_hdf5_path,
+        dataset_files_path,
+        splits=("test",),
+        subseq_len=subseq_len,
+        cache_files=True,
+        slice_strategy="deterministic",
+        random_variable_len_proportion=0.0,
+    )
+    num_windows = min(max_windows, len(dataset))
+
+    errors: dict[int, dict[str, list[float]]] = {t: {} for t in noise_levels}
+    timings: dict[str, list[float]] = {"float32": [], "int8": []}
+    for i in range(num_windows):
+        sequence = dataset[i].to(device)
+        assert sequence.hand_quats is not None
+        x_0_packed = network.EgoDenoiseTraj(
+            betas=sequence.betas.expand((subseq_len, 16)),
+            body_rotmats=SO3(sequence.body_quats).as_matrix(),
+            contacts=sequence.contacts,
+            hand_rotmats=SO3(sequence.hand_quats).as_matrix()
+            if include_hands
+            else None,
+        ).pack()[None]
+
+        generator = torch.Generator().manual_seed(i)
+        for t in noise_levels:
+            alpha_bar_t = noise_constants.alpha_bar_t[t].to(torch.float32)
+            x_t_packed = torch.sqrt(alpha_bar_t) * x_0_packed + torch.sqrt(
+                1.0 - alpha_bar_t
+            ) * torch.randn(x_0_packed.shape, generator=generator)
+
+            preds: dict[str, torch.Tensor] = {}
+            for name, model in (("float32", float_network), ("int8", int8_network)):
+                start_time = time.perf_counter()
+                with torch.inference_mode():
+                    preds[name] = model.forward(
+                        x_t_packed,
+                        torch.tensor([t]),
+                        T_world_cpf=sequence.T_world_cpf[None],
+                        T_cpf_tm1_cpf_t=sequence.T_cpf_tm1_cpf_t[None],
+                        project_output_rotmats=False,
+                        hand_positions_wrt_cpf=None,
+                        mask=None,
+                    )
+                timings[name].append(time.perf_counter() - start_time)
+
+            float_traj = network.EgoDenoiseTraj.unpack(
+                preds["float32"], include_hands=include_hands, project_rotmats=True
+            )
+            int8_traj = network.EgoDenoiseTraj.unpack(
+                preds["int8"], include_hands=include_hands, project_rotmats=True
+            )
+            window_errors = {
+                f"{key} rel err": (
+                    torch.linalg.norm(
+                        getattr(int8_traj, key) - getattr(float_traj, key)
+                    )
+                    / torch.linalg.norm(getattr(float_traj, key))
+                ).item()
+                for key in ("betas", "body_rotmats", "contacts")
+                + (("hand_rotmats",) if include_hands else ())
+            }
+            window_errors["body rot err (deg)"] = float(
+                torch.rad2deg(
+                    torch.mean(
+                        torch.linalg.norm(
+                            (
+                                SO3.from_matrix(float_traj.body_rotmats).inverse()
+                                @ SO3.from_matrix(int8_traj.body_rotmats)
+                            ).log(),
+                            dim=-1,
+                        )
+                    )
+                )
+            )
+            window_errors["joint err (mm)"] = (
+                torch.mean(
+                    torch.linalg.norm(
+                        int8_traj.apply_to_body(body_model).Ts_world_joint[..., 4:7]
+                        - float_traj.apply_to_body(body_model).Ts_world_joint[..., 4:7],
+                        dim=-1,
+                    )
+                ).item()
+                * 1000.0
+            )
+            for k, v in window_errors.items():
+                errors[t].setdefault(k, []).append(v)
+
+    keys = list(errors[noise_levels[0]].keys())
+    print(f"int8 vs float32 over {num_windows} windows of length {subseq_len}")
+    print(f"{'t':>6} " + " ".join(f"{k:>20}" for k in keys))
+    for t in noise_levels:
+        print(f"{t:>6} " + " ".join(f"{np.mean(errors[t][k]):>20.4f}" for k in keys))
+
+    # The first forward pass for each model includes warmup.
+    float_time = float(np.median(timings["float32"][1:] or timings["float32"]))
+    int8_time = float(np.median(timings["int8"][1:] or timings["int8"]))
+    print(
+        f"forward pass: float32 {float_time * 1000:.1f} ms,"
+        f" int8 {int8_time * 1000:.1f} ms ({float_time / int8_time:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,228 @@
+"""Compare local-attention single-pass denoising to stitched windows on long sequences.
+
+`stitched` chops the sequence into 128-frame windows with 32 frames of overlap,
+which is how the denoiser is normally run. `local` sets
+`EgoDenoiser.local_attention` and denoises the whole sequence in one forward
+pass. For each sequence length, we report:
+- Latency and peak GPU memory of one denoising step.
+- Latency of a full sampling run.
+- Body rotation difference between `local` and `stitched` clean predictions,
+  for stitched samples re-noised to a few noise levels.
+- Body rotation difference between final samples, from the same initial noise.
+- Mean frame-to-frame body rotation change of the final samples, which goes up
+  if there are seams between windows.
+
+Differences are only meaningful with a trained checkpoint. Inputs are a
+synthetic walking trajectory.
+
+Example:
+
+    python benchmarks/long_context_attention.py --seq-lens 1000 10000 \\
+        --checkpoint-dir ./egoallo_checkpoint_april13/checkpoints_3000000/
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Literal
+
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf, time_fn
+from torch import Tensor
+
+from egoallo import network
+from egoallo.sampling import (
+    CosineNoiseScheduleConstants,
+    StitchedWindows,
+    denoise_with_stitching,
+    run_sampling_with_stitching,
+)
+from egoallo.stitching_plan import StitchingPlan
+from egoallo.transforms import SE3, SO3
+
+
+def body_rotmats(x_packed: Tensor, include_hands: bool) -> Tensor:
+    return network.EgoDenoiseTraj.unpack(
+        x_packed, include_hands=include_hands, project_rotmats=True
+    ).body_rotmats
+
+
+def rotation_diff_deg(a: Tensor, b: Tensor) -> float:
+    """Mean geodesic distance between two sets of rotation matrices."""
+    return float(
+        torch.rad2deg(
+            torch.mean(
+                torch.linalg.norm(
+                    (SO3.from_matrix(a).inverse() @ SO3.from_matrix(b)).log(), dim=-1
+                )
+            )
+        )
+    )
+
+
+def main(
+    seq_lens: tuple[int, ...] = (1000, 10000),
+    num_samples: int = 1,
+    noise_levels: tuple[int, ...] = (1000, 500, 100),
+    block_size: int = 64,
+    context_size: int = 32,
+    windows_per_batch: int | None = None,
+    num_repeats: int = 3,
+    device: str = "cuda",
+    checkpoint_dir: Path | None = None,
+) -> None:
+    torch_device = torch.device(device)
+    denoiser_network = make_denoiser(checkpoint_dir, torch_device)
+    include_hands = denoiser_network.config.include_hands
+    local_attention = network.LocalAttentionConfig(block_size, context_size)
+    noise_constants = CosineNoiseScheduleConstants.compute(timesteps=1000).to(
+        torch_device
+    )
+    modes: tuple[Literal["stitched", "local"], ...] = ("stitched", "local")
+
+    rows = []
+    for seq_len in seq_lens:
+        Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len + 1, torch_device)
+        T_cpf_tm1_cpf_t = (
+            SE3(Ts_world_cpf[:-1, :]).inverse() @ SE3(Ts_world_cpf[1:, :])
+        ).wxyz_xyz
+        plans = {
+            "stitched": StitchingPlan(windows_per_batch=windows_per_batch),
+            "local": StitchingPlan(window_size=seq_len, overlap_size=0),
+        }
+
+        samples: dict[str, Tensor] = {}
+        sample_times: dict[str, float] = {}
+        for mode in modes:
+            denoiser_network.local_attention = (
+                local_attention if mode == "local" else None
+            )
+            torch.manual_seed(0)
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+            start_time = time.perf_counter()
+            samples[mode] = run_sampling_with_stitching(
+                denoiser_network,
+                body_model=None,  # type: ignore
+                guidance_mode="off",
+                guidance_post=False,
+                guidance_inner=False,
+                Ts_world_cpf=Ts_world_cpf,
+                floor_z=0.0,
+                hamer_detections=None,
+                aria_detections=None,
+                num_samples=num_samples,
+                device=torch_device,
+                plan=plans[mode],
+            ).pack()
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+            sample_times[mode] = time.perf_counter() - start_time
+
+        # Re-noise the stitched samples, so denoiser inputs are realistic.
+        generator = torch.Generator(device=torch_device).manual_seed(0)
+        x_0_packed = samples["stitched"]
+        noise = torch.randn(x_0_packed.shape, generator=generator, device=torch_device)
+        x_t_from_t = {}
+        for t in noise_levels:
+            alpha_bar_t = noise_constants.alpha_bar_t[t].to(torch.float32)
+            x_t_from_t[t] = (
+                torch.sqrt(alpha_bar_t) * x_0_packed
+                + torch.sqrt(1.0 - alpha_bar_t) * noise
+            )
+
+        preds: dict[str, dict[int, Tensor]] = {}
+        step_times: dict[str, float] = {}
+        peak_mb: dict[str, float] = {}
+        for mode in modes:
+            denoiser_network.local_attention = (
+                local_attention if mode == "local" else None
+            )
+            plan = plans[mode]
+            windows = StitchedWindows.make(
+                denoiser_network,
+                T_cpf_tm1_cpf_t,
+                T_world_cpf=Ts_world_cpf[1:, :],
+                window_size=plan.window_size,
+                overlap_size=plan.overlap_size,
+            )
+
+            def denoise_step(t: int) -> Tensor:
+                with torch.inference_mode():
+                    return denoise_with_stitching(
+                        denoiser_network,
+                        x_t_from_t[t],
+                        t=t,
+                        windows=windows,
+                        windows_per_batch=plan.windows_per_batch,
+                    )
+
+            preds[mode] = {t: denoise_step(t) for t in noise_levels}
+            if torch_device.type == "cuda":
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(torch_device)
+                baseline = torch.cuda.memory_allocated(torch_device)
+                denoise_step(noise_levels[0])
+                peak = torch.cuda.max_memory_allocated(torch_device) - baseline
+                peak_mb[mode] = peak / 1024**2
+            step_times[mode] = time_fn(
+                lambda: denoise_step(noise_levels[0]), torch_device, num_repeats
+            )
+
+        rot_diffs = {
+            t: rotation_diff_deg(
+                body_rotmats(preds["stitched"][t], include_hands),
+                body_rotmats(preds["local"][t], include_hands),
+            )
+            for t in noise_levels
+        }
+        sample_diff = rotation_diff_deg(
+            body_rotmats(samples["stitched"], include_hands),
+            body_rotmats(samples["local"], include_hands),
+        )
+        frame_deltas = {}
+        for mode in modes:
+            rotmats = body_rotmats(samples[mode], include_hands)
+            frame_deltas[mode] = rotation_diff_deg(rotmats[:, :-1], rotmats[:, 1:])
+        rows.append(
+            (
+                seq_len,
+                step_times,
+                peak_mb,
+                sample_times,
+                rot_diffs,
+                sample_diff,
+                frame_deltas,
+            )
+        )
+
+    print(
+        f"{'seq_len':>8} {'mode':>9} {'step (ms)':>10} {'peak (MB)':>10}"
+        f" {'sample (s)':>11} {'frame delta':>12}"
+    )
+    for seq_len, step_times, peak_mb, sample_times, _, _, frame_deltas in rows:
+        for mode in modes:
+            peak = f"{peak_mb[mode]:>10.1f}" if mode in peak_mb else f"{'-':>10}"
+            print(
+                f"{seq_len:>8} {mode:>9} {step_times[mode] * 1000:>10.1f} {peak}"
+                f" {sample_times[mode]:>11.2f} {frame_deltas[mode]:>11.3f}°"
+            )
+
+    print("\nBody rotation difference, local vs stitched (degrees)")
+    print(
+        f"{'seq_len':>8} "
+        + " ".join(f"{'x0 @ t=' + str(t):>12}" for t in noise_levels)
+        + f" {'samples':>10}"
+    )
+    for seq_len, _, _, _, rot_diffs, sample_diff, _ in rows:
+        print(
+            f"{seq_len:>8} "
+            + " ".join(f"{rot_diffs[t]:>12.3f}" for t in noise_levels)
+            + f" {sample_diff:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,255 @@
+"""Check parity and latency of ONNX Runtime sampling against PyTorch.
+
+The denoiser is exported to ONNX, and we report:
+- Max difference in denoiser outputs for one stitched denoising step.
+- Max difference in final samples after a full sampling run. Both backends
+  use the same initial and per-step noise, so this includes the stochastic
+  part of DDIM (`eta>0`).
+- Wall-clock time for one stitched denoising step and one sampling run.
+
+Both backends run on the CPU, which is the use case for ONNX Runtime sampling.
+We also repeat the ONNX sampling run in a subprocess where PyTorch can't be
+imported, and check that it matches.
+
+Example:
+
+    python benchmarks/onnx_sampling_parity.py --seq-len 1000 --num-samples 4
+"""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf, time_fn
+
+from egoallo.onnx_export import export_denoiser_onnx
+from egoallo.onnx_sampling import (
+    OnnxDenoiser,
+    OnnxStitchedWindows,
+    denoise_with_stitching_onnx,
+    run_sampling_onnx,
+)
+from egoallo.sampling import (
+    SamplerConfig,
+    StitchedWindows,
+    denoise_with_stitching,
+    run_sampling_with_stitching,
+)
+from egoallo.stitching_plan import StitchingPlan
+from egoallo.transforms import SE3
+
+# Runs `run_sampling_onnx()` with the arguments in an .npz file.
+_SAMPLE_WITHOUT_TORCH = """
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Make `import torch` fail, like on a worker without PyTorch.
+sys.modules["torch"] = None
+from egoallo.onnx_sampling import OnnxDenoiser, run_sampling_onnx
+
+onnx_dir, inputs_path, output_path = map(Path, sys.argv[1:])
+inputs = np.load(inputs_path)
+samples = run_sampling_onnx(
+    OnnxDenoiser(onnx_dir, num_threads=int(inputs["num_threads"]) or None),
+    body_model=None,
+    guidance_mode="off",
+    guidance_post=False,
+    guidance_inner=False,
+    Ts_world_cpf=inputs["Ts_world_cpf"],
+    floor_z=0.0,
+    hamer_detections=None,
+    aria_detections=None,
+    num_samples=inputs["initial_noise"].shape[0],
+    ts=inputs["ts"],
+    guidance_verbose=False,
+    eta=float(inputs["eta"]),
+    window_size=int(inputs["window_size"]),
+    overlap_size=int(inputs["overlap_size"]),
+    windows_per_batch=int(inputs["windows_per_batch"]) or None,
+    initial_noise=inputs["initial_noise"],
+    step_noise=inputs["step_noise"],
+)
+np.save(output_path, samples)
+"""
+
+
+def main(
+    seq_len: int = 1000,
+    num_samples: int = 1,
+    num_steps: int | None = None,
+    windows_per_batch: int | None = None,
+    num_repeats: int = 5,
+    num_threads: int | None = None,
+    checkpoint_dir: Path | None = None,
+    onnx_dir: Path | None = None,
+) -> None:
+    """If `onnx_dir` is None, the model is exported to a temporary directory."""
+    device = torch.device("cpu")
+    denoiser_network = make_denoiser(checkpoint_dir, device)
+    plan = StitchingPlan(windows_per_batch=windows_per_batch)
+    sampler = SamplerConfig(num_steps=num_steps)
+
+    if onnx_dir is None:
+        onnx_dir = Path(tempfile.mkdtemp())
+    start_time = time.perf_counter()
+    export_denoiser_onnx(denoiser_network, onnx_dir, window_size=plan.window_size)
+    export_time = time.perf_counter() - start_time
+    onnx_denoiser = OnnxDenoiser(onnx_dir, num_threads=num_threads)
+
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len + 1, device)
+    T_cpf_tm1_cpf_t = (
+        SE3(Ts_world_cpf[:-1, :]).inverse() @ SE3(Ts_world_cpf[1:, :])
+    ).wxyz_xyz
+    windows = StitchedWindows.make(
+        denoiser_network,
+        T_cpf_tm1_cpf_t,
+        T_world_cpf=Ts_world_cpf[1:, :],
+        window_size=plan.window_size,
+        overlap_size=plan.overlap_size,
+    )
+    onnx_windows = OnnxStitchedWindows(
+        onnx_denoiser,
+        T_cpf_tm1_cpf_t.numpy(),
+        T_world_cpf=Ts_world_cpf[1:, :].numpy(),
+        window_size=plan.window_size,
+        overlap_size=plan.overlap_size,
+    )
+    x_t_packed = torch.randn((num_samples, seq_len, denoiser_network.get_d_state()))
+
+    def torch_step() -> torch.Tensor:
+        with torch.inference_mode():
+            return denoise_with_stitching(
+                denoiser_network,
+                x_t_packed,
+                t=500,
+                windows=windows,
+                windows_per_batch=plan.windows_per_batch,
+            )
+
+    def onnx_step() -> np.ndarray:
+        return denoise_with_stitching_onnx(
+            onnx_denoiser,
+            x_t_packed.numpy(),
+            t=500,
+            windows=onnx_windows,
+            windows_per_batch=plan.windows_per_batch,
+        )
+
+    # Without guidance, `run_sampling_with_stitching()` draws its initial
+    # noise and then one noise sample per DDIM step, so we can reproduce all
+    # of it by resetting the seed.
+    torch.manual_seed(0)
+    initial_noise = torch.randn(x_t_packed.shape).numpy()
+    step_noise = np.stack(
+        [
+            torch.randn(x_t_packed.shape).numpy()
+            for _ in range(len(sampler.get_ts()) - 1)
+        ]
+    )
+
+    def torch_sample() -> np.ndarray:
+        torch.manual_seed(0)
+        return (
+            run_sampling_with_stitching(
+                denoiser_network,
+                body_model=None,  # type: ignore
+                guidance_mode="off",
+                guidance_post=False,
+                guidance_inner=False,
+                Ts_world_cpf=Ts_world_cpf,
+                floor_z=0.0,
+                hamer_detections=None,
+                aria_detections=None,
+                num_samples=num_samples,
+                device=device,
+                guidance_verbose=False,
+                sampler=sampler,
+                plan=plan,
+            )
+            .pack()
+            .numpy()
+        )
+
+    def onnx_sample() -> np.ndarray:
+        return run_sampling_onnx(
+            onnx_denoiser,
+            body_model=None,
+            guidance_mode="off",
+            guidance_post=False,
+            guidance_inner=False,
+            Ts_world_cpf=Ts_world_cpf.numpy(),
+            floor_z=0.0,
+            hamer_detections=None,
+            aria_detections=None,
+            num_samples=num_samples,
+            ts=sampler.get_ts(),
+            guidance_verbose=False,
+            eta=sampler.eta,
+            window_size=plan.window_size,
+            overlap_size=plan.overlap_size,
+            windows_per_batch=plan.windows_per_batch,
+            initial_noise=initial_noise,
+            step_noise=step_noise,
+        )
+
+    def onnx_sample_without_torch() -> np.ndarray:
+        assert onnx_dir is not None
+        inputs_path = onnx_dir / "inputs.npz"
+        output_path = onnx_dir / "samples.npy"
+        np.savez(
+            inputs_path,
+            Ts_world_cpf=Ts_world_cpf.numpy(),
+            ts=sampler.get_ts(),
+            eta=sampler.eta,
+            window_size=plan.window_size,
+            overlap_size=plan.overlap_size,
+            initial_noise=initial_noise,
+            step_noise=step_noise,
+            num_threads=num_threads or 0,
+            windows_per_batch=plan.windows_per_batch or 0,
+        )
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                _SAMPLE_WITHOUT_TORCH,
+                str(onnx_dir),
+                str(inputs_path),
+                str(output_path),
+            ],
+            check=True,
+        )
+        return np.load(output_path)
+
+    step_diff = np.max(np.abs(onnx_step() - torch_step().numpy()))
+    start_time = time.perf_counter()
+    torch_samples = torch_sample()
+    torch_sample_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    onnx_samples = onnx_sample()
+    onnx_sample_time = time.perf_counter() - start_time
+    samples_diff = np.max(np.abs(onnx_samples - torch_samples))
+    without_torch_diff = np.max(np.abs(onnx_sample_without_torch() - onnx_samples))
+
+    torch_step_time = time_fn(torch_step, device, num_repeats)
+    onnx_step_time = time_fn(onnx_step, device, num_repeats)
+
+    print(f"export: {export_time:.1f} s")
+    print(f"max diff: step {step_diff:.2e}, samples {samples_diff:.2e}")
+    print(f"max diff without PyTorch: samples {without_torch_diff:.2e}")
+    print(f"{'backend':>8} {'step (ms)':>10} {'sample (s)':>11}")
+    print(f"{'torch':>8} {torch_step_time * 1000:>10.2f} {torch_sample_time:>11.2f}")
+    print(f"{'onnx':>8} {onnx_step_time * 1000:>10.2f} {onnx_sample_time:>11.2f}")
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,139 @@
+"""Compare denoiser inference precisions, and report accuracy against wall-clock time.
+
+Metrics are computed on the AMASS test split, using the same helpers as
+`5_eval_body_metrics.py`. Sequences are seeded by index, so every precision
+sees the same inputs and initial noise. We also report how far joint positions
+drift from the float32 outputs, which is a more sensitive check than the
+metrics themselves.
+
+Example:
+
+    python benchmarks/precision_accuracy_vs_speed.py \\
+        --dataset-hdf5-path ./data/egoalgo_no_skating_dataset.hdf5 \\
+        --dataset-files-path ./data/egoalgo_no_skating_dataset_files.txt \\
+        --device cpu --precisions float32 bfloat16
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import tyro
+
+from egoallo import fncsmpl
+from egoallo.data.amass import EgoAmassHdf5Dataset
+from egoallo.inference_utils import load_denoiser
+from egoallo.metrics_helpers import compute_body_metrics
+from egoallo.network import InferencePrecision
+from egoallo.sampling import SamplerConfig, run_sampling_with_stitching
+
+
+def main(
+    dataset_hdf5_path: Path,
+    dataset_files_path: Path,
+    precisions: tuple[InferencePrecision, ...] = ("float32", "bfloat16", "float16"),
+    subseq_len: int = 128,
+    max_sequences: int = 50,
+    num_samples: int = 1,
+    sampler: SamplerConfig = SamplerConfig(),
+    checkpoint_dir: Path = Path("./egoallo_checkpoint_april13/checkpoints_3000000/"),
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    device: str = "cpu",
+) -> None:
+    """Compare inference precisions on the AMASS test split. float32 is always
+    run first, as the reference."""
+    torch_device = torch.device(device)
+    denoiser_network = load_denoiser(checkpoint_dir).to(torch_device)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch_device)
+    dataset = EgoAmassHdf5Dataset(
+        dataset_hdf5_path,
+        dataset_files_path,
+        splits=("test",),
+        # We need an extra timestep in order to compute the relative CPF pose. (T_cpf_tm1_cpf_t)
+        subseq_len=subseq_len + 1,
+        cache_files=True,
+        slice_strategy="deterministic",
+        random_variable_len_proportion=0.0,
+    )
+    num_sequences = min(max_sequences, len(dataset))
+
+    reference_joints = list[torch.Tensor]()
+    rows = []
+    run_precisions: tuple[InferencePrecision, ...] = (
+        "float32",
+        *(p for p in precisions if p != "float32"),
+    )
+    for precision in run_precisions:
+        denoiser_network.inference_precision = precision
+        metrics = list[dict[str, np.ndarray]]()
+        runtimes = list[float]()
+        drifts = list[float]()
+        for i in range(num_sequences):
+            sequence = dataset[i].to(torch_device)
+            torch.manual_seed(i)
+
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+            start_time = time.perf_counter()
+            samples = run_sampling_with_stitching(
+                denoiser_network,
+                body_model=body_model,
+                guidance_mode="off",
+                guidance_inner=False,
+                guidance_post=False,
+                Ts_world_cpf=sequence.T_world_cpf,
+                hamer_detections=None,
+                aria_detections=None,
+                num_samples=num_samples,
+                floor_z=0.0,
+                device=torch_device,
+                guidance_verbose=False,
+                batch_windows=True,
+                sampler=sampler,
+            )
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+            runtimes.append(time.perf_counter() - start_time)
+            metrics.append(compute_body_metrics(body_model, sequence, samples))
+
+            # Joint positions relative to the root; `apply_to_body()` places
+            # the root at the origin.
+            joints = samples.apply_to_body(body_model).Ts_world_joint[..., 4:7]
+            if precision == "float32":
+                reference_joints.append(joints)
+            else:
+                drifts.append(
+                    torch.mean(
+                        torch.linalg.norm(joints - reference_joints[i], dim=-1)
+                    ).item()
+                    * 1000.0
+                )
+
+        rows.append(
+            (
+                precision,
+                {k: np.mean([m[k] for m in metrics]) for k in metrics[0].keys()},
+                # The first sequence includes warmup.
+                float(np.mean(runtimes[1:] or runtimes)),
+                float(np.mean(drifts)) if len(drifts) > 0 else 0.0,
+            )
+        )
+
+    print(
+        f"{'precision':>10} {'mpjpe':>9} {'pampjpe':>9} {'foot_skate':>11}"
+        f" {'T_head':>8} {'drift (mm)':>11} {'s/seq':>8} {'speedup':>8}"
+    )
+    for precision, mean_metrics, runtime, drift in rows:
+        print(
+            f"{precision:>10} {mean_metrics['mpjpe']:>9.3f}"
+            f" {mean_metrics['pampjpe']:>9.3f} {mean_metrics['foot_skate']:>11.3f}"
+            f" {mean_metrics['T_head']:>8.4f} {drift:>11.3f} {runtime:>8.3f}"
+            f" {rows[0][2] / runtime:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
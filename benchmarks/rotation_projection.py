@@ -0,0 +1,166 @@
+"""Check parity and latency of `project_to_so3()` against SVD-based projection.
+
+Inputs are batches of 3x3 matrices, as produced by `EgoDenoiseTraj.unpack()`
+for a `(num_samples, seq_len, 21)` set of body rotations. We check parity on:
+- `noisy`: rotations plus Gaussian noise, like denoiser outputs.
+- `gaussian`: i.i.d. Gaussian matrices, half of which have negative
+  determinants.
+- `unpack`: body rotations from `EgoDenoiseTraj.unpack(project_rotmats=True)`.
+- `fwd body` and `fwd hands`: body and hand rotations from a randomly
+  initialized `EgoDenoiser`, with `project_output_rotmats=True`.
+
+For parity, we report the max difference from the float64 SVD result, and the
+max gap in the objective `tr(R^T M)` that both methods maximize. The
+difference can be large for nearly degenerate matrices, where the closest
+rotation is ambiguous. The objective gap should always be small. The script
+fails if any output isn't a rotation, or if the objective gap is too large.
+
+Example:
+
+    python benchmarks/rotation_projection.py --device cpu --seq-lens 128 1000 10000
+"""
+
+from __future__ import annotations
+
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf, time_fn
+from jaxtyping import Float
+from torch import Tensor
+
+from egoallo.network import EgoDenoiseTraj, project_rotmats_via_svd, project_to_so3
+from egoallo.transforms import SE3, SO3
+
+
+def check_parity(
+    name: str,
+    rotmats: Float[Tensor, "*batch 3 3"],
+    projected: Float[Tensor, "*batch 3 3"],
+) -> None:
+    """Compare projected matrices against float64 SVD, print the results, and
+    fail if they aren't rotations or don't maximize the objective."""
+    rotmats = rotmats.to(torch.float64)
+    expected = project_rotmats_via_svd(rotmats)
+    projected = projected.to(torch.float64)
+    max_diff = torch.max(torch.abs(projected - expected)).item()
+    obj_gap = torch.max(
+        torch.sum((expected - projected) * rotmats, dim=(-2, -1))
+    ).item()
+    det = torch.linalg.det(projected)
+    print(
+        f"{name:>10} {max_diff:>10.2e} {obj_gap:>12.2e}"
+        f" {f'[{det.min().item():.6f}, {det.max().item():.6f}]':>22}"
+    )
+    assert torch.allclose(det, torch.ones_like(det), atol=1e-4)
+    assert torch.allclose(
+        projected.transpose(-1, -2) @ projected,
+        torch.eye(3, dtype=torch.float64, device=projected.device),
+        atol=1e-4,
+    )
+    assert obj_gap < 1e-3
+
+
+def main(
+    seq_lens: tuple[int, ...] = (128, 1000, 10000),
+    num_samples: int = 1,
+    num_parity_matrices: int = 1_000_000,
+    parity_seq_len: int = 32,
+    noise_std: float = 0.3,
+    num_repeats: int = 10,
+    device: str = "cpu",
+) -> None:
+    torch_device = torch.device(device)
+    generator = torch.Generator(device=torch_device).manual_seed(0)
+
+    # Parity.
+    inputs = {
+        "noisy": SO3.exp(
+            torch.randn(
+                (num_parity_matrices, 3), generator=generator, device=torch_device
+            )
+        ).as_matrix()
+        + noise_std
+        * torch.randn(
+            (num_parity_matrices, 3, 3), generator=generator, device=torch_device
+        ),
+        "gaussian": torch.randn(
+            (num_parity_matrices, 3, 3), generator=generator, device=torch_device
+        ),
+    }
+    print(f"{'input':>10} {'max diff':>10} {'max obj gap':>12} {'det range':>22}")
+    for name, rotmats in inputs.items():
+        check_parity(name, rotmats, project_to_so3(rotmats))
+
+    # Parity at the call sites.
+    denoiser = make_denoiser(None, torch_device)
+    include_hands = denoiser.config.include_hands
+    x_packed = torch.randn(
+        (num_samples, parity_seq_len, EgoDenoiseTraj.get_packed_dim(include_hands)),
+        generator=generator,
+        device=torch_device,
+    )
+    check_parity(
+        "unpack",
+        EgoDenoiseTraj.unpack(x_packed, include_hands=include_hands).body_rotmats,
+        EgoDenoiseTraj.unpack(
+            x_packed, include_hands=include_hands, project_rotmats=True
+        ).body_rotmats,
+    )
+
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(parity_seq_len + 1, torch_device)
+    T_cpf_tm1_cpf_t = (
+        SE3(Ts_world_cpf[:-1, :]).inverse() @ SE3(Ts_world_cpf[1:, :])
+    ).parameters()
+    with torch.no_grad():
+        outputs = {
+            project_output_rotmats: EgoDenoiseTraj.unpack(
+                denoiser.forward(
+                    x_packed,
+                    torch.full((num_samples,), 500, device=torch_device),
+                    T_world_cpf=Ts_world_cpf[None, 1:].expand(num_samples, -1, -1),
+                    T_cpf_tm1_cpf_t=T_cpf_tm1_cpf_t[None].expand(num_samples, -1, -1),
+                    project_output_rotmats=project_output_rotmats,
+                    hand_positions_wrt_cpf=None,
+                    mask=None,
+                ),
+                include_hands=include_hands,
+            )
+            for project_output_rotmats in (False, True)
+        }
+    assert torch.equal(outputs[False].betas, outputs[True].betas)
+    assert torch.equal(outputs[False].contacts, outputs[True].contacts)
+    check_parity(
+        "fwd body",
+        outputs[False].body_rotmats,
+        outputs[True].body_rotmats,
+    )
+    if include_hands:
+        hand_rotmats_svd = outputs[False].hand_rotmats
+        hand_rotmats_fast = outputs[True].hand_rotmats
+        assert hand_rotmats_svd is not None
+        assert hand_rotmats_fast is not None
+        check_parity("fwd hands", hand_rotmats_svd, hand_rotmats_fast)
+
+    # Latency.
+    print(
+        f"\n{'seq_len':>8} {'matrices':>10} {'svd (ms)':>10} {'fast (ms)':>10}"
+        f" {'speedup':>8}"
+    )
+    for seq_len in seq_lens:
+        rotmats = SO3.exp(
+            torch.randn((num_samples, seq_len, 21, 3), device=torch_device)
+        ).as_matrix() + noise_std * torch.randn(
+            (num_samples, seq_len, 21, 3, 3), device=torch_device
+        )
+        svd_time = time_fn(
+            lambda: project_rotmats_via_svd(rotmats), torch_device, num_repeats
+        )
+        fast_time = time_fn(lambda: project_to_so3(rotmats), torch_device, num_repeats)
+        print(
+            f"{seq_len:>8} {rotmats.shape[:-2].numel():>10} {svd_time * 1000:>10.2f}"
+            f" {fast_time * 1000:>10.2f} {svd_time / fast_time:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,132 @@
+"""Sweep diffusion samplers and step counts, and report accuracy against wall-clock time.
+
+Metrics are computed on the AMASS test split, using the same helpers as
+`5_eval_body_metrics.py`. The first row is always the original 30-step DDIM
+sampler, for reference. Sequences are seeded by index, so every sampler sees
+the same inputs.
+
+Example:
+
+    python benchmarks/sampler_accuracy_vs_speed.py \\
+        --dataset-hdf5-path ./data/egoalgo_no_skating_dataset.hdf5 \\
+        --dataset-files-path ./data/egoalgo_no_skating_dataset_files.txt \\
+        --methods ddim dpmpp_2m euler_ancestral --step-counts 5 10 20
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import torch
+import tyro
+
+from egoallo import fncsmpl
+from egoallo.data.amass import EgoAmassHdf5Dataset
+from egoallo.inference_utils import load_denoiser
+from egoallo.metrics_helpers import compute_body_metrics
+from egoallo.sampling import SamplerConfig, run_sampling_with_stitching
+
+
+def main(
+    dataset_hdf5_path: Path,
+    dataset_files_path: Path,
+    methods: tuple[Literal["ddim", "dpmpp_2m", "euler_ancestral"], ...] = (
+        "ddim",
+        "dpmpp_2m",
+        "euler_ancestral",
+    ),
+    step_counts: tuple[int, ...] = (5, 10, 20),
+    subseq_len: int = 128,
+    max_sequences: int = 50,
+    num_samples: int = 1,
+    guidance_post: bool = False,
+    batch_windows: bool = True,
+    checkpoint_dir: Path = Path("./egoallo_checkpoint_april13/checkpoints_3000000/"),
+    smplh_npz_path: Path = Path("./data/smplh/neutral/model.npz"),
+    device: str = "cuda",
+) -> None:
+    """Compare samplers on the AMASS test split.
+
+    Args:
+        guidance_post: Whether to run the post-sampling guidance optimizer.
+            This is off by default because it hides differences between samplers.
+    """
+    torch_device = torch.device(device)
+    denoiser_network = load_denoiser(checkpoint_dir).to(torch_device)
+    body_model = fncsmpl.SmplhModel.load(smplh_npz_path).to(torch_device)
+    dataset = EgoAmassHdf5Dataset(
+        dataset_hdf5_path,
+        dataset_files_path,
+        splits=("test",),
+        # We need an extra timestep in order to compute the relative CPF pose. (T_cpf_tm1_cpf_t)
+        subseq_len=subseq_len + 1,
+        cache_files=True,
+        slice_strategy="deterministic",
+        random_variable_len_proportion=0.0,
+    )
+    num_sequences = min(max_sequences, len(dataset))
+
+    configs = [SamplerConfig()] + [
+        SamplerConfig(method=method, num_steps=num_steps)
+        for method in methods
+        for num_steps in step_counts
+    ]
+
+    rows = []
+    for config in configs:
+        metrics = list[dict[str, np.ndarray]]()
+        runtimes = list[float]()
+        for i in range(num_sequences):
+            sequence = dataset[i].to(torch_device)
+            torch.manual_seed(i)
+
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+            start_time = time.perf_counter()
+            samples = run_sampling_with_stitching(
+                denoiser_network,
+                body_model=body_model,
+                guidance_mode="no_hands" if guidance_post else "off",
+                guidance_inner=False,
+                guidance_post=guidance_post,
+                Ts_world_cpf=sequence.T_world_cpf,
+                hamer_detections=None,
+                aria_detections=None,
+                num_samples=num_samples,
+                floor_z=0.0,
+                device=torch_device,
+                guidance_verbose=False,
+                batch_windows=batch_windows,
+                sampler=config,
+            )
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+            runtimes.append(time.perf_counter() - start_time)
+            metrics.append(compute_body_metrics(body_model, sequence, samples))
+
+        rows.append(
+            (
+                config.method,
+                len(config.get_ts()) - 1,
+                {k: np.mean([m[k] for m in metrics]) for k in metrics[0].keys()},
+                float(np.mean(runtimes)),
+            )
+        )
+
+    print(
+        f"{'method':>16} {'steps':>6} {'mpjpe':>9} {'pampjpe':>9}"
+        f" {'foot_skate':>11} {'T_head':>8} {'s/seq':>8}"
+    )
+    for method, num_steps, mean_metrics, runtime in rows:
+        print(
+            f"{method:>16} {num_steps:>6} {mean_metrics['mpjpe']:>9.3f}"
+            f" {mean_metrics['pampjpe']:>9.3f} {mean_metrics['foot_skate']:>11.3f}"
+            f" {mean_metrics['T_head']:>8.4f} {runtime:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
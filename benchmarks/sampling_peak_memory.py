@@ -0,0 +1,75 @@
+"""Benchmark peak GPU memory of sampling, with and without per-step history.
+
+Modes:
+- `current`: default sampling, which only keeps the current noisy state.
+- `history_gpu`: keeps every intermediate state on the GPU. This is what
+  sampling used to do.
+- `history_cpu`: strided history moved to the CPU via `TrajectoryHistory`.
+
+Example:
+
+    python benchmarks/sampling_peak_memory.py --seq-lens 128 1024 4096 --num-samples 4
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable
+
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf
+
+from egoallo import network
+from egoallo.sampling import TrajectoryHistory, run_sampling_with_stitching
+
+
+def main(
+    seq_lens: tuple[int, ...] = (128, 1024, 4096),
+    num_samples: int = 4,
+    history_stride: int = 10,
+    batch_windows: bool = True,
+    device: str = "cuda",
+    checkpoint_dir: Path | None = None,
+) -> None:
+    torch_device = torch.device(device)
+    assert torch_device.type == "cuda", "Peak memory is measured with CUDA stats."
+    denoiser_network = make_denoiser(checkpoint_dir, torch_device)
+
+    print(f"{'seq_len':>8} {'mode':>12} {'peak (MB)':>10}")
+    for seq_len in seq_lens:
+        Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len + 1, torch_device)
+        gpu_history = list[network.EgoDenoiseTraj]()
+        step_callbacks: dict[
+            str, Callable[[int, network.EgoDenoiseTraj], None] | None
+        ] = {
+            "current": None,
+            "history_gpu": lambda i, traj: gpu_history.append(traj),
+            "history_cpu": TrajectoryHistory(stride=history_stride),
+        }
+        for mode, step_callback in step_callbacks.items():
+            gpu_history.clear()
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(torch_device)
+            baseline = torch.cuda.memory_allocated(torch_device)
+            run_sampling_with_stitching(
+                denoiser_network,
+                body_model=None,  # type: ignore
+                guidance_mode="off",
+                guidance_post=False,
+                guidance_inner=False,
+                Ts_world_cpf=Ts_world_cpf,
+                floor_z=0.0,
+                hamer_detections=None,
+                aria_detections=None,
+                num_samples=num_samples,
+                device=torch_device,
+                batch_windows=batch_windows,
+                step_callback=step_callback,
+            )
+            peak = torch.cuda.max_memory_allocated(torch_device) - baseline
+            print(f"{seq_len:>8} {mode:>12} {peak / 1024**2:>10.1f}")
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
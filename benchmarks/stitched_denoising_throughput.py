@@ -0,0 +1,73 @@
+"""Benchmark a single stitched denoising step, with and without window batching.
+
+Example:
+
+    python benchmarks/stitched_denoising_throughput.py --seq-lens 256 1024 4096
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf, time_fn
+
+from egoallo.sampling import StitchedWindows, denoise_with_stitching
+from egoallo.transforms import SE3
+
+
+def main(
+    seq_lens: tuple[int, ...] = (128, 512, 2048, 8192),
+    num_samples: int = 1,
+    device: str = "cpu",
+    num_repeats: int = 3,
+    checkpoint_dir: Path | None = None,
+) -> None:
+    torch_device = torch.device(device)
+    denoiser_network = make_denoiser(checkpoint_dir, torch_device)
+
+    print(
+        f"{'seq_len':>8} {'windows':>8} {'looped (s/step)':>16} {'batched (s/step)':>17}"
+        f" {'speedup':>8} {'batched frames/s':>17} {'max abs diff':>13}"
+    )
+    for seq_len in seq_lens:
+        Ts_world_cpf = make_synthetic_Ts_world_cpf(seq_len + 1, torch_device)
+        windows = StitchedWindows.make(
+            denoiser_network,
+            (SE3(Ts_world_cpf[:-1, :]).inverse() @ SE3(Ts_world_cpf[1:, :])).wxyz_xyz,
+            T_world_cpf=Ts_world_cpf[1:, :],
+            window_size=128,
+            overlap_size=32,
+        )
+        x_t_packed = torch.randn(
+            (num_samples, seq_len, denoiser_network.get_d_state()),
+            device=torch_device,
+        )
+
+        outputs: dict[bool, torch.Tensor] = {}
+        timings: dict[bool, float] = {}
+        for batch_windows in (False, True):
+
+            def step() -> None:
+                with torch.inference_mode():
+                    outputs[batch_windows] = denoise_with_stitching(
+                        denoiser_network,
+                        x_t_packed,
+                        t=500,
+                        windows=windows,
+                        windows_per_batch=None if batch_windows else 1,
+                    )
+
+            timings[batch_windows] = time_fn(step, torch_device, num_repeats)
+
+        max_diff = torch.max(torch.abs(outputs[True] - outputs[False])).item()
+        print(
+            f"{seq_len:>8} {len(windows.starts):>8} {timings[False]:>16.4f}"
+            f" {timings[True]:>17.4f} {timings[False] / timings[True]:>7.2f}x"
+            f" {seq_len * num_samples / timings[True]:>17.1f} {max_diff:>13.2e}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,83 @@
+"""Benchmark latency and memory for streaming inference.
+
+CPF poses are pushed to a `StreamingSampler` in chunks, as they would arrive
+from a live 30 FPS session. For each emitted frame, we report latency as the
+time between the frame arriving and it being emitted, assuming that pushes
+can keep up with real time.
+
+Example:
+
+    python benchmarks/streaming_latency.py --num-frames 1000 --chunk-size 1 30
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import tyro
+from bench_utils import make_denoiser, make_synthetic_Ts_world_cpf
+
+from egoallo.sampling import SamplerConfig
+from egoallo.streaming import StreamingSampler
+
+
+def main(
+    num_frames: int = 1000,
+    chunk_size: tuple[int, ...] = (1, 30),
+    num_samples: int = 1,
+    fps: float = 30.0,
+    sampler: SamplerConfig = SamplerConfig(),
+    device: str = "cpu",
+    checkpoint_dir: Path | None = None,
+) -> None:
+    torch_device = torch.device(device)
+    denoiser_network = make_denoiser(checkpoint_dir, torch_device)
+    Ts_world_cpf = make_synthetic_Ts_world_cpf(num_frames + 1, torch_device)
+
+    print(
+        f"{'chunk':>6} {'push (s, max)':>14} {'latency (s, mean)':>18}"
+        f" {'latency (s, max)':>17} {'max buffered':>13}"
+    )
+    for chunk in chunk_size:
+        streaming_sampler = StreamingSampler(
+            denoiser_network,
+            body_model=None,  # type: ignore
+            guidance_mode="off",
+            guidance_post=False,
+            guidance_inner=False,
+            floor_z=0.0,
+            num_samples=num_samples,
+            device=torch_device,
+            sampler=sampler,
+        )
+        push_times = list[float]()
+        latencies = list[float]()
+        max_buffered = 0
+        for start in range(0, num_frames + 1, chunk):
+            start_time = time.perf_counter()
+            streaming_sampler.push(Ts_world_cpf[start : start + chunk])
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+            push_times.append(time.perf_counter() - start_time)
+            max_buffered = max(max_buffered, streaming_sampler._Ts_world_cpf.shape[0])
+
+            # Output frame `i` arrives with pose `i + 1`.
+            arrived = min(start + chunk, num_frames + 1) - 1
+            newly_emitted = streaming_sampler.num_frames_emitted - len(latencies)
+            latencies.extend(
+                (arrived - i) / fps + push_times[-1]
+                for i in range(len(latencies), len(latencies) + newly_emitted)
+            )
+        streaming_sampler.flush()
+
+        print(
+            f"{chunk:>6} {max(push_times):>14.3f} {np.mean(latencies):>18.3f}"
+            f" {np.max(latencies):>17.3f} {max_buffered:>13}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
@@ -0,0 +1,163 @@
+"""Compare peak memory and throughput of training with activation checkpointing
+and gradient accumulation.
+
+Each setting runs optimizer steps on the same effective batch, split into
+`gradient_accumulation_steps` micro-batches, like `1_train_motion_prior.py`.
+For each setting, we report:
+- Peak GPU memory during a training step.
+- Training throughput, in sequences per second.
+- Max gradient difference from the same setting without activation
+  checkpointing. This should be ~0.
+
+Inputs are synthetic, so losses aren't meaningful.
+
+Example:
+
+    python benchmarks/training_memory.py --batch-size 256 --subseq-len 128 \\
+        --gradient-accumulation-steps 1 4
+"""
+
+from __future__ import annotations
+
+import torch
+import tyro
+from bench_utils import make_synthetic_Ts_world_cpf, time_fn
+from torch import Tensor
+
+from egoallo import network, training_loss
+from egoallo.data.dataclass import EgoTrainingData
+from egoallo.transforms import SE3, SO3
+
+
+def make_synthetic_train_batch(
+    batch: int, subseq_len: int, device: torch.device
+) -> EgoTrainingData:
+    """Make a batch of training data with random poses along walking-like
+    head trajectories."""
+    generator = torch.Generator().manual_seed(0)
+    Ts_world_cpf = torch.stack(
+        [
+            make_synthetic_Ts_world_cpf(subseq_len + 1, torch.device("cpu"), seed=i)
+            for i in range(batch)
+        ]
+    )
+
+    def random_quats(num_joints: int) -> Tensor:
+        return SO3.exp(
+            torch.randn((batch, subseq_len, num_joints, 3), generator=generator) * 0.3
+        ).wxyz
+
+    return EgoTrainingData(
+        T_world_root=Ts_world_cpf[:, 1:],
+        contacts=(torch.rand((batch, subseq_len, 21), generator=generator) > 0.5).to(
+            torch.float32
+        ),
+        betas=torch.randn((batch, 1, 16), generator=generator),
+        body_quats=random_quats(21),
+        T_cpf_tm1_cpf_t=(
+            SE3(Ts_world_cpf[:, :-1]).inverse() @ SE3(Ts_world_cpf[:, 1:])
+        ).wxyz_xyz,
+        T_world_cpf=Ts_world_cpf[:, 1:],
+        height_from_floor=torch.ones((batch, subseq_len, 1)),
+        joints_wrt_cpf=torch.randn((batch, subseq_len, 21, 3), generator=generator),
+        mask=torch.ones((batch, subseq_len), dtype=torch.bool),
+        hand_quats=random_quats(30),
+    ).to(device)
+
+
+def main(
+    batch_size: int = 64,
+    subseq_len: int = 128,
+    gradient_accumulation_steps: tuple[int, ...] = (1, 4),
+    num_repeats: int = 3,
+    device: str = "cuda",
+) -> None:
+    torch_device = torch.device(device)
+    config = network.EgoDenoiserConfig()
+    loss_helper = training_loss.TrainingLossComputer(
+        training_loss.TrainingLossConfig(), device=torch_device
+    )
+    train_batch = make_synthetic_train_batch(batch_size, subseq_len, torch_device)
+
+    torch.manual_seed(0)
+    init_state_dict = network.EgoDenoiser(config).state_dict()
+
+    rows = []
+    for accumulation_steps in gradient_accumulation_steps:
+        assert batch_size % accumulation_steps == 0
+        micro_batches = [
+            train_batch.map(lambda x: torch.chunk(x, accumulation_steps)[i])
+            for i in range(accumulation_steps)
+        ]
+        grads: dict[bool, list[Tensor]] = {}
+        for activation_checkpointing in (False, True):
+            model = network.EgoDenoiser(config).to(torch_device).train()
+            model.load_state_dict(init_state_dict)
+            model.activation_checkpointing = activation_checkpointing
+            optim = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+            def train_step() -> None:
+                for micro_batch in micro_batches:
+                    loss, _ = loss_helper.compute_denoising_loss(
+                        model, unwrapped_model=model, train_batch=micro_batch
+                    )
+                    (loss / accumulation_steps).backward()
+                optim.step()
+                optim.zero_grad(set_to_none=False)
+
+            # Gradients for the first step, from the same seed.
+            torch.manual_seed(0)
+            for micro_batch in micro_batches:
+                loss, _ = loss_helper.compute_denoising_loss(
+                    model, unwrapped_model=model, train_batch=micro_batch
+                )
+                (loss / accumulation_steps).backward()
+            grads[activation_checkpointing] = [
+                p.grad.clone() for p in model.parameters() if p.grad is not None
+            ]
+            optim.zero_grad(set_to_none=False)
+
+            peak_mb = None
+            if torch_device.type == "cuda":
+                torch.cuda.synchronize(torch_device)
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(torch_device)
+                baseline = torch.cuda.memory_allocated(torch_device)
+                train_step()
+                torch.cuda.synchronize(torch_device)
+                peak = torch.cuda.max_memory_allocated(torch_device) - baseline
+                peak_mb = peak / 1024**2
+            step_time = time_fn(train_step, torch_device, num_repeats)
+            rows.append(
+                (
+                    activation_checkpointing,
+                    accumulation_steps,
+                    peak_mb,
+                    batch_size / step_time,
+                )
+            )
+            del model, optim
+
+        grad_diff = max(
+            torch.max(torch.abs(a - b)).item()
+            for a, b in zip(grads[False], grads[True])
+        )
+        print(
+            f"accumulation steps {accumulation_steps}: max grad diff from"
+            f" checkpointing {grad_diff:.2e}"
+        )
+
+    print(
+        f"\n{'checkpointing':>14} {'accum steps':>12} {'micro-batch':>12}"
+        f" {'peak (MB)':>10} {'seqs/sec':>9}"
+    )
+    for activation_checkpointing, accumulation_steps, peak_mb, seqs_per_sec in rows:
+        peak = f"{peak_mb:>10.1f}" if peak_mb is not None else f"{'-':>10}"
+        print(
+            f"{str(activation_checkpointing):>14} {accumulation_steps:>12}"
+            f" {batch_size // accumulation_steps:>12} {peak} {seqs_per_sec:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(main)
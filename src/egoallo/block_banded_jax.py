@@ -0,0 +1,134 @@
+"""Direct solvers for block-banded linear systems, implemented in JAX.
+
+These are used for the normal equations of guidance optimization, where
+variables are only coupled across nearby timesteps. Cost is linear in the
+number of blocks."""
+
+from __future__ import annotations
+
+import jax
+import jax.scipy.linalg
+from jax import Array
+from jax import numpy as jnp
+from jaxtyping import Float
+
+
+def solve_block_tridiagonal(
+    diag: Float[Array, "n d d"],
+    upper: Float[Array, "n-1 d d"],
+    rhs: Float[Array, "n d"],
+) -> Float[Array, "n d"]:
+    """Solve a symmetric positive-definite block-tridiagonal system, with a
+    block Cholesky factorization.
+
+    `diag[i]` is block `(i, i)` of the matrix, and `upper[i]` is block
+    `(i, i + 1)`. Blocks below the diagonal are the transposes of `upper`."""
+    (n, d, _) = diag.shape
+    assert diag.shape == (n, d, d)
+    assert upper.shape == (n - 1, d, d)
+    assert rhs.shape == (n, d)
+
+    def factor_and_forward(
+        carry: tuple[Array, Array], inputs: tuple[Array, Array, Array]
+    ) -> tuple[tuple[Array, Array], tuple[Array, Array, Array]]:
+        # W_prev = L_prev^{-1} @ upper_prev, where L_prev is the Cholesky
+        # factor of the previous (Schur-complemented) diagonal block.
+        W_prev, y_prev = carry
+        diag_i, upper_i, rhs_i = inputs
+        L = jnp.linalg.cholesky(diag_i - W_prev.T @ W_prev)
+        y = jax.scipy.linalg.solve_triangular(L, rhs_i - W_prev.T @ y_prev, lower=True)
+        W = jax.scipy.linalg.solve_triangular(L, upper_i, lower=True)
+        return (W, y), (L, W, y)
+
+    _, (L, W, y) = jax.lax.scan(
+        factor_and_forward,
+        init=(jnp.zeros((d, d), diag.dtype), jnp.zeros((d,), diag.dtype)),
+        xs=(diag, jnp.concatenate([upper, jnp.zeros((1, d, d), upper.dtype)]), rhs),
+    )
+
+    def backward(
+        x_next: Array, inputs: tuple[Array, Array, Array]
+    ) -> tuple[Array, Array]:
+        L_i, W_i, y_i = inputs
+        x = jax.scipy.linalg.solve_triangular(
+            L_i, y_i - W_i @ x_next, lower=True, trans="T"
+        )
+        return x, x
+
+    _, x = jax.lax.scan(
+        backward, init=jnp.zeros((d,), diag.dtype), xs=(L, W, y), reverse=True
+    )
+    assert x.shape == (n, d)
+    return x
+
+
+def solve_block_banded(
+    band: Float[Array, "n bandwidth+1 d d"],
+    rhs: Float[Array, "n d"],
+) -> Float[Array, "n d"]:
+    """Solve a symmetric positive-definite block-banded system.
+
+    `band[i, j]` is block `(i, i + j)` of the matrix; entries for blocks
+    outside of the matrix are ignored. Blocks below the diagonal are the
+    transposes of those above it. We group every `bandwidth` blocks into one,
+    which makes the matrix block-tridiagonal."""
+    (n, bandwidth_plus_one, d, _) = band.shape
+    bandwidth = bandwidth_plus_one - 1
+    assert bandwidth >= 1
+    assert rhs.shape == (n, d)
+
+    # Zero out blocks that go past the end of the matrix.
+    in_bounds = jnp.arange(n)[:, None] + jnp.arange(bandwidth + 1)[None, :] < n
+    band = jnp.where(in_bounds[:, :, None, None], band, 0.0)
+
+    # Pad to a multiple of the bandwidth. Padded diagonal blocks are identity,
+    # with zeros on the right-hand side, so their solutions are zero.
+    num_padded = -n % bandwidth
+    band = jnp.concatenate(
+        [
+            band,
+            jnp.zeros((num_padded, bandwidth + 1, d, d), band.dtype)
+            .at[:, 0]
+            .set(jnp.eye(d, dtype=band.dtype)),
+        ]
+    )
+    rhs = jnp.concatenate([rhs, jnp.zeros((num_padded, d), rhs.dtype)])
+    num_groups = (n + num_padded) // bandwidth
+    band = band.reshape((num_groups, bandwidth, bandwidth + 1, d, d))
+
+    # Assemble grouped blocks from their (a, b) sub-blocks. Grouped diagonal
+    # blocks are symmetric. In grouped upper blocks, sub-blocks with b > a are
+    # more than `bandwidth` blocks from the diagonal, so they're zero.
+    zeros = jnp.zeros((num_groups, d, d), band.dtype)
+    diag = jnp.concatenate(
+        [
+            jnp.concatenate(
+                [
+                    band[:, a, b - a]
+                    if b >= a
+                    else jnp.swapaxes(band[:, b, a - b], -1, -2)
+                    for b in range(bandwidth)
+                ],
+                axis=-1,
+            )
+            for a in range(bandwidth)
+        ],
+        axis=-2,
+    )
+    upper = jnp.concatenate(
+        [
+            jnp.concatenate(
+                [
+                    band[:-1, a, bandwidth + b - a] if b <= a else zeros[:-1]
+                    for b in range(bandwidth)
+                ],
+                axis=-1,
+            )
+            for a in range(bandwidth)
+        ],
+        axis=-2,
+    )
+    x = solve_block_tridiagonal(
+        diag, upper, rhs.reshape((num_groups, bandwidth * d))
+    ).reshape((num_groups * bandwidth, d))
+    return x[:n]
@@ -0,0 +1,192 @@
+"""Denoiser forward passes compiled for a static window shape.
+
+Eager `EgoDenoiser.forward()` does a lot of Python-level work on every call:
+unpacking the noisy trajectory, looping over modality encoders and decoders,
+and building attention masks. During sampling, we call it with the same
+shapes over and over, so we can instead compile or export it once.
+"""
+
+from __future__ import annotations
+
+from typing import Literal
+
+import torch
+from jaxtyping import Bool, Float, Int
+from torch import Tensor, nn
+
+from . import network
+
+
+class _WindowForward(nn.Module):
+    """`EgoDenoiser.forward()`, restricted to the arguments used for sampling."""
+
+    def __init__(self, denoiser: network.EgoDenoiser) -> None:
+        super().__init__()
+        self.denoiser = denoiser
+
+    def forward(
+        self,
+        x_t_packed: Float[Tensor, "batch window d_state"],
+        t: Int[Tensor, "batch"],
+        cond_latent: Float[Tensor, "batch window d_latent"],
+        mask: Bool[Tensor, "batch window"],
+    ) -> Float[Tensor, "batch window d_state"]:
+        return self.denoiser.forward(
+            x_t_packed,
+            t,
+            T_world_cpf=None,
+            T_cpf_tm1_cpf_t=None,
+            project_output_rotmats=False,
+            hand_positions_wrt_cpf=None,
+            mask=mask,
+            cond_latent=cond_latent,
+        )
+
+
+class StaticShapeDenoiser(nn.Module):
+    """Wraps an `EgoDenoiser` so that sampling always runs it with inputs of
+    shape `(batch_size, window_size)`. This lets us compile the forward pass
+    once, with no recompilation or shape guards.
+
+    Inputs are padded up to the static shape: padded timesteps are masked
+    out, and padded batch entries are discarded. Larger batches are split
+    into chunks of `batch_size`. Set `batch_size` to the number of
+    (sample, window) pairs in each forward pass to avoid wasted padding; see
+    `StitchingPlan.get_forward_batch_size()`.
+
+    Two backends are supported:
+    - `compile`: `torch.compile()` with `dynamic=False`.
+    - `export`: `torch.export.export()`, which traces a graph ahead of time.
+
+    Only `forward()` with a precomputed `cond_latent` is compiled, since this
+    is how it's called during sampling. Anything else, including
+    `forward_decoder()` for `cache_encoder=True`, falls back to the eager
+    model.
+
+    Can be passed in place of an `EgoDenoiser` to `run_sampling_with_stitching()`.
+    """
+
+    def __init__(
+        self,
+        denoiser: network.EgoDenoiser,
+        batch_size: int,
+        window_size: int = 128,
+        backend: Literal["compile", "export"] = "compile",
+    ) -> None:
+        super().__init__()
+        self.denoiser = denoiser.eval()
+        self.batch_size = batch_size
+        self.window_size = window_size
+        self.backend: Literal["compile", "export"] = backend
+        self.config = denoiser.config
+
+        window_forward = _WindowForward(self.denoiser)
+        if backend == "compile":
+            self._compiled = torch.compile(window_forward, dynamic=False)
+        elif backend == "export":
+            device = next(denoiser.parameters()).device
+            with torch.no_grad():
+                self._compiled = torch.export.export(
+                    window_forward,
+                    (
+                        torch.zeros(
+                            (batch_size, window_size, denoiser.get_d_state()),
+                            device=device,
+                        ),
+                        torch.ones((batch_size,), dtype=torch.int64, device=device),
+                        torch.zeros(
+                            (batch_size, window_size, denoiser.config.d_latent),
+                            device=device,
+                        ),
+                        torch.ones(
+                            (batch_size, window_size), dtype=torch.bool, device=device
+                        ),
+                    ),
+                ).module()
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+
+    @property
+    def inference_precision(self) -> network.InferencePrecision:
+        return self.denoiser.inference_precision
+
+    def get_d_state(self) -> int:
+        return self.denoiser.get_d_state()
+
+    def encode_cond(self, **kwargs) -> Float[Tensor, "batch time d_latent"]:
+        return self.denoiser.encode_cond(**kwargs)
+
+    def precompute_decoder_cache(
+        self, *args, **kwargs
+    ) -> network.EgoDenoiserDecoderCache:
+        return self.denoiser.precompute_decoder_cache(*args, **kwargs)
+
+    def forward_decoder(self, *args, **kwargs) -> Tensor:
+        return self.denoiser.forward_decoder(*args, **kwargs)
+
+    def forward(
+        self,
+        x_t_packed: Float[Tensor, "batch time state_dim"],
+        t: Float[Tensor, "batch"],
+        *,
+        T_world_cpf: Float[Tensor, "batch time 7"] | None,
+        T_cpf_tm1_cpf_t: Float[Tensor, "batch time 7"] | None,
+        project_output_rotmats: bool,
+        hand_positions_wrt_cpf: Float[Tensor, "batch time 6"] | None,
+        mask: Bool[Tensor, "batch time"] | None,
+        cond_dropout_keep_mask: Bool[Tensor, "batch"] | None = None,
+        cond_latent: Float[Tensor, "batch time d_latent"] | None = None,
+    ) -> Float[Tensor, "batch time state_dim"]:
+        """Same as `EgoDenoiser.forward()`."""
+        (batch, time, d_state) = x_t_packed.shape
+        if (
+            cond_latent is None
+            or project_output_rotmats
+            or cond_dropout_keep_mask is not None
+            or time > self.window_size
+        ):
+            return self.denoiser.forward(
+                x_t_packed,
+                t,
+                T_world_cpf=T_world_cpf,
+                T_cpf_tm1_cpf_t=T_cpf_tm1_cpf_t,
+                project_output_rotmats=project_output_rotmats,
+                hand_positions_wrt_cpf=hand_positions_wrt_cpf,
+                mask=mask,
+                cond_dropout_keep_mask=cond_dropout_keep_mask,
+                cond_latent=cond_latent,
+            )
+
+        # Pad the time axis, and mask out padding.
+        pad_time = self.window_size - time
+        x_t_packed = nn.functional.pad(x_t_packed, (0, 0, 0, pad_time))
+        cond_latent = nn.functional.pad(cond_latent, (0, 0, 0, pad_time))
+        if mask is None:
+            mask = x_t_packed.new_ones((batch, time), dtype=torch.bool)
+        mask = nn.functional.pad(mask, (0, pad_time), value=False)
+        t = t.to(torch.int64)
+
+        outputs = list[Tensor]()
+        for start in range(0, batch, self.batch_size):
+            end = min(start + self.batch_size, batch)
+            # Padded batch entries copy the first entry in the chunk, which
+            # is guaranteed to be valid.
+            chunk_indices = torch.cat(
+                [
+                    torch.arange(start, end, device=x_t_packed.device),
+                    x_t_packed.new_full(
+                        (self.batch_size - (end - start),), start, dtype=torch.int64
+                    ),
+                ]
+            )
+            outputs.append(
+                self._compiled(
+                    x_t_packed[chunk_indices],
+                    t[chunk_indices],
+                    cond_latent[chunk_indices],
+                    mask[chunk_indices],
+                )[: end - start]
+            )
+        out = torch.cat(outputs, dim=0)[:, :time, :]
+        assert out.shape == (batch, time, d_state)
+        return out
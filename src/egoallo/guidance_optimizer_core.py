@@ -0,0 +1,1779 @@
+"""Guidance optimization with Levenberg-Marquardt, using only JAX and NumPy.
+
+This doesn't import PyTorch, so it can be used by `onnx_sampling` on workers
+without it. Entry points that take PyTorch inputs are in
+`guidance_optimizer_jax`.
+"""
+
+from __future__ import annotations
+
+import os
+
+# Need to play nice with PyTorch!
+os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
+
+import dataclasses
+import itertools
+import time
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Literal, Sequence, Unpack, assert_never
+
+import jax
+import jax_dataclasses as jdc
+import jaxlie
+import jaxls
+import numpy as onp
+from jax import numpy as jnp
+from jax.typing import ArrayLike
+from jaxtyping import Float, Int
+
+from . import fncsmpl_jax
+from .block_banded_jax import solve_block_banded
+
+
+def do_guidance_optimization_numpy(
+    Ts_world_cpf: Float[onp.ndarray, "time 7"],
+    betas: Float[onp.ndarray, "samples time 16"],
+    body_rotmats: Float[onp.ndarray, "samples time 21 3 3"],
+    hand_rotmats: Float[onp.ndarray, "samples time 30 3 3"],
+    contacts: Float[onp.ndarray, "samples time 21"],
+    body: fncsmpl_jax.SmplhModel,
+    guidance_mode: GuidanceMode,
+    phase: Literal["inner", "post"],
+    hamer_detections: None | dict,
+    aria_detections: None | dict,
+    verbose: bool,
+    bucket_shapes: bool = True,
+    guidance_params: JaxGuidanceParams | None = None,
+) -> tuple[Float[onp.ndarray, "samples time 51 4"], dict]:
+    """Same as `guidance_optimizer_jax.do_guidance_optimization()`, but with
+    NumPy inputs and outputs; no PyTorch tensors are involved. Hand detections
+    should be nested dictionaries, as returned by `as_nested_dict(numpy=True)`.
+
+    Returns optimized local joint rotations as wxyz quaternions, with the 21
+    body joints followed by the 30 hand joints."""
+    quats, debug_info = do_guidance_optimization_jax(
+        Ts_world_cpf=jnp.asarray(Ts_world_cpf),
+        betas=jnp.asarray(betas),
+        body_rotmats=jnp.asarray(body_rotmats),
+        hand_rotmats=jnp.asarray(hand_rotmats),
+        contacts=jnp.asarray(contacts),
+        body=body,
+        guidance_mode=guidance_mode,
+        phase=phase,
+        hamer_detections=hamer_detections,
+        aria_detections=aria_detections,
+        verbose=verbose,
+        bucket_shapes=bucket_shapes,
+        guidance_params=guidance_params,
+    )
+    return onp.array(quats), debug_info
+
+
+def do_guidance_optimization_jax(
+    Ts_world_cpf: Float[jax.Array, "time 7"],
+    betas: Float[jax.Array, "samples time 16"],
+    body_rotmats: Float[jax.Array, "samples time 21 3 3"],
+    hand_rotmats: Float[jax.Array, "samples time 30 3 3"],
+    contacts: Float[jax.Array, "samples time 21"],
+    body: fncsmpl_jax.SmplhModel,
+    guidance_mode: GuidanceMode,
+    phase: Literal["inner", "post"],
+    hamer_detections: None | dict,
+    aria_detections: None | dict,
+    verbose: bool,
+    bucket_shapes: bool,
+    guidance_params: JaxGuidanceParams | None = None,
+    warm_quats: Float[jax.Array, "samples time 51 4"] | None = None,
+    warm_lambdas: Float[ArrayLike, "samples"] | None = None,
+) -> tuple[Float[jax.Array, "samples time 51 4"], dict]:
+    """Shared implementation for guidance entrypoints, with JAX inputs and
+    outputs. `warm_quats` and `warm_lambdas` are a previous solution and
+    Levenberg-Marquardt damping per sample, to warm-start from; see
+    `guidance_optimizer_jax.GuidanceSession`."""
+    if guidance_params is None:
+        guidance_params = JaxGuidanceParams.defaults(guidance_mode, phase)
+
+    # Pad to shape buckets by repeating the last sample and timestep. Padded
+    # timesteps are masked out of the optimization; see `_optimize()`.
+    (num_samples, timesteps) = body_rotmats.shape[:2]
+    if bucket_shapes:
+        padded_samples = get_guidance_bucket_num_samples(num_samples)
+        padded_timesteps = get_guidance_bucket_length(timesteps)
+    else:
+        padded_samples = num_samples
+        padded_timesteps = timesteps
+
+    def pad(x: jax.Array, has_sample_axis: bool = True) -> jax.Array:
+        pad_width = [(0, padded_samples - num_samples)] if has_sample_axis else []
+        pad_width.append((0, padded_timesteps - timesteps))
+        pad_width += [(0, 0)] * (x.ndim - len(pad_width))
+        if all(after == 0 for _, after in pad_width):
+            return x
+        return jnp.pad(x, pad_width, mode="edge")
+
+    optimize = _optimize_vmapped
+    if (
+        guidance_params.chunk_size is not None
+        and padded_timesteps > guidance_params.chunk_size
+    ):
+        # Detections are padded to the same count for every chunk and seam
+        # window, which is part of the compiled shape.
+        chunk_starts, seam_starts = _get_chunk_and_seam_starts(
+            padded_timesteps, guidance_params
+        )
+        max_chunk_detections, max_seam_detections = (
+            _count_max_window_detections(
+                (hamer_detections, aria_detections), starts, window_size
+            )
+            for starts, window_size in (
+                (chunk_starts, guidance_params.chunk_size),
+                (seam_starts, 2 * guidance_params.chunk_overlap),
+            )
+        )
+        if bucket_shapes:
+            max_chunk_detections = 1 << (max_chunk_detections - 1).bit_length()
+            max_seam_detections = 1 << (max_seam_detections - 1).bit_length()
+        optimize = partial(
+            _optimize_chunked_vmapped,
+            max_chunk_detections=max_chunk_detections,
+            max_seam_detections=max_seam_detections,
+        )
+
+    start_time = time.time()
+    quats, debug_info = optimize(
+        body=body,
+        Ts_world_cpf=pad(Ts_world_cpf, has_sample_axis=False),
+        betas=pad(betas),
+        body_rotmats=pad(body_rotmats),
+        hand_rotmats=pad(hand_rotmats),
+        contacts=pad(contacts),
+        num_valid_timesteps=jnp.array(timesteps, dtype=jnp.int32),
+        guidance_params=guidance_params,
+        hamer_detections=hamer_detections,
+        aria_detections=aria_detections,
+        verbose=verbose,
+        warm_quats=None if warm_quats is None else pad(warm_quats),
+        warm_lambdas=None
+        if warm_lambdas is None
+        else jnp.pad(warm_lambdas, (0, padded_samples - num_samples), mode="edge"),
+    )
+    quats = quats[:num_samples, :timesteps].block_until_ready()
+    debug_info = jax.tree.map(lambda x: x[:num_samples], debug_info)
+
+    print(f"Constraint optimization finished in {time.time() - start_time}sec")
+    return quats, debug_info
+
+
+def get_guidance_bucket_length(timesteps: int) -> int:
+    """Round a sequence length up to the length that guidance is compiled for.
+
+    Buckets are spaced a quarter octave apart, so padding adds less than 25%
+    to the sequence length. Sequences of up to 32 timesteps share a bucket."""
+    if timesteps <= 32:
+        return 32
+    # For lengths in [2^k, 2^(k+1)), round up to a multiple of 2^(k-2).
+    step = 1 << (timesteps.bit_length() - 3)
+    return -(-timesteps // step) * step
+
+
+def get_guidance_bucket_num_samples(num_samples: int) -> int:
+    """Round a sample count up to the count that guidance is compiled for,
+    which is the next power of two."""
+    return 1 << (num_samples - 1).bit_length()
+
+
+def enable_compilation_cache(cache_dir: Path) -> None:
+    """Use JAX's persistent compilation cache, so compiled guidance optimizers
+    are saved to `cache_dir` and reused by later processes. This should be
+    called before the first guidance call."""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", str(cache_dir.absolute()))
+
+
+def prewarm_guidance(
+    body: fncsmpl_jax.SmplhModel,
+    guidance_modes: Sequence[GuidanceMode],
+    phases: Sequence[Literal["inner", "post"]],
+    seq_lens: Sequence[int],
+    num_samples: Sequence[int],
+    persistent_guidance: bool = False,
+    chunk_size: int | None = None,
+) -> None:
+    """Compile guidance optimizers ahead of time, for the shape buckets that
+    `seq_lens` and `num_samples` fall into. Combined with
+    `enable_compilation_cache()`, this lets later processes skip compilation.
+    With `persistent_guidance`, inner guidance is compiled for
+    `guidance_optimizer_jax.GuidanceSession` instead, which warm-starts from
+    previous solutions.
+    `chunk_size` should match `JaxGuidanceParams.chunk_size` for inference.
+
+    Compiled optimizers also depend on the number of hand detections, which we
+    don't know in advance. We only compile optimizers for inputs without hand
+    detections, like `no_hands` guidance or sequences where no hands are
+    detected."""
+    shapes = sorted(
+        {
+            (get_guidance_bucket_num_samples(n), get_guidance_bucket_length(t))
+            for n in num_samples
+            for t in seq_lens
+        }
+    )
+    for guidance_mode, phase, (n, t) in itertools.product(
+        guidance_modes, phases, shapes
+    ):
+        print(f"Compiling {guidance_mode=} {phase=} for {n} samples, {t} timesteps")
+        warm_start = persistent_guidance and phase == "inner"
+        do_guidance_optimization_jax(
+            Ts_world_cpf=jnp.broadcast_to(jaxlie.SE3.identity().wxyz_xyz, (t, 7)),
+            betas=jnp.zeros((n, t, 16)),
+            body_rotmats=jnp.broadcast_to(jnp.eye(3), (n, t, 21, 3, 3)),
+            hand_rotmats=jnp.broadcast_to(jnp.eye(3), (n, t, 30, 3, 3)),
+            contacts=jnp.zeros((n, t, 21)),
+            body=body,
+            guidance_mode=guidance_mode,
+            phase=phase,
+            hamer_detections=None,
+            aria_detections=None,
+            verbose=False,
+            bucket_shapes=True,
+            guidance_params=dataclasses.replace(
+                JaxGuidanceParams.session_defaults(guidance_mode, phase)
+                if warm_start
+                else JaxGuidanceParams.defaults(guidance_mode, phase),
+                chunk_size=chunk_size,
+            ),
+            warm_quats=jnp.broadcast_to(jaxlie.SO3.identity().wxyz, (n, t, 51, 4))
+            if warm_start
+            else None,
+            warm_lambdas=onp.full((n,), 0.1, dtype=onp.float32) if warm_start else None,
+        )
+
+
+class _SmplhBodyPosesVar(
+    jaxls.Var[jax.Array],
+    default_factory=lambda: jnp.concatenate(
+        [jnp.ones((21, 1)), jnp.zeros((21, 3))], axis=-1
+    ),
+    retract_fn=lambda val, delta: (
+        jaxlie.SO3(val) @ jaxlie.SO3.exp(delta.reshape(21, 3))
+    ).wxyz,
+    tangent_dim=21 * 3,
+):
+    """Variable containing local joint poses for a SMPL-H human."""
+
+
+class _SmplhSingleHandPosesVar(
+    jaxls.Var[jax.Array],
+    default_factory=lambda: jnp.concatenate(
+        [jnp.ones((15, 1)), jnp.zeros((15, 3))], axis=-1
+    ),
+    retract_fn=lambda val, delta: (
+        jaxlie.SO3(val) @ jaxlie.SO3.exp(delta.reshape(15, 3))
+    ).wxyz,
+    tangent_dim=15 * 3,
+):
+    """Variable containing local joint poses for one hand of a SMPL-H human."""
+
+
+@jdc.jit
+def _optimize_vmapped(
+    Ts_world_cpf: jax.Array,
+    body: fncsmpl_jax.SmplhModel,
+    betas: jax.Array,
+    body_rotmats: jax.Array,
+    hand_rotmats: jax.Array,
+    contacts: jax.Array,
+    num_valid_timesteps: jax.Array,
+    guidance_params: JaxGuidanceParams,
+    hamer_detections: dict | None,
+    aria_detections: dict | None,
+    verbose: jdc.Static[bool],
+    warm_quats: jax.Array | None = None,
+    warm_lambdas: jax.Array | None = None,
+) -> tuple[jax.Array, dict]:
+    return jax.vmap(
+        partial(
+            _optimize,
+            Ts_world_cpf=Ts_world_cpf,
+            body=body,
+            num_valid_timesteps=num_valid_timesteps,
+            guidance_params=guidance_params,
+            hamer_detections=hamer_detections,
+            aria_detections=aria_detections,
+            verbose=verbose,
+        )
+    )(
+        betas=betas,
+        body_rotmats=body_rotmats,
+        hand_rotmats=hand_rotmats,
+        contacts=contacts,
+        warm_quats=warm_quats,
+        warm_lambda=warm_lambdas,
+    )
+
+
+@jdc.jit
+def _optimize_chunked_vmapped(
+    Ts_world_cpf: jax.Array,
+    body: fncsmpl_jax.SmplhModel,
+    betas: jax.Array,
+    body_rotmats: jax.Array,
+    hand_rotmats: jax.Array,
+    contacts: jax.Array,
+    num_valid_timesteps: jax.Array,
+    guidance_params: JaxGuidanceParams,
+    hamer_detections: dict | None,
+    aria_detections: dict | None,
+    max_chunk_detections: jdc.Static[int],
+    max_seam_detections: jdc.Static[int],
+    verbose: jdc.Static[bool],
+    warm_quats: jax.Array | None = None,
+    warm_lambdas: jax.Array | None = None,
+) -> tuple[jax.Array, dict]:
+    return jax.vmap(
+        partial(
+            _optimize_chunked,
+            Ts_world_cpf=Ts_world_cpf,
+            body=body,
+            num_valid_timesteps=num_valid_timesteps,
+            guidance_params=guidance_params,
+            hamer_detections=hamer_detections,
+            aria_detections=aria_detections,
+            max_chunk_detections=max_chunk_detections,
+            max_seam_detections=max_seam_detections,
+            verbose=verbose,
+        )
+    )(
+        betas=betas,
+        body_rotmats=body_rotmats,
+        hand_rotmats=hand_rotmats,
+        contacts=contacts,
+        warm_quats=warm_quats,
+        warm_lambda=warm_lambdas,
+    )
+
+
+# Modes for guidance.
+GuidanceMode = Literal[
+    # Foot skating only.
+    "no_hands",
+    # Only use Aria wrist pose.
+    "aria_wrist_only",
+    # Use Aria wrist pose + HaMeR 3D estimates.
+    "aria_hamer",
+    # Use only HaMeR 3D estimates.
+    "hamer_wrist",
+    # Use HaMeR 3D estimates + reprojection.
+    "hamer_reproj2",
+]
+
+GuidanceLinearSolver = Literal["conjugate_gradient", "block_banded"]
+
+
+@jdc.pytree_dataclass
+class JaxGuidanceParams:
+    prior_quat_weight: float = 1.0
+    prior_pos_weight: float = 5.0
+    body_quat_vel_smoothness_weight: float = 5.0
+    body_quat_smoothness_weight: float = 1.0
+    body_quat_delta_smoothness_weight: float = 10.0
+    skate_weight: float = 30.0
+
+    # Note: this should be quite high. If the hand quaternions aren't
+    # constrained enough the reprojecction loss can get wild.
+    hand_quats: jdc.Static[bool] = True
+    hand_quat_weight = 5.0
+
+    hand_quat_priors: jdc.Static[bool] = True
+    hand_quat_prior_weight = 0.1
+    hand_quat_smoothness_weight = 1.0
+
+    hamer_reproj: jdc.Static[bool] = True
+    hand_reproj_weight: float = 1.0
+
+    hamer_wrist_pose: jdc.Static[bool] = True
+    hamer_abspos_weight: float = 20.0
+    hamer_ori_weight: float = 5.0
+
+    aria_wrists: jdc.Static[bool] = True
+    aria_wrist_pos_weight: float = 50.0
+    aria_wrist_ori_weight: float = 10.0
+
+    # Optimization parameters.
+    lambda_initial: float = 0.1
+    max_iters: jdc.Static[int] = 20
+    # Stop early once an accepted step decreases the cost by less than this
+    # fraction. The default matches jaxls.
+    cost_tolerance: float = 1e-5
+
+    # Linear solver for each Levenberg-Marquardt step. `block_banded`
+    # factorizes the normal equations directly, which takes advantage of
+    # variables only being coupled across nearby timesteps. Its cost is linear
+    # in the sequence length. See `_optimize_block_banded()`.
+    linear_solver: jdc.Static[GuidanceLinearSolver] = "conjugate_gradient"
+
+    # If set, sequences longer than this are optimized in overlapping chunks
+    # of `chunk_size` timesteps, which are solved in parallel and blended.
+    # Seams between chunks are then refined for `seam_iters` iterations. See
+    # `_optimize_chunked()`.
+    chunk_size: jdc.Static[int | None] = None
+    chunk_overlap: jdc.Static[int] = 32
+    seam_iters: jdc.Static[int] = 5
+
+    @staticmethod
+    def defaults(
+        mode: GuidanceMode,
+        phase: Literal["inner", "post"],
+    ) -> JaxGuidanceParams:
+        if mode == "no_hands":
+            return {
+                "inner": JaxGuidanceParams(
+                    hand_quats=False,
+                    hand_quat_priors=False,
+                    hamer_reproj=False,
+                    hamer_wrist_pose=False,
+                    aria_wrists=False,
+                    max_iters=5,
+                ),
+                "post": JaxGuidanceParams(
+                    hand_quats=False,
+                    hand_quat_priors=False,
+                    hamer_reproj=False,
+                    hamer_wrist_pose=False,
+                    aria_wrists=False,
+                    max_iters=20,
+                ),
+            }[phase]
+        elif mode == "aria_wrist_only":
+            return {
+                "inner": JaxGuidanceParams(
+                    hand_quats=False,
+                    hand_quat_priors=True,
+                    hamer_reproj=False,
+                    hamer_wrist_pose=False,
+                    aria_wrists=True,
+                    max_iters=5,
+                ),
+                "post": JaxGuidanceParams(
+                    hand_quats=False,
+                    hand_quat_priors=True,
+                    hamer_reproj=False,
+                    hamer_wrist_pose=False,
+                    aria_wrists=True,
+                    max_iters=20,
+                ),
+            }[phase]
+        elif mode == "aria_hamer":
+            return {
+                "inner": JaxGuidanceParams(
+                    hand_quats=True,
+                    hand_quat_priors=True,
+                    hamer_reproj=False,
+                    hamer_wrist_pose=False,
+                    aria_wrists=True,
+                    max_iters=5,
+                ),
+                "post": JaxGuidanceParams(
+                    hand_quats=True,
+                    hand_quat_priors=True,
+                    hamer_reproj=False,
+                    hamer_wrist_pose=False,
+                    aria_wrists=True,
+                    max_iters=20,
+                ),
+            }[phase]
+        elif mode == "hamer_wrist":
+            return {
+                "inner": JaxGuidanceParams(
+                    hand_quats=True,
+                    hand_quat_priors=True,
+                    # NOTE: we turn off reprojection during the inner loop optimization.
+                    hamer_reproj=False,
+                    hamer_wrist_pose=True,
+                    aria_wrists=False,
+                    max_iters=5,
+                ),
+                "post": JaxGuidanceParams(
+                    hand_quats=True,
+                    hand_quat_priors=True,
+                    # Turn on reprojection.
+                    hamer_reproj=False,
+                    hamer_wrist_pose=True,
+                    aria_wrists=False,
+                    max_iters=20,
+                ),
+            }[phase]
+        elif mode == "hamer_reproj2":
+            return {
+                "inner": JaxGuidanceParams(
+                    hand_quats=True,
+                    hand_quat_priors=True,
+                    # NOTE: we turn off reprojection during the inner loop optimization.
+                    hamer_reproj=False,
+                    hamer_wrist_pose=True,
+                    aria_wrists=False,
+                    max_iters=5,
+                ),
+                "post": JaxGuidanceParams(
+                    hand_quats=True,
+                    hand_quat_priors=True,
+                    # Turn on reprojection.
+                    hamer_reproj=True,
+                    hamer_wrist_pose=True,
+                    aria_wrists=False,
+                    max_iters=20,
+                ),
+            }[phase]
+        else:
+            assert_never(mode)
+
+    @staticmethod
+    def session_defaults(
+        mode: GuidanceMode,
+        phase: Literal["inner", "post"],
+    ) -> JaxGuidanceParams:
+        """Defaults for `guidance_optimizer_jax.GuidanceSession`. These are
+        the same as `defaults()`, but with the `block_banded` linear solver:
+        it's the only one that returns its final damping, so each call can
+        start from the damping that the previous call ended with."""
+        return dataclasses.replace(
+            JaxGuidanceParams.defaults(mode, phase), linear_solver="block_banded"
+        )
+
+
+def _optimize(
+    Ts_world_cpf: jax.Array,
+    body: fncsmpl_jax.SmplhModel,
+    betas: jax.Array,
+    body_rotmats: jax.Array,
+    hand_rotmats: jax.Array,
+    contacts: jax.Array,
+    num_valid_timesteps: jax.Array,
+    guidance_params: JaxGuidanceParams,
+    hamer_detections: dict | None,
+    aria_detections: dict | None,
+    verbose: bool,
+    warm_quats: jax.Array | None = None,
+    warm_lambda: jax.Array | None = None,
+) -> tuple[jax.Array, dict]:
+    """Apply constraints using Levenberg-Marquardt optimizer. Returns updated
+    body_rotmats and hand_rotmats matrices.
+
+    Timesteps from `num_valid_timesteps` onward are padding. Costs that couple
+    neighboring timesteps are masked out for padded timesteps, and per-frame
+    costs are zero at initialization, so padding doesn't change the solution
+    for valid timesteps. Each side of `hamer_detections` and `aria_detections`
+    can also have a `mask`, with one weight per detection; padded detections
+    have a weight of 0.0.
+
+    If `warm_quats` is set, we start from it instead of the input rotations
+    when it has a lower cost. Priors are still relative to the input.
+    `warm_lambda` overrides `guidance_params.lambda_initial`. The returned
+    metadata has the final damping under `lambda`."""
+    timesteps = body_rotmats.shape[0]
+    assert Ts_world_cpf.shape == (timesteps, 7)
+    assert body_rotmats.shape == (timesteps, 21, 3, 3)
+    assert hand_rotmats.shape == (timesteps, 30, 3, 3)
+    assert contacts.shape == (timesteps, 21)
+    assert betas.shape == (timesteps, 16)
+    assert num_valid_timesteps.shape == ()
+
+    # 1.0 for valid timesteps, 0.0 for padding.
+    valid = (jnp.arange(timesteps) < num_valid_timesteps).astype(betas.dtype)
+
+    init_quats = jaxlie.SO3.from_matrix(
+        # body_rotmats
+        jnp.concatenate([body_rotmats, hand_rotmats], axis=1)
+    ).wxyz
+    assert init_quats.shape == (timesteps, 51, 4)
+
+    # Assume body shape is time-invariant.
+    shaped_body = body.with_shape(
+        jnp.sum(betas * valid[:, None], axis=0) / jnp.sum(valid)
+    )
+    T_head_cpf = shaped_body.get_T_head_cpf()
+    T_cpf_head = jaxlie.SE3(T_head_cpf).inverse().parameters()
+    assert T_cpf_head.shape == (7,)
+
+    init_posed = shaped_body.with_pose(
+        jaxlie.SE3.identity(batch_axes=(timesteps,)).wxyz_xyz, init_quats
+    )
+    T_world_head = jaxlie.SE3(Ts_world_cpf) @ jaxlie.SE3(T_cpf_head)
+    T_root_head = jaxlie.SE3(init_posed.Ts_world_joint[:, 14])
+    init_posed = init_posed.with_new_T_world_root(
+        (T_world_head @ T_root_head.inverse()).wxyz_xyz
+    )
+    del T_world_head
+    del T_root_head
+
+    foot_joint_indices = jnp.array([6, 7, 9, 10])
+    num_foot_joints = foot_joint_indices.shape[0]
+
+    contacts = contacts[..., foot_joint_indices]
+    pairwise_contacts = (contacts[:-1, :] + contacts[1:, :]) / 2.0
+    assert pairwise_contacts.shape == (timesteps - 1, num_foot_joints)
+    del contacts
+
+    # We'll populate a list of factors (cost terms). Each is a residual
+    # function, and arguments that are batched over the leading axis.
+    factors = list[tuple[Callable[..., jax.Array], tuple]]()
+
+    def cost_with_args[*CostArgs](
+        *args: Unpack[tuple[*CostArgs]],
+    ) -> Callable[
+        [Callable[[jaxls.VarValues, *CostArgs], jax.Array]],
+        Callable[[jaxls.VarValues, *CostArgs], jax.Array],
+    ]:
+        """Decorator for appending to the factor list."""
+
+        def inner(
+            cost_func: Callable[[jaxls.VarValues, *CostArgs], jax.Array],
+        ) -> Callable[[jaxls.VarValues, *CostArgs], jax.Array]:
+            factors.append((cost_func, args))
+            return cost_func
+
+        return inner
+
+    def do_forward_kinematics(
+        vals: jaxls.VarValues,
+        var: _SmplhBodyPosesVar,
+        left_hand: _SmplhSingleHandPosesVar | None = None,
+        right_hand: _SmplhSingleHandPosesVar | None = None,
+        output_frame: Literal["world", "root"] = "world",
+    ) -> fncsmpl_jax.SmplhShapedAndPosed:
+        """Helper for computing forward kinematics from variables."""
+        assert (left_hand is None) == (right_hand is None)
+        if left_hand is None and right_hand is None:
+            posed = shaped_body.with_pose(
+                T_world_root=jaxlie.SE3.identity().wxyz_xyz,
+                local_quats=vals[var],
+            )
+        elif left_hand is not None and right_hand is None:
+            posed = shaped_body.with_pose(
+                T_world_root=jaxlie.SE3.identity().wxyz_xyz,
+                local_quats=jnp.concatenate([vals[var], vals[left_hand]], axis=-2),
+            )
+        elif left_hand is not None and right_hand is not None:
+            posed = shaped_body.with_pose(
+                T_world_root=jaxlie.SE3.identity().wxyz_xyz,
+                local_quats=jnp.concatenate(
+                    [vals[var], vals[left_hand], vals[right_hand]], axis=-2
+                ),
+            )
+        else:
+            assert False
+
+        if output_frame == "world":
+            T_world_root = (
+                # T_world_cpf
+                jaxlie.SE3(Ts_world_cpf[var.id, :])
+                # T_cpf_head
+                @ jaxlie.SE3(T_cpf_head)
+                # T_head_root
+                @ jaxlie.SE3(posed.Ts_world_joint[14]).inverse()
+            )
+            return posed.with_new_T_world_root(T_world_root.wxyz_xyz)
+        elif output_frame == "root":
+            return posed
+
+    # HaMeR pose cost.
+    if hamer_detections is not None and guidance_params.hand_quat_priors:
+        hamer_left = hamer_detections["detections_left_concat"]
+        hamer_right = hamer_detections["detections_right_concat"]
+
+        # HaMeR local quaternion smoothness.
+        @(
+            cost_with_args(
+                _SmplhSingleHandPosesVar(jnp.arange(timesteps * 2 - 2)),
+                _SmplhSingleHandPosesVar(jnp.arange(2, timesteps * 2)),
+                valid[jnp.arange(timesteps * 2 - 2) // 2 + 1],
+            )
+        )
+        def hand_smoothness(
+            vals: jaxls.VarValues,
+            hand_pose: _SmplhSingleHandPosesVar,
+            hand_pose_next: _SmplhSingleHandPosesVar,
+            next_valid: jax.Array,
+        ) -> jax.Array:
+            return (
+                next_valid
+                * guidance_params.hand_quat_smoothness_weight
+                * (
+                    jaxlie.SO3(vals[hand_pose]).inverse()
+                    @ jaxlie.SO3(vals[hand_pose_next])
+                )
+                .log()
+                .flatten()
+            )
+
+        # Hand prior loss.
+        @cost_with_args(
+            _SmplhSingleHandPosesVar(jnp.arange(timesteps * 2)),
+            init_quats[:, 21:51, :].reshape((timesteps * 2, 15, 4)),
+        )
+        def hand_prior(
+            vals: jaxls.VarValues,
+            hand_pose: _SmplhSingleHandPosesVar,
+            init_hand_quats: jax.Array,
+        ) -> jax.Array:
+            return (
+                guidance_params.hand_quat_prior_weight
+                * (jaxlie.SO3(vals[hand_pose]).inverse() @ jaxlie.SO3(init_hand_quats))
+                .log()
+                .flatten()
+            )
+
+    if hamer_detections is not None and guidance_params.hand_quats:
+        hamer_left = hamer_detections["detections_left_concat"]
+        hamer_right = hamer_detections["detections_right_concat"]
+
+        # HaMeR local pose matching.
+        @(
+            cost_with_args(
+                _SmplhSingleHandPosesVar(hamer_left["indices"] * 2),
+                hamer_left["single_hand_quats"],
+                _get_detection_mask(hamer_left),
+            )
+            if hamer_left is not None
+            else lambda x: x
+        )
+        @(
+            cost_with_args(
+                _SmplhSingleHandPosesVar(hamer_right["indices"] * 2 + 1),
+                hamer_right["single_hand_quats"],
+                _get_detection_mask(hamer_right),
+            )
+            if hamer_right is not None
+            else lambda x: x
+        )
+        def hamer_local_pose_cost(
+            vals: jaxls.VarValues,
+            hand_pose: _SmplhSingleHandPosesVar,
+            estimated_hand_quats: jax.Array,
+            mask: jax.Array,
+        ) -> jax.Array:
+            hand_quats = vals[hand_pose]
+            assert hand_quats.shape == estimated_hand_quats.shape
+            return (mask * guidance_params.hand_quat_weight) * (
+                (jaxlie.SO3(hand_quats).inverse() @ jaxlie.SO3(estimated_hand_quats))
+                .log()
+                .flatten()
+            )
+
+    if hamer_detections is not None and (
+        guidance_params.hamer_reproj and guidance_params.hamer_wrist_pose
+    ):
+        hamer_left = hamer_detections["detections_left_concat"]
+        hamer_right = hamer_detections["detections_right_concat"]
+
+        # HaMeR reprojection.
+        mano_from_openpose_indices = _get_mano_from_openpose_indices(include_tips=False)
+
+        @(
+            cost_with_args(
+                _SmplhBodyPosesVar(hamer_left["indices"]),
+                _SmplhSingleHandPosesVar(hamer_left["indices"] * 2),
+                _SmplhSingleHandPosesVar(hamer_left["indices"] * 2 + 1),
+                jnp.full_like(hamer_left["indices"], fill_value=0),
+                hamer_left["keypoints_3d"],
+                hamer_left["mano_hand_global_orient"],
+                _get_detection_mask(hamer_left),
+            )
+            if hamer_left is not None
+            else lambda x: x
+        )
+        @(
+            cost_with_args(
+                _SmplhBodyPosesVar(hamer_right["indices"]),
+                _SmplhSingleHandPosesVar(hamer_right["indices"] * 2),
+                _SmplhSingleHandPosesVar(hamer_right["indices"] * 2 + 1),
+                jnp.full_like(hamer_right["indices"], fill_value=1),
+                hamer_right["keypoints_3d"],
+                hamer_right["mano_hand_global_orient"],
+                _get_detection_mask(hamer_right),
+            )
+            if hamer_right is not None
+            else lambda x: x
+        )
+        def hamer_wrist_and_reproj(
+            vals: jaxls.VarValues,
+            body_pose: _SmplhBodyPosesVar,
+            left_hand_pose: _SmplhSingleHandPosesVar,
+            right_hand_pose: _SmplhSingleHandPosesVar,
+            left0_right1: jax.Array,  # Set to 0 for left, 1 for right.
+            keypoints3d_wrt_cam: jax.Array,  # These are in OpenPose order!!
+            Rmat_cam_wrist: jax.Array,
+            mask: jax.Array,
+        ) -> jax.Array:
+            posed = do_forward_kinematics(
+                # The right hand comes _after_ the left hand, we can exclude it.
+                vals,
+                body_pose,
+                left_hand_pose,
+                right_hand_pose,
+                output_frame="root",
+            )
+            Ts_root_joint = posed.Ts_world_joint  # Sorry for the naming...
+            del posed
+
+            # 19 for left wrist, 20 for right wrist.
+            wrist_index = 19 + left0_right1
+            hand_start_index = 21 + 15 * left0_right1
+
+            assert Ts_root_joint.shape == (51, 7)
+            joint_positions_wrt_root = Ts_root_joint[:, 4:7]
+            mano_joints_wrt_root = jnp.concatenate(
+                [
+                    jax.lax.dynamic_slice_in_dim(
+                        joint_positions_wrt_root,
+                        start_index=wrist_index,
+                        slice_size=1,
+                        axis=-2,
+                    ),
+                    jax.lax.dynamic_slice_in_dim(
+                        joint_positions_wrt_root,
+                        start_index=hand_start_index,
+                        slice_size=15,
+                        axis=-2,
+                    ),
+                ],
+                axis=0,
+            )
+            assert mano_joints_wrt_root.shape == (16, 3)
+            assert keypoints3d_wrt_cam.shape == (21, 3)  # In OpenPose.
+
+            T_cam_root = (
+                # T_cam_cpf (7,)
+                jaxlie.SE3(hamer_detections["T_cpf_cam"]).inverse()
+                # T_cpf_head (7,)
+                @ jaxlie.SE3(T_cpf_head)
+                # T_head_root (7,)
+                @ jaxlie.SE3(Ts_root_joint[14, :]).inverse()
+            )
+            assert T_cam_root.parameters().shape == (7,)
+            mano_joints_wrt_cam = T_cam_root @ mano_joints_wrt_root
+            obs_joints_wrt_cam = keypoints3d_wrt_cam[mano_from_openpose_indices, :]
+
+            mano_uv_wrt_cam = mano_joints_wrt_cam[:, :2] / mano_joints_wrt_cam[:, 2:3]
+            obs_uv_wrt_cam = obs_joints_wrt_cam[:, :2] / obs_joints_wrt_cam[:, 2:3]
+
+            T_cam_wrist = jaxlie.SE3.from_rotation_and_translation(
+                T_cam_root.rotation() @ jaxlie.SO3(Ts_root_joint[wrist_index, :4]),
+                mano_joints_wrt_cam[0, :],
+            )
+            obs_T_cam_wrist = jaxlie.SE3.from_rotation_and_translation(
+                jaxlie.SO3.from_matrix(Rmat_cam_wrist),
+                obs_joints_wrt_cam[0, :],
+            )
+
+            return mask * jnp.concatenate(
+                [
+                    (T_cam_wrist.inverse() @ obs_T_cam_wrist).log()
+                    * jnp.array(
+                        [guidance_params.hamer_abspos_weight] * 3
+                        + [guidance_params.hamer_ori_weight] * 3
+                    ),
+                    guidance_params.hand_reproj_weight
+                    * (mano_uv_wrt_cam - obs_uv_wrt_cam).flatten(),
+                ]
+            )
+    elif (
+        hamer_detections is not None
+        and not guidance_params.hamer_reproj
+        and guidance_params.hamer_wrist_pose
+    ):
+        hamer_left = hamer_detections["detections_left_concat"]
+        hamer_right = hamer_detections["detections_right_concat"]
+
+        @(
+            cost_with_args(
+                _SmplhBodyPosesVar(hamer_left["indices"]),
+                jnp.full_like(hamer_left["indices"], fill_value=0),
+                hamer_left["keypoints_3d"],
+                hamer_left["mano_hand_global_orient"],
+                _get_detection_mask(hamer_left),
+            )
+            if hamer_left is not None
+            else lambda x: x
+        )
+        @(
+            cost_with_args(
+                _SmplhBodyPosesVar(hamer_right["indices"]),
+                jnp.full_like(hamer_right["indices"], fill_value=1),
+                hamer_right["keypoints_3d"],
+                hamer_right["mano_hand_global_orient"],
+                _get_detection_mask(hamer_right),
+            )
+            if hamer_right is not None
+            else lambda x: x
+        )
+        def hamer_wrist_only(
+            vals: jaxls.VarValues,
+            body_pose: _SmplhBodyPosesVar,
+            left0_right1: jax.Array,  # Set to 0 for left, 1 for right.
+            keypoints3d_wrt_cam: jax.Array,  # These are in OpenPose order!!
+            Rmat_cam_wrist: jax.Array,
+            mask: jax.Array,
+        ) -> jax.Array:
+            posed = do_forward_kinematics(vals, body_pose, output_frame="root")
+            Ts_root_joint = posed.Ts_world_joint  # Sorry for the naming...
+            del posed
+
+            # 19 for left wrist, 20 for right wrist.
+            wrist_index = 19 + left0_right1
+
+            assert Ts_root_joint.shape == (21, 7)
+            wrist_position_wrt_root = Ts_root_joint[wrist_index, 4:7]
+
+            T_cam_root = (
+                # T_cam_cpf (7,)
+                jaxlie.SE3(hamer_detections["T_cpf_cam"]).inverse()
+                # T_cpf_head (7,)
+                @ jaxlie.SE3(T_cpf_head)
+                # T_head_root (7,)
+                @ jaxlie.SE3(Ts_root_joint[14, :]).inverse()
+            )
+            assert T_cam_root.parameters().shape == (7,)
+            wrist_position_wrt_cam = T_cam_root @ wrist_position_wrt_root
+
+            # Assumes OpenPose root is same as Mano root!!
+            wrist_pos_wrt_cam = keypoints3d_wrt_cam[0, :]
+
+            T_cam_wrist = jaxlie.SE3.from_rotation_and_translation(
+                T_cam_root.rotation() @ jaxlie.SO3(Ts_root_joint[wrist_index, :4]),
+                wrist_position_wrt_cam,
+            )
+            obs_T_cam_wrist = jaxlie.SE3.from_rotation_and_translation(
+                jaxlie.SO3.from_matrix(Rmat_cam_wrist),
+                wrist_pos_wrt_cam,
+            )
+            return (
+                mask
+                * (T_cam_wrist.inverse() @ obs_T_cam_wrist).log()
+                * jnp.array(
+                    [guidance_params.hamer_abspos_weight] * 3
+                    + [guidance_params.hamer_ori_weight] * 3
+                )
+            )
+
+    # Wrist pose cost.
+    if aria_detections is not None and guidance_params.aria_wrists:
+        aria_left = aria_detections["detections_left_concat"]
+        aria_right = aria_detections["detections_right_concat"]
+
+        @(
+            cost_with_args(
+                _SmplhBodyPosesVar(aria_left["indices"]),
+                aria_left["confidence"],
+                aria_left["wrist_position"],
+                aria_left["palm_position"],
+                aria_left["palm_normal"],
+                jnp.full_like(aria_left["indices"], fill_value=0),
+                _get_detection_mask(aria_left),
+            )
+            if aria_left is not None
+            else lambda x: x
+        )
+        @(
+            cost_with_args(
+                _SmplhBodyPosesVar(aria_right["indices"]),
+                aria_right["confidence"],
+                aria_right["wrist_position"],
+                aria_right["palm_position"],
+                aria_right["palm_normal"],
+                jnp.full_like(aria_right["indices"], fill_value=1),
+                _get_detection_mask(aria_right),
+            )
+            if aria_right is not None
+            else lambda x: x
+        )
+        def wrist_pose_cost(
+            vals: jaxls.VarValues,
+            pose: _SmplhBodyPosesVar,
+            confidence: jax.Array,
+            wrist_position: jax.Array,
+            palm_position: jax.Array,
+            palm_normal: jax.Array,
+            left0_right1: jax.Array,  # Set to 0 for left, 1 for right.
+            mask: jax.Array,
+        ) -> jax.Array:
+            assert wrist_position.shape == (3,)
+            assert left0_right1.shape == ()
+            posed = do_forward_kinematics(vals, pose)
+
+            T_world_wrist = posed.Ts_world_joint[19 + left0_right1]
+
+            pos_cost = (
+                # Left wrist is joint 19, right is joint 20.
+                T_world_wrist[4:7] - wrist_position
+            )
+
+            # Estimate wrist orientation from forward + normal directions.
+            palm_forward = palm_position - wrist_position
+            palm_forward = palm_forward / jnp.linalg.norm(palm_forward)
+            palm_normal = palm_normal / jnp.linalg.norm(palm_normal)
+            palm_forward = (  # Flip palm forward if right hand.
+                palm_forward * jnp.array([1, -1])[left0_right1]
+            )
+            palm_forward = (  # Gram-schmidt for forward direction.
+                palm_forward - jnp.dot(palm_forward, palm_normal) * palm_normal
+            )
+            estimatedR_world_wrist = jaxlie.SO3.from_matrix(
+                jnp.stack(
+                    [
+                        palm_forward,
+                        -palm_normal,
+                        jnp.cross(palm_normal, palm_forward),
+                    ],
+                    axis=1,
+                )
+            )
+            R_world_wrist = jaxlie.SO3(T_world_wrist[:4])
+            ori_cost = (estimatedR_world_wrist.inverse() @ R_world_wrist).log()
+
+            return (mask * confidence) * jnp.concatenate(
+                [
+                    guidance_params.aria_wrist_pos_weight * pos_cost,
+                    guidance_params.aria_wrist_ori_weight * ori_cost,
+                ]
+            )
+
+    # Per-frame regularization cost.
+    @cost_with_args(
+        _SmplhBodyPosesVar(jnp.arange(timesteps)),
+    )
+    def reg_cost(
+        vals: jaxls.VarValues,
+        pose: _SmplhBodyPosesVar,
+    ) -> jax.Array:
+        posed = do_forward_kinematics(vals, pose)
+
+        torso_indices = jnp.array([0, 1, 2, 5, 8])
+        return jnp.concatenate(
+            [
+                guidance_params.prior_quat_weight
+                * (
+                    jaxlie.SO3(vals[pose]).inverse()
+                    @ jaxlie.SO3(init_quats[pose.id, :21, :])
+                )
+                .log()
+                .flatten(),
+                # Only include some torso joints.
+                guidance_params.prior_pos_weight
+                * (
+                    posed.Ts_world_joint[torso_indices, 4:7]
+                    - init_posed.Ts_world_joint[pose.id, torso_indices, 4:7]
+                ).flatten(),
+            ]
+        )
+
+    @cost_with_args(
+        _SmplhBodyPosesVar(jnp.arange(timesteps - 1)),
+        _SmplhBodyPosesVar(jnp.arange(1, timesteps)),
+        valid[1:],
+    )
+    def delta_smoothness_cost(
+        vals: jaxls.VarValues,
+        current: _SmplhBodyPosesVar,
+        next: _SmplhBodyPosesVar,
+        next_valid: jax.Array,
+    ) -> jax.Array:
+        curdelt = jaxlie.SO3(vals[current]).inverse() @ jaxlie.SO3(
+            init_quats[current.id, :21, :]
+        )
+        nexdelt = jaxlie.SO3(vals[next]).inverse() @ jaxlie.SO3(
+            init_quats[next.id, :21, :]
+        )
+        return next_valid * jnp.concatenate(
+            [
+                guidance_params.body_quat_delta_smoothness_weight
+                * (curdelt.inverse() @ nexdelt).log().flatten(),
+                guidance_params.body_quat_smoothness_weight
+                * (jaxlie.SO3(vals[current]).inverse() @ jaxlie.SO3(vals[next]))
+                .log()
+                .flatten(),
+            ]
+        )
+
+    @cost_with_args(
+        _SmplhBodyPosesVar(jnp.arange(timesteps - 2)),
+        _SmplhBodyPosesVar(jnp.arange(1, timesteps - 1)),
+        _SmplhBodyPosesVar(jnp.arange(2, timesteps)),
+        valid[2:],
+    )
+    def vel_smoothness_cost(
+        vals: jaxls.VarValues,
+        t0: _SmplhBodyPosesVar,
+        t1: _SmplhBodyPosesVar,
+        t2: _SmplhBodyPosesVar,
+        t2_valid: jax.Array,
+    ) -> jax.Array:
+        curdelt = jaxlie.SO3(vals[t0]).inverse() @ jaxlie.SO3(vals[t1])
+        nexdelt = jaxlie.SO3(vals[t1]).inverse() @ jaxlie.SO3(vals[t2])
+        return (
+            t2_valid
+            * guidance_params.body_quat_vel_smoothness_weight
+            * (curdelt.inverse() @ nexdelt).log().flatten()
+        )
+
+    @cost_with_args(
+        _SmplhBodyPosesVar(jnp.arange(timesteps - 1)),
+        _SmplhBodyPosesVar(jnp.arange(1, timesteps)),
+        pairwise_contacts * valid[1:, None],
+    )
+    def skating_cost(
+        vals: jaxls.VarValues,
+        current: _SmplhBodyPosesVar,
+        next: _SmplhBodyPosesVar,
+        foot_contacts: jax.Array,
+    ) -> jax.Array:
+        # Do forward kinematics.
+        posed_current = do_forward_kinematics(vals, current)
+        posed_next = do_forward_kinematics(vals, next)
+        footpos_current = posed_current.Ts_world_joint[foot_joint_indices, 4:7]
+        footpos_next = posed_next.Ts_world_joint[foot_joint_indices, 4:7]
+        assert footpos_current.shape == footpos_next.shape == (num_foot_joints, 3)
+        assert foot_contacts.shape == (num_foot_joints,)
+
+        return (
+            guidance_params.skate_weight
+            * (foot_contacts[:, None] * (footpos_current - footpos_next)).flatten()
+        )
+
+    start_quats = init_quats
+    if warm_quats is not None:
+        assert warm_quats.shape == (timesteps, 51, 4)
+        # Padded timesteps always start from the input, where their costs are
+        # zero.
+        warm_quats = jnp.where(valid[:, None, None] > 0.0, warm_quats, init_quats)
+        start_quats = jnp.where(
+            _compute_cost(
+                factors,
+                warm_quats[:, :21, :],
+                warm_quats[:, 21:51, :].reshape((timesteps * 2, 15, 4)),
+            )
+            < _compute_cost(
+                factors,
+                init_quats[:, :21, :],
+                init_quats[:, 21:51, :].reshape((timesteps * 2, 15, 4)),
+            ),
+            warm_quats,
+            init_quats,
+        )
+    lambda_initial = (
+        jnp.asarray(guidance_params.lambda_initial, init_quats.dtype)
+        if warm_lambda is None
+        else warm_lambda
+    )
+
+    if guidance_params.linear_solver == "block_banded":
+        out_body_quats, out_hand_quats, out_lambda = _optimize_block_banded(
+            factors,
+            init_body_quats=start_quats[:, :21, :],
+            init_hand_quats=start_quats[:, 21:51, :].reshape((timesteps * 2, 15, 4)),
+            lambda_initial=lambda_initial,
+            guidance_params=guidance_params,
+            verbose=verbose,
+        )
+    else:
+        vars_body_pose = _SmplhBodyPosesVar(jnp.arange(timesteps))
+        vars_hand_pose = _SmplhSingleHandPosesVar(jnp.arange(timesteps * 2))
+        graph = jaxls.LeastSquaresProblem(
+            costs=[jaxls.Cost(cost_func, args) for cost_func, args in factors],
+            variables=[vars_body_pose, vars_hand_pose],
+        ).analyze()
+        solutions = graph.solve(
+            initial_vals=jaxls.VarValues.make(
+                [
+                    vars_body_pose.with_value(start_quats[:, :21, :]),
+                    vars_hand_pose.with_value(
+                        start_quats[:, 21:51, :].reshape((timesteps * 2, 15, 4))
+                    ),
+                ]
+            ),
+            linear_solver="conjugate_gradient",
+            trust_region=jaxls.TrustRegionConfig(lambda_initial=lambda_initial),
+            termination=jaxls.TerminationConfig(
+                max_iterations=guidance_params.max_iters,
+                cost_tolerance=guidance_params.cost_tolerance,
+            ),
+            verbose=verbose,
+        )
+        out_body_quats = solutions[_SmplhBodyPosesVar]
+        out_hand_quats = solutions[_SmplhSingleHandPosesVar]
+        out_lambda = lambda_initial
+    assert out_body_quats.shape == (timesteps, 21, 4)
+    out_hand_quats = out_hand_quats.reshape((timesteps, 30, 4))
+    assert out_hand_quats.shape == (timesteps, 30, 4)
+    return (
+        jnp.concatenate([out_body_quats, out_hand_quats], axis=-2),
+        # Metadata dict that we use for debugging.
+        {"lambda": out_lambda},
+    )
+
+
+def _optimize_chunked(
+    Ts_world_cpf: jax.Array,
+    body: fncsmpl_jax.SmplhModel,
+    betas: jax.Array,
+    body_rotmats: jax.Array,
+    hand_rotmats: jax.Array,
+    contacts: jax.Array,
+    num_valid_timesteps: jax.Array,
+    guidance_params: JaxGuidanceParams,
+    hamer_detections: dict | None,
+    aria_detections: dict | None,
+    max_chunk_detections: int,
+    max_seam_detections: int,
+    verbose: bool,
+    warm_quats: jax.Array | None = None,
+    warm_lambda: jax.Array | None = None,
+) -> tuple[jax.Array, dict]:
+    """Same as `_optimize()`, but the sequence is split into overlapping
+    chunks, which are optimized in parallel and blended where they overlap.
+    Windows centered on the seams between chunks are then optimized again,
+    starting from the blended result, and blended back in.
+
+    Only the seam pass sees costs that cross chunk boundaries, so results are
+    close to but not the same as optimizing the whole sequence. Detections
+    are padded to the same count for every window, and masked out."""
+    timesteps = body_rotmats.shape[0]
+    assert guidance_params.chunk_size is not None
+    chunk_starts, seam_starts = _get_chunk_and_seam_starts(timesteps, guidance_params)
+    seam_size = 2 * guidance_params.chunk_overlap
+
+    # Chunks share the body shape of the whole sequence.
+    valid = (jnp.arange(timesteps) < num_valid_timesteps).astype(betas.dtype)
+    betas = jnp.broadcast_to(
+        jnp.sum(betas * valid[:, None], axis=0) / jnp.sum(valid), betas.shape
+    )
+    init_quats = jaxlie.SO3.from_matrix(
+        jnp.concatenate([body_rotmats, hand_rotmats], axis=1)
+    ).wxyz
+
+    def optimize_windows(
+        starts: tuple[int, ...],
+        window_size: int,
+        max_detections: int,
+        params: JaxGuidanceParams,
+        start_quats: jax.Array | None,
+    ) -> tuple[jax.Array, jax.Array, jax.Array]:
+        """Optimize windows of the sequence in parallel. Returns optimized
+        rotations, their timesteps, and the final damping for each window."""
+        indices = jnp.array(starts)[:, None] + jnp.arange(window_size)[None, :]
+
+        def optimize_window(
+            start: jax.Array, window_indices: jax.Array
+        ) -> tuple[jax.Array, dict]:
+            return _optimize(
+                Ts_world_cpf=Ts_world_cpf[window_indices],
+                body=body,
+                betas=betas[window_indices],
+                body_rotmats=body_rotmats[window_indices],
+                hand_rotmats=hand_rotmats[window_indices],
+                contacts=contacts[window_indices],
+                num_valid_timesteps=jnp.clip(
+                    num_valid_timesteps - start, 1, window_size
+                ),
+                guidance_params=params,
+                hamer_detections=_get_window_detections(
+                    hamer_detections, start, window_size, max_detections
+                ),
+                aria_detections=_get_window_detections(
+                    aria_detections, start, window_size, max_detections
+                ),
+                verbose=verbose,
+                warm_quats=None if start_quats is None else start_quats[window_indices],
+                warm_lambda=warm_lambda,
+            )
+
+        quats, debug_info = jax.vmap(optimize_window)(jnp.array(starts), indices)
+        return quats, indices, debug_info["lambda"]
+
+    chunk_quats, chunk_indices, chunk_lambdas = optimize_windows(
+        chunk_starts,
+        guidance_params.chunk_size,
+        max_chunk_detections,
+        guidance_params,
+        warm_quats,
+    )
+    blended_quats, _ = _blend_windows(
+        chunk_quats,
+        chunk_indices,
+        _get_overlap_weights(guidance_params.chunk_size, guidance_params.chunk_overlap),
+        init_quats,
+    )
+
+    seam_quats, seam_indices, seam_lambdas = optimize_windows(
+        seam_starts,
+        seam_size,
+        max_seam_detections,
+        jdc.replace(guidance_params, max_iters=guidance_params.seam_iters),
+        blended_quats,
+    )
+    blended_seam_quats, seam_coverage = _blend_windows(
+        seam_quats,
+        seam_indices,
+        _get_overlap_weights(seam_size, max(guidance_params.chunk_overlap // 2, 1)),
+        blended_quats,
+    )
+    out_quats = blended_quats + seam_coverage[:, None, None] * (
+        blended_seam_quats - blended_quats
+    )
+    out_quats = out_quats / jnp.linalg.norm(out_quats, axis=-1, keepdims=True)
+    return out_quats, {
+        "lambda": jnp.maximum(jnp.max(chunk_lambdas), jnp.max(seam_lambdas))
+    }
+
+
+def _get_chunk_and_seam_starts(
+    timesteps: int, guidance_params: JaxGuidanceParams
+) -> tuple[tuple[int, ...], tuple[int, ...]]:
+    """Get the first timestep of each chunk for chunked guidance, and of each
+    window centered on a seam between chunks. Chunks are spaced evenly, and
+    neighbors overlap by at least about `chunk_overlap` timesteps. Seam
+    windows are `2 * chunk_overlap` timesteps long."""
+    chunk_size = guidance_params.chunk_size
+    overlap = guidance_params.chunk_overlap
+    assert chunk_size is not None and chunk_size < timesteps
+    assert 0 < 2 * overlap <= chunk_size
+
+    num_chunks = -(-(timesteps - overlap) // (chunk_size - overlap))
+    chunk_starts = tuple(
+        round(i * (timesteps - chunk_size) / (num_chunks - 1))
+        for i in range(num_chunks)
+    )
+    seam_starts = tuple(
+        min(
+            max((start + next_start + chunk_size) // 2 - overlap, 0),
+            timesteps - 2 * overlap,
+        )
+        for start, next_start in zip(chunk_starts[:-1], chunk_starts[1:])
+    )
+    return chunk_starts, seam_starts
+
+
+def _count_max_window_detections(
+    detections: Sequence[dict | None], starts: Sequence[int], window_size: int
+) -> int:
+    """Count the most detections for one hand in any window. This runs
+    outside of JIT, since the count determines array shapes."""
+    counts = [1]
+    for detections_dict in detections:
+        if detections_dict is None:
+            continue
+        for key in ("detections_left_concat", "detections_right_concat"):
+            if detections_dict[key] is None:
+                continue
+            indices = onp.asarray(detections_dict[key]["indices"])
+            counts.extend(
+                int(onp.sum((indices >= start) & (indices < start + window_size)))
+                for start in starts
+            )
+    return max(counts)
+
+
+def _get_window_detections(
+    detections: dict | None,
+    start: jax.Array,
+    window_size: int,
+    max_detections: int,
+) -> dict | None:
+    """Select detections in a window of timesteps, and make their indices
+    relative to the window start. Detections are padded to `max_detections`.
+    Each side gets a `mask`, which is 0.0 for padding; see `_optimize()`."""
+    if detections is None:
+        return None
+    out = dict(detections)
+    for key in ("detections_left_concat", "detections_right_concat"):
+        side = detections[key]
+        if side is None:
+            continue
+        local_indices = side["indices"] - start
+        (selected,) = jnp.nonzero(
+            (local_indices >= 0) & (local_indices < window_size),
+            size=max_detections,
+            fill_value=-1,
+        )
+        out[key] = {k: v[jnp.maximum(selected, 0)] for k, v in side.items()}
+        out[key]["indices"] = jnp.where(
+            selected >= 0, local_indices[jnp.maximum(selected, 0)], 0
+        )
+        out[key]["mask"] = (selected >= 0).astype(jnp.float32)
+    return out
+
+
+def _get_detection_mask(detections: dict) -> jax.Array:
+    """Weight for each detection on one side: 0.0 for padding, otherwise 1.0.
+    Only windows of chunked guidance have padding."""
+    return detections.get("mask", jnp.ones(detections["indices"].shape))
+
+
+def _get_overlap_weights(window_size: int, overlap: int) -> jax.Array:
+    """Weights for blending overlapping windows, which ramp up and down over
+    `overlap` timesteps at each end. Same shape as in sampling."""
+    ramp = jnp.minimum(jnp.arange(1, window_size + 1), jnp.arange(window_size, 0, -1))
+    return jnp.minimum(overlap, ramp) / overlap
+
+
+def _blend_windows(
+    window_quats: Float[jax.Array, "windows window_size joints 4"],
+    indices: Int[jax.Array, "windows window_size"],
+    weights: Float[jax.Array, "window_size"],
+    reference_quats: Float[jax.Array, "time joints 4"],
+) -> tuple[Float[jax.Array, "time joints 4"], Float[jax.Array, "time"]]:
+    """Blend windows of quaternions with a normalized weighted sum, after
+    flipping them to the same hemisphere as `reference_quats`. Timesteps
+    outside of every window are taken from `reference_quats`. Also returns
+    the largest weight at each timestep, which is zero outside of windows."""
+    timesteps = reference_quats.shape[0]
+    weights = jnp.broadcast_to(weights, indices.shape).astype(window_quats.dtype)
+    window_quats = jnp.where(
+        jnp.sum(window_quats * reference_quats[indices], axis=-1, keepdims=True) < 0.0,
+        -window_quats,
+        window_quats,
+    )
+    weighted_sum = (
+        jnp.zeros_like(reference_quats)
+        .at[indices]
+        .add(weights[:, :, None, None] * window_quats)
+    )
+    coverage = jnp.zeros((timesteps,), weights.dtype).at[indices].max(weights)
+    norm = jnp.linalg.norm(weighted_sum, axis=-1, keepdims=True)
+    blended = jnp.where(
+        coverage[:, None, None] > 0.0,
+        weighted_sum / jnp.maximum(norm, 1e-12),
+        reference_quats,
+    )
+    return blended, coverage
+
+
+def _optimize_block_banded(
+    factors: list[tuple[Callable[..., jax.Array], tuple]],
+    init_body_quats: jax.Array,
+    init_hand_quats: jax.Array,
+    lambda_initial: jax.Array,
+    guidance_params: JaxGuidanceParams,
+    verbose: bool,
+) -> tuple[jax.Array, jax.Array, jax.Array]:
+    """Levenberg-Marquardt, with steps from a direct solve of the normal
+    equations. jaxls linear solvers aren't pluggable, so this replaces
+    `jaxls.LeastSquaresProblem.solve()`.
+
+    Variables are grouped by timestep: each timestep has a body pose and, if
+    any cost uses them, two hand poses. Costs only couple timesteps up to
+    `_MAX_TIMESTEP_OFFSET` apart, so the normal equations are block-banded.
+    Couplings across more timesteps would be dropped. Steps that increase the
+    cost are rejected. Returns optimized body and hand poses, and the final
+    damping."""
+    timesteps = init_body_quats.shape[0]
+    assert init_body_quats.shape == (timesteps, 21, 4)
+    assert init_hand_quats.shape == (timesteps * 2, 15, 4)
+    include_hands = any(
+        isinstance(arg, _SmplhSingleHandPosesVar) for _, args in factors for arg in args
+    )
+
+    def retract(
+        body_quats: jax.Array, hand_quats: jax.Array, delta: jax.Array
+    ) -> tuple[jax.Array, jax.Array]:
+        body_quats = _retract_quats(body_quats, delta[:, : 21 * 3])
+        if include_hands:
+            hand_quats = _retract_quats(
+                hand_quats, delta[:, 21 * 3 :].reshape((timesteps * 2, 15 * 3))
+            )
+        return body_quats, hand_quats
+
+    # Iteration count, poses, damping, and whether we've converged.
+    State = tuple[jax.Array, jax.Array, jax.Array, jax.Array, jax.Array]
+
+    def step(state: State) -> State:
+        i, body_quats, hand_quats, lambd, _ = state
+        cost, gradient, band = _linearize_costs(
+            factors, body_quats, hand_quats, include_hands
+        )
+        diag = jnp.diagonal(band[:, 0], axis1=-2, axis2=-1)
+        band = band.at[:, 0].add(
+            lambd * jax.vmap(jnp.diag)(jnp.maximum(diag, _MIN_DAMPING_DIAGONAL))
+        )
+        delta = solve_block_banded(band, -gradient)
+        new_body_quats, new_hand_quats = retract(body_quats, hand_quats, delta)
+        new_cost = _compute_cost(factors, new_body_quats, new_hand_quats)
+        if verbose:
+            jax.debug.print(
+                "step {i}: cost={cost}, new cost={new_cost}, lambda={lambd}",
+                i=i,
+                cost=cost,
+                new_cost=new_cost,
+                lambd=lambd,
+            )
+        accept = new_cost < cost
+        return (
+            i + 1,
+            jnp.where(accept, new_body_quats, body_quats),
+            jnp.where(accept, new_hand_quats, hand_quats),
+            jnp.clip(
+                jnp.where(accept, lambd / 2.0, lambd * 2.0), _MIN_LAMBDA, _MAX_LAMBDA
+            ),
+            accept & (cost - new_cost < guidance_params.cost_tolerance * cost),
+        )
+
+    _, body_quats, hand_quats, lambd, _ = jax.lax.while_loop(
+        lambda state: (state[0] < guidance_params.max_iters) & ~state[4],
+        step,
+        (
+            jnp.zeros((), jnp.int32),
+            init_body_quats,
+            init_hand_quats,
+            lambda_initial,
+            jnp.zeros((), bool),
+        ),
+    )
+    return body_quats, hand_quats, lambd
+
+
+_MAX_TIMESTEP_OFFSET = 2
+"""Costs couple variables up to this many timesteps apart."""
+
+_MIN_DAMPING_DIAGONAL = 1e-6
+"""Lower bound for normal equation diagonals, when scaled for damping."""
+
+_MIN_LAMBDA = 1e-5
+_MAX_LAMBDA = 1e10
+"""Bounds for the damping factor, which is halved or doubled after each step.
+These match jaxls defaults."""
+
+_LINEARIZE_BATCH_SIZE = 256
+"""Number of cost terms to linearize at a time."""
+
+_VAR_SLOTS: dict[type, int] = {_SmplhBodyPosesVar: 1, _SmplhSingleHandPosesVar: 2}
+"""Number of variables of each type per timestep."""
+
+_VAR_TANGENT_DIMS: dict[type, int] = {
+    _SmplhBodyPosesVar: 21 * 3,
+    _SmplhSingleHandPosesVar: 15 * 3,
+}
+
+
+def _retract_quats(quats: jax.Array, delta: jax.Array) -> jax.Array:
+    """Same as the `retract_fn` of the pose variables, for any number of
+    joints and batch axes."""
+    return (
+        jaxlie.SO3(quats) @ jaxlie.SO3.exp(delta.reshape(quats.shape[:-1] + (3,)))
+    ).wxyz
+
+
+class _VarValuesByIdentity:
+    """Drop-in for `jaxls.VarValues` in residual functions, where values are
+    looked up by variable object identity. This lets us differentiate each
+    cost with respect to its own variables."""
+
+    def __init__(self, variables: Sequence[jaxls.Var], values: Sequence[jax.Array]):
+        self._variables = variables
+        self._values = values
+
+    def __getitem__(self, var: jaxls.Var) -> jax.Array:
+        for v, value in zip(self._variables, self._values):
+            if v is var:
+                return value
+        raise KeyError(var)
+
+
+def _get_var_value(
+    var: jaxls.Var, body_quats: jax.Array, hand_quats: jax.Array
+) -> jax.Array:
+    if isinstance(var, _SmplhBodyPosesVar):
+        return body_quats[var.id]
+    elif isinstance(var, _SmplhSingleHandPosesVar):
+        return hand_quats[var.id]
+    else:
+        assert False
+
+
+def _get_var_timestep_and_slot(var: jaxls.Var) -> tuple[jax.Array, jax.Array]:
+    """Get the timestep of a variable, and its index among variables of the
+    same type at that timestep. Left hands are slot 0, right hands slot 1."""
+    if isinstance(var, _SmplhBodyPosesVar):
+        return var.id, jnp.zeros_like(var.id)
+    elif isinstance(var, _SmplhSingleHandPosesVar):
+        return var.id // 2, var.id % 2
+    else:
+        assert False
+
+
+def _get_var_arg_indices(args: tuple) -> tuple[int, ...]:
+    return tuple(
+        i
+        for i, arg in enumerate(args)
+        if isinstance(arg, (_SmplhBodyPosesVar, _SmplhSingleHandPosesVar))
+    )
+
+
+def _compute_cost(
+    factors: list[tuple[Callable[..., jax.Array], tuple]],
+    body_quats: jax.Array,
+    hand_quats: jax.Array,
+) -> jax.Array:
+    """Sum of squared residuals."""
+    cost = jnp.zeros((), body_quats.dtype)
+    for cost_func, args in factors:
+        var_indices = _get_var_arg_indices(args)
+
+        def residual(*args: Any) -> jax.Array:
+            variables = [args[i] for i in var_indices]
+            values = [_get_var_value(v, body_quats, hand_quats) for v in variables]
+            return cost_func(_VarValuesByIdentity(variables, values), *args)
+
+        cost = cost + jnp.sum(jax.vmap(residual)(*args) ** 2)
+    return cost
+
+
+def _linearize_costs(
+    factors: list[tuple[Callable[..., jax.Array], tuple]],
+    body_quats: jax.Array,
+    hand_quats: jax.Array,
+    include_hands: bool,
+) -> tuple[jax.Array, jax.Array, jax.Array]:
+    """Compute the sum of squared residuals, the gradient `J^T r`, and the
+    block-banded Gauss-Newton matrix `J^T J`. Blocks are per-timestep, and
+    `band[t, j]` is the block between timesteps `t` and `t + j`."""
+    timesteps = body_quats.shape[0]
+    var_types = (_SmplhBodyPosesVar,) + (
+        (_SmplhSingleHandPosesVar,) if include_hands else ()
+    )
+    num_segments = timesteps * (_MAX_TIMESTEP_OFFSET + 1)
+
+    # Gradients and Gauss-Newton blocks are accumulated separately for each
+    # variable type, and for each pair of variable types.
+    cost = jnp.zeros((), body_quats.dtype)
+    gradients = {
+        var_type: jnp.zeros(
+            (timesteps * _VAR_SLOTS[var_type], _VAR_TANGENT_DIMS[var_type]),
+            body_quats.dtype,
+        )
+        for var_type in var_types
+    }
+    blocks = {
+        (type_a, type_b): jnp.zeros(
+            (
+                num_segments * _VAR_SLOTS[type_a] * _VAR_SLOTS[type_b],
+                _VAR_TANGENT_DIMS[type_a],
+                _VAR_TANGENT_DIMS[type_b],
+            ),
+            body_quats.dtype,
+        )
+        for type_a in var_types
+        for type_b in var_types
+    }
+    for cost_func, args in factors:
+        var_indices = _get_var_arg_indices(args)
+
+        def linearize(*args: Any) -> tuple[jax.Array, list[jax.Array]]:
+            variables = [args[i] for i in var_indices]
+            values = [_get_var_value(v, body_quats, hand_quats) for v in variables]
+
+            def residual(deltas: list[jax.Array]) -> jax.Array:
+                retracted = [_retract_quats(x, dx) for x, dx in zip(values, deltas)]
+                return cost_func(_VarValuesByIdentity(variables, retracted), *args)
+
+            # Differentiate in whichever direction needs fewer passes.
+            deltas = [jnp.zeros(x.shape[0] * 3, x.dtype) for x in values]
+            (residual_dim,) = jax.eval_shape(residual, deltas).shape
+            jac_fn = (
+                jax.jacrev
+                if residual_dim < sum(d.shape[0] for d in deltas)
+                else jax.jacfwd
+            )
+            return residual(deltas), jac_fn(residual)(deltas)
+
+        # Linearize in chunks, to bound memory use for long sequences.
+        residuals, jacobians = jax.lax.map(
+            lambda args: linearize(*args), args, batch_size=_LINEARIZE_BATCH_SIZE
+        )
+        cost = cost + jnp.sum(residuals**2)
+
+        variables = [args[i] for i in var_indices]
+        timesteps_and_slots = [_get_var_timestep_and_slot(v) for v in variables]
+        for var_a, jac_a, (t_a, slot_a) in zip(
+            variables, jacobians, timesteps_and_slots
+        ):
+            type_a = type(var_a)
+            gradients[type_a] = gradients[type_a] + jax.ops.segment_sum(
+                jnp.einsum("nri,nr->ni", jac_a, residuals),
+                t_a * _VAR_SLOTS[type_a] + slot_a,
+                num_segments=timesteps * _VAR_SLOTS[type_a],
+            )
+            for var_b, jac_b, (t_b, slot_b) in zip(
+                variables, jacobians, timesteps_and_slots
+            ):
+                # Only blocks on or above the diagonal are stored. Others are
+                # dropped by `segment_sum()`, via out-of-range segment IDs.
+                type_b = type(var_b)
+                t_offset = t_b - t_a
+                in_band = (t_offset >= 0) & (t_offset <= _MAX_TIMESTEP_OFFSET)
+                segment_ids = (
+                    (t_a * (_MAX_TIMESTEP_OFFSET + 1) + t_offset) * _VAR_SLOTS[type_a]
+                    + slot_a
+                ) * _VAR_SLOTS[type_b] + slot_b
+                num_block_segments = blocks[type_a, type_b].shape[0]
+                blocks[type_a, type_b] = blocks[type_a, type_b] + jax.ops.segment_sum(
+                    jnp.einsum("nri,nrj->nij", jac_a, jac_b),
+                    jnp.where(in_band, segment_ids, num_block_segments),
+                    num_segments=num_block_segments,
+                )
+
+    # Assemble per-timestep gradients and blocks. Body poses come first, then
+    # left and right hands.
+    gradient = jnp.concatenate(
+        [gradients[var_type].reshape((timesteps, -1)) for var_type in var_types],
+        axis=-1,
+    )
+    band = jnp.concatenate(
+        [
+            jnp.concatenate(
+                [
+                    _reshape_band_blocks(
+                        blocks[type_a, type_b], timesteps, type_a, type_b
+                    )
+                    for type_b in var_types
+                ],
+                axis=-1,
+            )
+            for type_a in var_types
+        ],
+        axis=-2,
+    )
+    return cost, gradient, band
+
+
+def _reshape_band_blocks(
+    blocks: jax.Array, timesteps: int, type_a: type, type_b: type
+) -> jax.Array:
+    """Reshape Gauss-Newton blocks between two variable types from
+    `(timesteps * offsets * slots_a * slots_b, dim_a, dim_b)` to
+    `(timesteps, offsets, slots_a * dim_a, slots_b * dim_b)`."""
+    slots_a, slots_b = _VAR_SLOTS[type_a], _VAR_SLOTS[type_b]
+    dim_a, dim_b = _VAR_TANGENT_DIMS[type_a], _VAR_TANGENT_DIMS[type_b]
+    return (
+        blocks.reshape(
+            (timesteps, _MAX_TIMESTEP_OFFSET + 1, slots_a, slots_b, dim_a, dim_b)
+        )
+        .swapaxes(3, 4)
+        .reshape(
+            (timesteps, _MAX_TIMESTEP_OFFSET + 1, slots_a * dim_a, slots_b * dim_b)
+        )
+    )
+
+
+def _get_mano_from_openpose_indices(include_tips: bool) -> Int[onp.ndarray, "21"]:
+    # https://github.com/geopavlakos/hamer/blob/272d68f176e0ea8a506f761663dd3dca4a03ced0/hamer/models/mano_wrapper.py#L20
+    # fmt: off
+    mano_to_openpose = [0, 13, 14, 15, 16, 1, 2, 3, 17, 4, 5, 6, 18, 10, 11, 12, 19, 7, 8, 9, 20]
+    # fmt: on
+    openpose_from_mano_idx = {
+        mano_idx: openpose_idx for openpose_idx, mano_idx in enumerate(mano_to_openpose)
+    }
+    return onp.array(
+        [openpose_from_mano_idx[i] for i in range(21 if include_tips else 16)]
+    )
@@ -8,7 +8,7 @@ from __future__ import annotations
 
 import pickle
 from pathlib import Path
-from typing import Protocol, TypedDict, cast
+from typing import Protocol, Sequence, TypedDict, cast
 
 import numpy as np
 import torch
@@ -64,6 +64,40 @@ class CorrespondedAriaHandWristPoseDetections(TensorDataclass):
     detections_left_concat: AriaHandWristPoseWrtWorld | None
     detections_right_concat: AriaHandWristPoseWrtWorld | None
 
+    def slice(
+        self, start_index: int, end_index: int
+    ) -> CorrespondedAriaHandWristPoseDetections:
+        """Slice the wrist detections. Removes unused detections, and shifts
+        indices as necessary."""
+        assert start_index < end_index
+        return CorrespondedAriaHandWristPoseDetections(
+            detections_left_concat=_slice_indexed(
+                self.detections_left_concat, start_index, end_index
+            ),
+            detections_right_concat=_slice_indexed(
+                self.detections_right_concat, start_index, end_index
+            ),
+        )
+
+    @staticmethod
+    def concatenate(
+        parts: Sequence[CorrespondedAriaHandWristPoseDetections],
+        lengths: Sequence[int],
+    ) -> CorrespondedAriaHandWristPoseDetections:
+        """Concatenate detections through time. Since the detections don't
+        store the number of timesteps they cover, we need `lengths` to offset
+        indices."""
+        assert len(parts) == len(lengths) > 0
+        offsets = np.cumsum([0, *lengths[:-1]]).tolist()
+        return CorrespondedAriaHandWristPoseDetections(
+            detections_left_concat=_concatenate_indexed(
+                [p.detections_left_concat for p in parts], offsets
+            ),
+            detections_right_concat=_concatenate_indexed(
+                [p.detections_right_concat for p in parts], offsets
+            ),
+        )
+
     @staticmethod
     def load(
         wrist_and_palm_poses_csv_path: Path,
@@ -229,6 +263,28 @@ class CorrespondedHamerDetections(TensorDataclass):
             ),
         )
 
+    @staticmethod
+    def concatenate(
+        parts: Sequence[CorrespondedHamerDetections],
+    ) -> CorrespondedHamerDetections:
+        """Concatenate hand detections through time. Inverse of `slice()`."""
+        assert len(parts) > 0
+        offsets = np.cumsum([0, *[p.get_length() for p in parts[:-1]]]).tolist()
+        return CorrespondedHamerDetections(
+            parts[0].mano_faces_right,
+            parts[0].mano_faces_left,
+            sum((p.detections_left_tuple for p in parts), start=()),
+            sum((p.detections_right_tuple for p in parts), start=()),
+            T_cpf_cam=parts[0].T_cpf_cam,
+            focal_length=parts[0].focal_length,
+            detections_left_concat=_concatenate_indexed(
+                [p.detections_left_concat for p in parts], offsets
+            ),
+            detections_right_concat=_concatenate_indexed(
+                [p.detections_right_concat for p in parts], offsets
+            ),
+        )
+
     @staticmethod
     def load(
         hand_pkl_path: Path,
@@ -426,3 +482,44 @@ class CorrespondedHamerDetections(TensorDataclass):
                 detections_right, detections_left
             ),
         )
+
+
+def _slice_indexed[
+    T: (AriaHandWristPoseWrtWorld, SingleHandHamerOutputWrtCameraConcatenated)
+](detections: T | None, start_index: int, end_index: int) -> T | None:
+    """Slice concatenated detections by timestep index."""
+    if detections is None:
+        return None
+    indices_mask = (detections.indices >= start_index) & (
+        detections.indices < end_index
+    )
+    if not torch.any(indices_mask):
+        return None
+    out = detections.map(lambda x: x[indices_mask].clone())
+    out.indices -= start_index
+    return out
+
+
+def _concatenate_indexed[
+    T: (AriaHandWristPoseWrtWorld, SingleHandHamerOutputWrtCameraConcatenated)
+](parts: Sequence[T | None], offsets: Sequence[int]) -> T | None:
+    """Concatenate detections through time, offsetting timestep indices."""
+    assert len(parts) == len(offsets)
+    not_none = [
+        (part, offset) for part, offset in zip(parts, offsets) if part is not None
+    ]
+    if len(not_none) == 0:
+        return None
+    part_type = type(not_none[0][0])
+    return part_type(
+        **{
+            k: torch.cat(
+                [
+                    getattr(part, k) + offset if k == "indices" else getattr(part, k)
+                    for part, offset in not_none
+                ],
+                dim=0,
+            )
+            for k in vars(not_none[0][0]).keys()
+        }
+    )
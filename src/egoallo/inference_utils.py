@@ -14,13 +14,42 @@ from projectaria_tools.core.data_provider import create_vrs_data_provider
 from safetensors import safe_open
 from torch import Tensor
 
-from .network import EgoDenoiser, EgoDenoiserConfig
+from .network import (
+    EgoDenoiser,
+    EgoDenoiserConfig,
+    InferencePrecision,
+    fuse_modality_heads_state_dict,
+)
 from .tensor_dataclass import TensorDataclass
 from .transforms import SE3
 
 
-def load_denoiser(checkpoint_dir: Path) -> EgoDenoiser:
-    """Load a denoiser model."""
+def load_denoiser(
+    checkpoint_dir: Path,
+    precision: InferencePrecision = "float32",
+    quantize_int8: bool = False,
+    cache_quantized: bool = True,
+    fused_modality_heads: bool = False,
+) -> EgoDenoiser:
+    """Load a denoiser model. See `EgoDenoiser.inference_precision` for
+    `precision`.
+
+    If `quantize_int8` is True, every `nn.Linear` layer is dynamically
+    quantized to int8: weights are stored in int8, and activations are
+    quantized on the fly. This speeds up CPU inference, and isn't supported on
+    GPUs. If `cache_quantized` is True, quantized weights are saved next to
+    `model.safetensors` and reused by later calls.
+
+    See `benchmarks/int8_quantization_parity.py` for comparing quantized
+    outputs to the float32 model.
+
+    If `fused_modality_heads` is True, the checkpoint's per-modality encoders
+    and decoders are converted to `FusedModalityEncoders` and
+    `FusedModalityDecoders`. Their batched matrix multiplies aren't quantized.
+    """
+    assert not (quantize_int8 and precision != "float32"), (
+        "int8 quantization can't be combined with reduced precision autocast."
+    )
     checkpoint_dir = checkpoint_dir.absolute()
     experiment_dir = checkpoint_dir.parent
 
@@ -29,11 +58,63 @@ def load_denoiser(checkpoint_dir: Path) -> EgoDenoiser:
     )
     assert isinstance(config, EgoDenoiserConfig)
 
-    model = EgoDenoiser(config)
-    with safe_open(checkpoint_dir / "model.safetensors", framework="pt") as f:  # type: ignore
+    model = EgoDenoiser(config, fused_modality_heads=fused_modality_heads)
+    weights_path = checkpoint_dir / "model.safetensors"
+    quantized_path = checkpoint_dir / (
+        QUANTIZED_FUSED_WEIGHTS_FILENAME
+        if fused_modality_heads
+        else QUANTIZED_WEIGHTS_FILENAME
+    )
+    if (
+        quantize_int8
+        and cache_quantized
+        and quantized_path.exists()
+        # Re-quantize if the float32 weights have changed.
+        and quantized_path.stat().st_mtime >= weights_path.stat().st_mtime
+    ):
+        model = quantize_denoiser_int8(model)
+        model.load_state_dict(torch.load(quantized_path, weights_only=True))
+        return model
+
+    with safe_open(weights_path, framework="pt") as f:  # type: ignore
         state_dict = {k: f.get_tensor(k) for k in f.keys()}
+    if fused_modality_heads:
+        state_dict = fuse_modality_heads_state_dict(state_dict, config.include_hands)
     model.load_state_dict(state_dict)
+    model.inference_precision = precision
+
+    if quantize_int8:
+        model = quantize_denoiser_int8(model)
+        if cache_quantized:
+            try:
+                torch.save(model.state_dict(), quantized_path)
+            except OSError as e:
+                print(f"Failed to cache quantized weights to {quantized_path}: {e}")
+
+    return model
 
+
+QUANTIZED_WEIGHTS_FILENAME = "model_int8_dynamic.pt"
+"""Filename for cached int8 weights, which are placed next to `model.safetensors`."""
+QUANTIZED_FUSED_WEIGHTS_FILENAME = "model_int8_dynamic_fused.pt"
+"""Filename for cached int8 weights with fused modality heads."""
+
+
+def quantize_denoiser_int8(model: EgoDenoiser) -> EgoDenoiser:
+    """Dynamically quantize a denoiser's `nn.Linear` layers to int8. This
+    covers the modality encoders and decoders, the conditioning and noise
+    token projections, and the attention and MLP layers in each transformer
+    block. The noise embedding table is a lookup, so it's left in float32.
+
+    Quantized layers run on CPU only. Autocast isn't supported, so the model
+    must use float32 inference precision."""
+    assert model.inference_precision == "float32", (
+        "int8 quantization can't be combined with autocast."
+    )
+    model = torch.ao.quantization.quantize_dynamic(
+        model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    assert isinstance(model, EgoDenoiser)
     return model
 
 
@@ -6,7 +6,11 @@ from jaxtyping import Float
 from torch import Tensor
 from typing_extensions import assert_never
 
-from .transforms import SO3
+from . import fncsmpl
+from .data.dataclass import EgoTrainingData
+from .fncsmpl_extensions import get_T_world_root_from_cpf_pose
+from .network import EgoDenoiseTraj
+from .transforms import SE3, SO3
 
 
 def compute_foot_skate(
@@ -156,6 +160,70 @@ def compute_mpjpe(
     return mpjpe.cpu().numpy()
 
 
+def compute_body_metrics(
+    body_model: fncsmpl.SmplhModel,
+    sequence: EgoTrainingData,
+    samples: EgoDenoiseTraj,
+) -> dict[str, np.ndarray]:
+    """Compute body metrics for a set of samples. `sequence` should include
+    the extra leading timestep used to compute relative CPF poses. Each metric
+    has shape (num_samples,)."""
+    assert samples.hand_rotmats is not None
+    assert sequence.hand_quats is not None
+
+    # We'll only use the body joint rotations.
+    pred_posed = body_model.with_shape(samples.betas).with_pose(
+        T_world_root=SE3.identity(samples.betas.device, torch.float32).wxyz_xyz,
+        local_quats=SO3.from_matrix(
+            torch.cat([samples.body_rotmats, samples.hand_rotmats], dim=2)
+        ).wxyz,
+    )
+    pred_posed = pred_posed.with_new_T_world_root(
+        get_T_world_root_from_cpf_pose(pred_posed, sequence.T_world_cpf[1:, ...])
+    )
+
+    label_posed = body_model.with_shape(sequence.betas[1:, ...]).with_pose(
+        sequence.T_world_root[1:, ...],
+        torch.cat(
+            [
+                sequence.body_quats[1:, ...],
+                sequence.hand_quats[1:, ...],
+            ],
+            dim=1,
+        ),
+    )
+
+    return {
+        "mpjpe": compute_mpjpe(
+            label_T_world_root=label_posed.T_world_root,
+            label_Ts_world_joint=label_posed.Ts_world_joint[:, :21, :],
+            pred_T_world_root=pred_posed.T_world_root,
+            pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
+            per_frame_procrustes_align=False,
+        ),
+        "pampjpe": compute_mpjpe(
+            label_T_world_root=label_posed.T_world_root,
+            label_Ts_world_joint=label_posed.Ts_world_joint[:, :21, :],
+            pred_T_world_root=pred_posed.T_world_root,
+            pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
+            per_frame_procrustes_align=True,
+        ),
+        # We didn't report foot skating metrics in the paper. It's not
+        # really meaningful: since we optimize foot skating in the
+        # guidance optimizer, it's easy to "cheat" this metric.
+        "foot_skate": compute_foot_skate(
+            pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
+        ),
+        "foot_contact (GND)": compute_foot_contact(
+            pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
+        ),
+        "T_head": compute_head_trans(
+            label_Ts_world_joint=label_posed.Ts_world_joint[:, :21, :],
+            pred_Ts_world_joint=pred_posed.Ts_world_joint[:, :, :21, :],
+        ),
+    }
+
+
 @overload
 def procrustes_align(
     points_y: Float[Tensor, "*#batch N 3"],
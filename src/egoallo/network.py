@@ -1,11 +1,13 @@
 from __future__ import annotations
 
+import contextlib
 from dataclasses import dataclass
-from functools import cache, cached_property
-from typing import Literal, assert_never
+from functools import cache, cached_property, partial
+from typing import ContextManager, Literal, assert_never
 
 import numpy as np
 import torch
+import torch.utils.checkpoint
 from einops import rearrange
 from jaxtyping import Bool, Float
 from loguru import logger
@@ -17,14 +19,150 @@ from .tensor_dataclass import TensorDataclass
 from .transforms import SE3, SO3
 
 
+InferencePrecision = Literal["float32", "bfloat16", "float16"]
+"""Precision for running the denoiser's layers at inference time."""
+
+
+@dataclass(frozen=True)
+class LocalAttentionConfig:
+    """Banded attention for long sequences. See `EgoDenoiser.local_attention`."""
+
+    block_size: int = 64
+    """Number of timesteps in each block of queries."""
+    context_size: int = 32
+    """Number of timesteps on each side of a block that its queries can also
+    attend to. At most `block_size`."""
+
+    def __post_init__(self) -> None:
+        assert self.block_size >= 1
+        assert 0 <= self.context_size <= self.block_size
+
+
 def project_rotmats_via_svd(
     rotmats: Float[Tensor, "*batch 3 3"],
 ) -> Float[Tensor, "*batch 3 3"]:
-    u, s, vh = torch.linalg.svd(rotmats)
+    """Reference for `project_to_so3()`. Slow for large batches of small
+    matrices, especially on CPU."""
+    # SVD is sensitive to rounding, so we always run it in at least float32,
+    # even under autocast.
+    with torch.autocast(rotmats.device.type, enabled=False):
+        u, s, vh = torch.linalg.svd(
+            rotmats.to(torch.promote_types(rotmats.dtype, torch.float32))
+        )
     del s
+    # Flip the last singular vector if needed, so we get a rotation instead
+    # of a reflection.
+    sign = torch.sign(torch.linalg.det(torch.einsum("...ij,...jk->...ik", u, vh)))
+    u = torch.cat([u[..., :2], u[..., 2:] * sign[..., None, None]], dim=-1)
     return torch.einsum("...ij,...jk->...ik", u, vh)
 
 
+def project_to_so3(
+    rotmats: Float[Tensor, "*batch 3 3"], newton_iters: int = 12
+) -> Float[Tensor, "*batch 3 3"]:
+    """Project matrices to the closest rotation matrices, in Frobenius norm.
+    Matches `project_rotmats_via_svd()`, but is much faster for large batches
+    of 3x3 matrices.
+
+    The closest rotation to `M` maximizes `tr(R^T M)`. Writing `R` as a unit
+    quaternion `q`, this is `q^T K q` for a symmetric 4x4 matrix `K`, so `q`
+    is the eigenvector of `K` with the largest eigenvalue. We find the
+    eigenvalue with Newton's method on the characteristic polynomial, starting
+    from an upper bound, and the eigenvector from the adjugate of
+    `K - lambda * I`. Outputs always have a determinant of +1, and only
+    elementwise arithmetic is used."""
+    with torch.autocast(rotmats.device.type, enabled=False):
+        m = rotmats.to(torch.promote_types(rotmats.dtype, torch.float32))
+        m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+        m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+        m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+        K = torch.stack(
+            [
+                m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01,
+                m21 - m12, m00 - m11 - m22, m01 + m10, m02 + m20,
+                m02 - m20, m01 + m10, m11 - m00 - m22, m12 + m21,
+                m10 - m01, m02 + m20, m12 + m21, m22 - m00 - m11,
+            ],
+            dim=-1,
+        ).reshape((*m.shape[:-2], 4, 4))  # fmt: skip
+
+        # `K` is traceless, so its characteristic polynomial is
+        # `lambda^4 + c2 * lambda^2 + c1 * lambda + c0`.
+        frobenius_sq = torch.sum(m**2, dim=(-2, -1))
+        det_m = (
+            m00 * (m11 * m22 - m12 * m21)
+            - m01 * (m10 * m22 - m12 * m20)
+            + m02 * (m10 * m21 - m11 * m20)
+        )
+        c2 = -2.0 * frobenius_sq
+        c1 = -8.0 * det_m
+        c0 = torch.sum(K[..., 0, :] * _adjugate_4x4(K)[..., :, 0], dim=-1)
+
+        # The largest eigenvalue is a sum of singular values of `m`, so it's
+        # at most sqrt(3) times the Frobenius norm. Newton's method converges
+        # monotonically from above.
+        lam = torch.sqrt(3.0 * frobenius_sq)
+        for _ in range(newton_iters):
+            lam_sq = lam**2
+            value = (lam_sq + c2) * lam_sq + c1 * lam + c0
+            deriv = (4.0 * lam_sq + 2.0 * c2) * lam + c1
+            lam = torch.where(deriv != 0.0, lam - value / deriv, lam)
+
+        # The adjugate of `K - lambda * I` is proportional to `q q^T`. We take
+        # the column with the largest diagonal entry, which is the best
+        # conditioned.
+        adj = _adjugate_4x4(K - lam[..., None, None] * torch.eye(4, device=m.device))
+        index = torch.argmax(torch.abs(torch.diagonal(adj, dim1=-2, dim2=-1)), dim=-1)
+        q = torch.take_along_dim(adj, index[..., None, None], dim=-1)[..., 0]
+
+        # Fall back to identity if `m` is all zeros.
+        q = torch.where(
+            torch.sum(q**2, dim=-1, keepdim=True) > 0.0, q, q.new_tensor([1, 0, 0, 0])
+        )
+        return SO3(q).as_matrix()
+
+
+def _adjugate_4x4(a: Float[Tensor, "*batch 4 4"]) -> Float[Tensor, "*batch 4 4"]:
+    """Adjugate of 4x4 matrices, via 2x2 minors of the top and bottom rows."""
+    a00, a01, a02, a03 = a[..., 0, 0], a[..., 0, 1], a[..., 0, 2], a[..., 0, 3]
+    a10, a11, a12, a13 = a[..., 1, 0], a[..., 1, 1], a[..., 1, 2], a[..., 1, 3]
+    a20, a21, a22, a23 = a[..., 2, 0], a[..., 2, 1], a[..., 2, 2], a[..., 2, 3]
+    a30, a31, a32, a33 = a[..., 3, 0], a[..., 3, 1], a[..., 3, 2], a[..., 3, 3]
+    s0 = a00 * a11 - a10 * a01
+    s1 = a00 * a12 - a10 * a02
+    s2 = a00 * a13 - a10 * a03
+    s3 = a01 * a12 - a11 * a02
+    s4 = a01 * a13 - a11 * a03
+    s5 = a02 * a13 - a12 * a03
+    c5 = a22 * a33 - a32 * a23
+    c4 = a21 * a33 - a31 * a23
+    c3 = a21 * a32 - a31 * a22
+    c2 = a20 * a33 - a30 * a23
+    c1 = a20 * a32 - a30 * a22
+    c0 = a20 * a31 - a30 * a21
+    return torch.stack(
+        [
+            a11 * c5 - a12 * c4 + a13 * c3,
+            -a01 * c5 + a02 * c4 - a03 * c3,
+            a31 * s5 - a32 * s4 + a33 * s3,
+            -a21 * s5 + a22 * s4 - a23 * s3,
+            -a10 * c5 + a12 * c2 - a13 * c1,
+            a00 * c5 - a02 * c2 + a03 * c1,
+            -a30 * s5 + a32 * s2 - a33 * s1,
+            a20 * s5 - a22 * s2 + a23 * s1,
+            a10 * c4 - a11 * c2 + a13 * c0,
+            -a00 * c4 + a01 * c2 - a03 * c0,
+            a30 * s4 - a31 * s2 + a33 * s0,
+            -a20 * s4 + a21 * s2 - a23 * s0,
+            -a10 * c3 + a11 * c1 - a12 * c0,
+            a00 * c3 - a01 * c1 + a02 * c0,
+            -a30 * s3 + a31 * s1 - a32 * s0,
+            a20 * s3 - a21 * s1 + a22 * s0,
+        ],
+        dim=-1,
+    ).reshape(a.shape)
+
+
 class EgoDenoiseTraj(TensorDataclass):
     """Data structure for denoising. Contains tensors that we are denoising, as
     well as utilities for packing + unpacking them."""
@@ -86,7 +224,7 @@ class EgoDenoiseTraj(TensorDataclass):
 
         Args:
             x: Packed trajectory.
-            project_rotmats: If True, project the rotation matrices to SO(3) via SVD.
+            project_rotmats: If True, project the body rotation matrices to SO(3).
         """
         (*batch, time, d_state) = x.shape
         assert d_state == cls.get_packed_dim(include_hands)
@@ -107,8 +245,7 @@ class EgoDenoiseTraj(TensorDataclass):
             assert betas.shape == (*batch, time, 16)
 
         if project_rotmats:
-            # We might want to handle the -1 determinant case as well.
-            body_rotmats = project_rotmats_via_svd(body_rotmats)
+            body_rotmats = project_to_so3(body_rotmats)
 
         return EgoDenoiseTraj(
             betas=betas,
@@ -118,6 +255,19 @@ class EgoDenoiseTraj(TensorDataclass):
         )
 
 
+def get_modality_dims(include_hands: bool) -> dict[str, int]:
+    """Flattened dimension of each modality in a packed trajectory, in the
+    order they're packed."""
+    modality_dims: dict[str, int] = {
+        "betas": 16,
+        "body_rotmats": 21 * 9,
+        "contacts": 21,
+    }
+    if include_hands:
+        modality_dims["hand_rotmats"] = 30 * 9
+    return modality_dims
+
+
 @dataclass(frozen=True)
 class EgoDenoiserConfig:
     max_t: int = 1000
@@ -313,47 +463,75 @@ class EgoDenoiser(nn.Module):
     Output is denoised trajectory.
     """
 
-    def __init__(self, config: EgoDenoiserConfig):
+    def __init__(self, config: EgoDenoiserConfig, fused_modality_heads: bool = False):
+        """If `fused_modality_heads` is True, the per-modality MLP encoders and
+        decoders are replaced by `FusedModalityEncoders` and
+        `FusedModalityDecoders`, which are faster for inference. Existing
+        checkpoints can be converted with `fuse_modality_heads_state_dict()`."""
         super().__init__()
 
         self.config = config
+        self.inference_precision: InferencePrecision = "float32"
+        """Precision for inference. For "bfloat16" and "float16", the
+        transformer blocks run under `torch.autocast`. Conditioning, noise
+        embeddings, the per-modality encoders and decoders, rotation
+        projection, and everything outside of the denoiser stay in float32.
+        Weights aren't converted."""
+        self.local_attention: LocalAttentionConfig | None = None
+        """If set, `forward()` restricts attention to a local band, so a long
+        sequence can be denoised in one pass with memory that's linear in its
+        length. Timesteps are split into blocks that each get their own copy
+        of the noise token, and attend to `context_size` extra timesteps on
+        each side. Rotary embeddings are applied within this span, so each
+        block looks like a window of `block_size + 2 * context_size`
+        timesteps to the model. Requires rotary embeddings; conditioning
+        parameterizations that depend on the first frame ("canonicalized")
+        won't generalize to long sequences."""
+        self.activation_checkpointing: bool = False
+        """If True, activations inside each transformer block are recomputed
+        during the backward pass instead of being stored. This reduces
+        training memory at the cost of one extra forward pass per block. Only
+        applies when gradients are enabled."""
         Activation = {"gelu": nn.GELU, "relu": nn.ReLU}[config.activation]
 
         # MLP encoders and decoders for each modality we want to denoise.
-        modality_dims: dict[str, int] = {
-            "betas": 16,
-            "body_rotmats": 21 * 9,
-            "contacts": 21,
-        }
-        if config.include_hands:
-            modality_dims["hand_rotmats"] = 30 * 9
-
+        modality_dims = get_modality_dims(config.include_hands)
         assert sum(modality_dims.values()) == self.get_d_state()
-        self.encoders = nn.ModuleDict(
-            {
-                k: nn.Sequential(
-                    nn.Linear(modality_dim, config.d_latent),
-                    Activation(),
-                    nn.Linear(config.d_latent, config.d_latent),
-                    Activation(),
-                    nn.Linear(config.d_latent, config.d_latent),
-                )
-                for k, modality_dim in modality_dims.items()
-            }
-        )
-        self.decoders = nn.ModuleDict(
-            {
-                k: nn.Sequential(
-                    nn.Linear(config.d_latent, config.d_latent),
-                    nn.LayerNorm(normalized_shape=config.d_latent),
-                    Activation(),
-                    nn.Linear(config.d_latent, config.d_latent),
-                    Activation(),
-                    nn.Linear(config.d_latent, modality_dim),
-                )
-                for k, modality_dim in modality_dims.items()
-            }
-        )
+        self.encoders: nn.ModuleDict | FusedModalityEncoders
+        self.decoders: nn.ModuleDict | FusedModalityDecoders
+        if fused_modality_heads:
+            self.encoders = FusedModalityEncoders(
+                modality_dims, config.d_latent, config.activation
+            )
+            self.decoders = FusedModalityDecoders(
+                modality_dims, config.d_latent, config.activation
+            )
+        else:
+            self.encoders = nn.ModuleDict(
+                {
+                    k: nn.Sequential(
+                        nn.Linear(modality_dim, config.d_latent),
+                        Activation(),
+                        nn.Linear(config.d_latent, config.d_latent),
+                        Activation(),
+                        nn.Linear(config.d_latent, config.d_latent),
+                    )
+                    for k, modality_dim in modality_dims.items()
+                }
+            )
+            self.decoders = nn.ModuleDict(
+                {
+                    k: nn.Sequential(
+                        nn.Linear(config.d_latent, config.d_latent),
+                        nn.LayerNorm(normalized_shape=config.d_latent),
+                        Activation(),
+                        nn.Linear(config.d_latent, config.d_latent),
+                        Activation(),
+                        nn.Linear(config.d_latent, modality_dim),
+                    )
+                    for k, modality_dim in modality_dims.items()
+                }
+            )
 
         # Helpers for converting between input dimensionality and latent dimensionality.
         self.latent_from_cond = nn.Linear(config.d_cond, config.d_latent)
@@ -416,13 +594,51 @@ class EgoDenoiser(nn.Module):
     def get_d_state(self) -> int:
         return EgoDenoiseTraj.get_packed_dim(self.config.include_hands)
 
+    def inference_autocast(self) -> ContextManager[object]:
+        """Autocast context for `inference_precision`. A no-op for float32, so
+        we don't override autocast settings from training."""
+        if self.inference_precision == "float32":
+            return contextlib.nullcontext()
+        return torch.autocast(
+            next(self.parameters()).device.type,
+            dtype={"bfloat16": torch.bfloat16, "float16": torch.float16}[
+                self.inference_precision
+            ],
+        )
+
+    def encode_cond(
+        self,
+        *,
+        T_world_cpf: Float[Tensor, "batch time 7"],
+        T_cpf_tm1_cpf_t: Float[Tensor, "batch time 7"],
+        hand_positions_wrt_cpf: Float[Tensor, "batch time 6"] | None,
+        cond_dropout_keep_mask: Bool[Tensor, "batch"] | None = None,
+    ) -> Float[Tensor, "batch time d_latent"]:
+        """Compute latent conditioning from CPF poses. This doesn't depend on
+        the noise level or the noisy trajectory, so during sampling it can be
+        computed once and passed into `forward()` for every denoising step."""
+        (batch, time, _) = T_world_cpf.shape
+        cond = self.config.make_cond(
+            T_cpf_tm1_cpf_t,
+            T_world_cpf=T_world_cpf,
+            hand_positions_wrt_cpf=hand_positions_wrt_cpf,
+        )
+
+        # Randomly drop out conditioning information; this serves as a
+        # regularizer that aims to improve sample diversity.
+        if cond_dropout_keep_mask is not None:
+            assert cond_dropout_keep_mask.shape == (batch,)
+            cond = cond * cond_dropout_keep_mask[:, None, None]
+
+        return self.latent_from_cond(cond)
+
     def forward(
         self,
         x_t_packed: Float[Tensor, "batch time state_dim"],
         t: Float[Tensor, "batch"],
         *,
-        T_world_cpf: Float[Tensor, "batch time 7"],
-        T_cpf_tm1_cpf_t: Float[Tensor, "batch time 7"],
+        T_world_cpf: Float[Tensor, "batch time 7"] | None,
+        T_cpf_tm1_cpf_t: Float[Tensor, "batch time 7"] | None,
         project_output_rotmats: bool,
         # Observed hand positions, relative to the CPF.
         hand_positions_wrt_cpf: Float[Tensor, "batch time 6"] | None,
@@ -430,27 +646,14 @@ class EgoDenoiser(nn.Module):
         mask: Bool[Tensor, "batch time"] | None,
         # Mask for when to drop out / keep conditioning information.
         cond_dropout_keep_mask: Bool[Tensor, "batch"] | None = None,
+        # Precomputed output of `encode_cond()`. If passed in, the CPF poses
+        # and hand positions are ignored.
+        cond_latent: Float[Tensor, "batch time d_latent"] | None = None,
     ) -> Float[Tensor, "batch time state_dim"]:
         """Predict a denoised trajectory. Note that `t` refers to a noise
         level, not a timestep."""
         config = self.config
-
-        x_t = EgoDenoiseTraj.unpack(x_t_packed, include_hands=self.config.include_hands)
-        (batch, time, num_body_joints, _, _) = x_t.body_rotmats.shape
-        assert num_body_joints == 21
-
-        # Encode the trajectory into a single vector per timestep.
-        x_t_encoded = (
-            self.encoders["betas"](x_t.betas.reshape((batch, time, -1)))
-            + self.encoders["body_rotmats"](x_t.body_rotmats.reshape((batch, time, -1)))
-            + self.encoders["contacts"](x_t.contacts)
-        )
-        if self.config.include_hands:
-            assert x_t.hand_rotmats is not None
-            x_t_encoded = x_t_encoded + self.encoders["hand_rotmats"](
-                x_t.hand_rotmats.reshape((batch, time, -1))
-            )
-        assert x_t_encoded.shape == (batch, time, config.d_latent)
+        (batch, time, _) = x_t_packed.shape
 
         # Embed the diffusion noise level.
         assert t.shape == (batch,)
@@ -458,70 +661,329 @@ class EgoDenoiser(nn.Module):
         assert noise_emb.shape == (batch, config.d_noise_emb)
 
         # Prepare conditioning information.
-        cond = config.make_cond(
-            T_cpf_tm1_cpf_t,
-            T_world_cpf=T_world_cpf,
-            hand_positions_wrt_cpf=hand_positions_wrt_cpf,
+        if cond_latent is None:
+            assert T_world_cpf is not None and T_cpf_tm1_cpf_t is not None
+            cond_latent = self.encode_cond(
+                T_world_cpf=T_world_cpf,
+                T_cpf_tm1_cpf_t=T_cpf_tm1_cpf_t,
+                hand_positions_wrt_cpf=hand_positions_wrt_cpf,
+                cond_dropout_keep_mask=cond_dropout_keep_mask,
+            )
+        else:
+            assert cond_dropout_keep_mask is None
+        assert cond_latent.shape == (batch, time, config.d_latent)
+
+        if self.local_attention is not None:
+            return self._forward_local(
+                x_t_packed,
+                noise_emb,
+                cond_latent,
+                mask,
+                project_output_rotmats=project_output_rotmats,
+            )
+
+        attn_mask = self._make_attn_mask(mask, batch=batch, time=time)
+        encoder_out = self._run_encoder(cond_latent, noise_emb, attn_mask)
+        return self._run_decoder(
+            x_t_packed,
+            noise_emb,
+            attn_mask,
+            encoder_out=encoder_out,
+            xattn_kv=None,
+            project_output_rotmats=project_output_rotmats,
         )
 
-        # Randomly drop out conditioning information; this serves as a
-        # regularizer that aims to improve sample diversity.
-        if cond_dropout_keep_mask is not None:
-            assert cond_dropout_keep_mask.shape == (batch,)
-            cond = cond * cond_dropout_keep_mask[:, None, None]
+    def _forward_local(
+        self,
+        x_t_packed: Float[Tensor, "batch time state_dim"],
+        noise_emb: Float[Tensor, "batch d_noise_emb"],
+        cond_latent: Float[Tensor, "batch time d_latent"],
+        mask: Bool[Tensor, "batch time"] | None,
+        *,
+        project_output_rotmats: bool,
+    ) -> Float[Tensor, "batch time state_dim"]:
+        """`forward()` with `local_attention`. Blocks of timesteps are laid
+        out along the batch axis, and only attention looks across blocks."""
+        config = self.config
+        assert self.local_attention is not None
+        assert config.positional_encoding == "rope", (
+            "Local attention requires rotary embeddings."
+        )
+        (batch, time, _) = x_t_packed.shape
+        block_size = self.local_attention.block_size
+        num_blocks = -(-time // block_size)
+        pad_time = num_blocks * block_size - time
+
+        def to_blocks(x: Tensor) -> Tensor:
+            x = nn.functional.pad(x, (0, 0, 0, pad_time))
+            return x.reshape((batch * num_blocks, block_size, x.shape[-1]))
+
+        layout = _LocalAttentionLayout(
+            num_blocks=num_blocks,
+            num_prefix_tokens=1 if self.noise_emb_token_proj is not None else 0,
+            context_size=self.local_attention.context_size,
+        )
+
+        # Mask out padding and, via `gather_context()`, context from outside
+        # of the sequence. Like `_make_attn_mask()`, we only mask keys.
+        if mask is None:
+            mask = x_t_packed.new_ones((batch, time), dtype=torch.bool)
+        assert mask.shape == (batch, time)
+        key_mask = to_blocks(mask[:, :, None])
+        key_mask = torch.cat(
+            [
+                key_mask.new_ones((batch * num_blocks, layout.num_prefix_tokens, 1)),
+                key_mask,
+            ],
+            dim=1,
+        )
+        attn_mask = layout.gather_context(key_mask)[:, None, None, :, 0]
+
+        noise_emb = noise_emb.repeat_interleave(num_blocks, dim=0)
+        encoder_out = self._run_encoder(
+            to_blocks(cond_latent), noise_emb, attn_mask, local_layout=layout
+        )
+        out = self._run_decoder(
+            to_blocks(x_t_packed),
+            noise_emb,
+            attn_mask,
+            encoder_out=encoder_out,
+            xattn_kv=None,
+            project_output_rotmats=project_output_rotmats,
+            local_layout=layout,
+        )
+        out = out.reshape((batch, num_blocks * block_size, -1))[:, :time, :]
+        assert out.shape == (batch, time, self.get_d_state())
+        return out
 
-        # Prepare encoder and decoder inputs.
+    def precompute_decoder_cache(
+        self,
+        t: Float[Tensor, "num_t"],
+        cond_latent: Float[Tensor, "batch time d_latent"],
+        mask: Bool[Tensor, "batch time"] | None,
+    ) -> EgoDenoiserDecoderCache:
+        """Run the encoder and project cross-attention keys/values for a set
+        of noise levels. Neither depends on the noisy trajectory, so during
+        sampling this can be done once instead of at every denoising step.
+
+        The encoder is run once for each batch element, batched over noise
+        levels. The output has leading axes `(num_t, batch)`. Memory scales
+        with `num_t * batch * decoder_layers`.
+        """
+        config = self.config
+        assert config.xattn_mode == "kv_from_cond_q_from_x", (
+            "Decoder caching requires keys and values to come from the conditioning."
+        )
+        assert self.local_attention is None, (
+            "Decoder caching isn't supported with local attention."
+        )
+        (num_t,) = t.shape
+        (batch, time, _) = cond_latent.shape
+
+        noise_emb = self.noise_emb(t - 1)
+        assert noise_emb.shape == (num_t, config.d_noise_emb)
+
+        # Keys and values are written into preallocated outputs, so we never
+        # hold a second copy of the cache.
+        xattn_kv = list[Tensor]()
+        for i in range(batch):
+            attn_mask = self._make_attn_mask(
+                None if mask is None else mask[i : i + 1].expand((num_t, time)),
+                batch=num_t,
+                time=time,
+            )
+            encoder_out = self._run_encoder(
+                cond_latent[i : i + 1].expand((num_t, time, config.d_latent)),
+                noise_emb,
+                attn_mask,
+            )
+            for j, layer in enumerate(self.decoder_layers):
+                assert isinstance(layer, TransformerBlock)
+                with self.inference_autocast():
+                    k, v = layer.project_xattn_kv(encoder_out)
+                if i == 0:
+                    xattn_kv.append(k.new_empty((num_t, batch, 2, *k.shape[1:])))
+                xattn_kv[j][:, i, 0] = k
+                xattn_kv[j][:, i, 1] = v
+
+        return EgoDenoiserDecoderCache(
+            noise_emb=noise_emb[:, None, :].expand((num_t, batch, config.d_noise_emb)),
+            xattn_kv=tuple(xattn_kv),
+            num_prefix_tokens=1 if self.noise_emb_token_proj is not None else 0,
+        )
+
+    def forward_decoder(
+        self,
+        x_t_packed: Float[Tensor, "batch time state_dim"],
+        decoder_cache: EgoDenoiserDecoderCache,
+        *,
+        project_output_rotmats: bool,
+        mask: Bool[Tensor, "batch time"] | None,
+    ) -> Float[Tensor, "batch time state_dim"]:
+        """Equivalent to `forward()`, but uses outputs from
+        `precompute_decoder_cache()` in place of the encoder. The cache
+        should have a single leading batch axis that matches `x_t_packed`."""
+        (batch, time, _) = x_t_packed.shape
+        decoder_cache = decoder_cache.truncate(time)
+        assert decoder_cache.noise_emb.shape == (batch, self.config.d_noise_emb)
+        return self._run_decoder(
+            x_t_packed,
+            decoder_cache.noise_emb,
+            self._make_attn_mask(mask, batch=batch, time=time),
+            encoder_out=None,
+            xattn_kv=decoder_cache.xattn_kv,
+            project_output_rotmats=project_output_rotmats,
+        )
+
+    def _make_attn_mask(
+        self, mask: Bool[Tensor, "batch time"] | None, batch: int, time: int
+    ) -> Bool[Tensor, "batch 1 tokens tokens"] | None:
+        """Compute attention mask from a per-timestep validity mask."""
+        if mask is None:
+            return None
+
+        assert mask.shape == (batch, time)
+        assert mask.dtype == torch.bool
+        if self.noise_emb_token_proj is not None:  # Account for noise token.
+            mask = torch.cat([mask.new_ones((batch, 1)), mask], dim=1)
+        num_tokens = mask.shape[1]
+        # Last two dimensions of mask are (query, key). We're masking out only keys;
+        # it's annoying for the softmax to mask out entire rows without getting NaNs.
+        attn_mask = mask[:, None, None, :].repeat(1, 1, num_tokens, 1)
+        assert attn_mask.shape == (batch, 1, num_tokens, num_tokens)
+        assert attn_mask.dtype == torch.bool
+        return attn_mask
+
+    def _get_pos_enc(
+        self, time: int, dtype: torch.dtype, device: torch.device
+    ) -> Float[Tensor, "1 time d_latent"] | int:
+        config = self.config
         if config.positional_encoding == "rope":
-            pos_enc = 0
+            return 0
         elif config.positional_encoding == "transformer":
             pos_enc = make_positional_encoding(
                 d_latent=config.d_latent,
                 length=time,
-                dtype=cond.dtype,
-            )[None, ...].to(x_t_encoded.device)
+                dtype=dtype,
+            )[None, ...].to(device)
             assert pos_enc.shape == (1, time, config.d_latent)
+            return pos_enc
         else:
             assert_never(config.positional_encoding)
 
-        encoder_out = self.latent_from_cond(cond) + pos_enc
-        decoder_out = x_t_encoded + pos_enc
-
-        # Append the noise embedding to the encoder and decoder inputs.
-        # This is weird if we're using rotary embeddings!
-        if self.noise_emb_token_proj is not None:
-            noise_emb_token = self.noise_emb_token_proj(noise_emb)
-            assert noise_emb_token.shape == (batch, config.d_latent)
-            encoder_out = torch.cat([noise_emb_token[:, None, :], encoder_out], dim=1)
-            decoder_out = torch.cat([noise_emb_token[:, None, :], decoder_out], dim=1)
-            assert (
-                encoder_out.shape
-                == decoder_out.shape
-                == (batch, time + 1, config.d_latent)
+    def _prepend_noise_token(
+        self,
+        x: Float[Tensor, "batch time d_latent"],
+        noise_emb: Float[Tensor, "batch d_noise_emb"],
+    ) -> Float[Tensor, "batch tokens d_latent"]:
+        """Append the noise embedding to the encoder or decoder inputs. This
+        is weird if we're using rotary embeddings!"""
+        if self.noise_emb_token_proj is None:
+            return x
+        (batch, time, d_latent) = x.shape
+        noise_emb_token = self.noise_emb_token_proj(noise_emb)
+        assert noise_emb_token.shape == (batch, d_latent)
+        out = torch.cat([noise_emb_token[:, None, :], x], dim=1)
+        assert out.shape == (batch, time + 1, d_latent)
+        return out
+
+    def _call_layer(self, layer: nn.Module, *args: object, **kwargs: object) -> Tensor:
+        """Run a transformer block, with activation checkpointing if enabled.
+        This is the only part of the denoiser that runs in a reduced
+        `inference_precision`."""
+        with self.inference_autocast():
+            if self.activation_checkpointing and torch.is_grad_enabled():
+                # Keyword arguments are bound first, so that they can't be
+                # confused with the options for `checkpoint()`.
+                out = torch.utils.checkpoint.checkpoint(
+                    partial(layer, **kwargs), *args, use_reentrant=False
+                )
+            else:
+                out = layer(*args, **kwargs)
+        assert isinstance(out, Tensor)
+        if self.inference_precision != "float32":
+            out = out.float()
+        return out
+
+    def _run_encoder(
+        self,
+        cond_latent: Float[Tensor, "batch time d_latent"],
+        noise_emb: Float[Tensor, "batch d_noise_emb"],
+        attn_mask: Bool[Tensor, "batch 1 tokens tokens"] | None,
+        local_layout: _LocalAttentionLayout | None = None,
+    ) -> Float[Tensor, "batch tokens d_latent"]:
+        """Encode conditioning information. Inputs are conditioning (current
+        noise level, observations); output is encoded conditioning."""
+        (batch, time, _) = cond_latent.shape
+        encoder_out = self._prepend_noise_token(
+            cond_latent
+            + self._get_pos_enc(time, cond_latent.dtype, cond_latent.device),
+            noise_emb,
+        )
+        for layer in self.encoder_layers:
+            encoder_out = self._call_layer(
+                layer,
+                encoder_out,
+                attn_mask,
+                noise_emb=noise_emb,
+                local_layout=local_layout,
             )
-            num_tokens = time + 1
-        else:
-            num_tokens = time
+        return encoder_out
 
-        # Compute attention mask. This needs to be a fl
-        if mask is None:
-            attn_mask = None
+    def _run_decoder(
+        self,
+        x_t_packed: Float[Tensor, "batch time state_dim"],
+        noise_emb: Float[Tensor, "batch d_noise_emb"],
+        attn_mask: Bool[Tensor, "batch 1 tokens tokens"] | None,
+        *,
+        encoder_out: Float[Tensor, "batch tokens d_latent"] | None,
+        xattn_kv: tuple[Float[Tensor, "batch 2 n_heads tokens d_head"], ...] | None,
+        project_output_rotmats: bool,
+        local_layout: _LocalAttentionLayout | None = None,
+    ) -> Float[Tensor, "batch time state_dim"]:
+        """Decode a noisy trajectory, conditioned on either encoder outputs
+        or precomputed cross-attention keys/values."""
+        config = self.config
+        assert (encoder_out is None) != (xattn_kv is None)
+
+        # Encode the trajectory into a single vector per timestep.
+        (batch, time, _) = x_t_packed.shape
+        if isinstance(self.encoders, FusedModalityEncoders):
+            x_t_encoded = self.encoders(x_t_packed)
         else:
-            assert mask.shape == (batch, time)
-            assert mask.dtype == torch.bool
-            if self.noise_emb_token_proj is not None:  # Account for noise token.
-                mask = torch.cat([mask.new_ones((batch, 1)), mask], dim=1)
-            # Last two dimensions of mask are (query, key). We're masking out only keys;
-            # it's annoying for the softmax to mask out entire rows without getting NaNs.
-            attn_mask = mask[:, None, None, :].repeat(1, 1, num_tokens, 1)
-            assert attn_mask.shape == (batch, 1, num_tokens, num_tokens)
-            assert attn_mask.dtype == torch.bool
+            x_t = EgoDenoiseTraj.unpack(
+                x_t_packed, include_hands=self.config.include_hands
+            )
+            x_t_encoded = (
+                self.encoders["betas"](x_t.betas.reshape((batch, time, -1)))
+                + self.encoders["body_rotmats"](
+                    x_t.body_rotmats.reshape((batch, time, -1))
+                )
+                + self.encoders["contacts"](x_t.contacts)
+            )
+            if self.config.include_hands:
+                assert x_t.hand_rotmats is not None
+                x_t_encoded = x_t_encoded + self.encoders["hand_rotmats"](
+                    x_t.hand_rotmats.reshape((batch, time, -1))
+                )
+        assert x_t_encoded.shape == (batch, time, config.d_latent)
+
+        decoder_out = self._prepend_noise_token(
+            x_t_encoded
+            + self._get_pos_enc(time, x_t_encoded.dtype, x_t_encoded.device),
+            noise_emb,
+        )
 
         # Forward pass through transformer.
-        for layer in self.encoder_layers:
-            encoder_out = layer(encoder_out, attn_mask, noise_emb=noise_emb)
-        for layer in self.decoder_layers:
-            decoder_out = layer(
-                decoder_out, attn_mask, noise_emb=noise_emb, cond=encoder_out
+        for i, layer in enumerate(self.decoder_layers):
+            decoder_out = self._call_layer(
+                layer,
+                decoder_out,
+                attn_mask,
+                noise_emb=noise_emb,
+                cond=encoder_out,
+                cond_kv=None if xattn_kv is None else xattn_kv[i].unbind(dim=1),
+                local_layout=local_layout,
             )
 
         # Remove the extra token corresponding to the noise embedding.
@@ -530,11 +992,30 @@ class EgoDenoiser(nn.Module):
         assert isinstance(decoder_out, Tensor)
         assert decoder_out.shape == (batch, time, config.d_latent)
 
+        if isinstance(self.decoders, FusedModalityDecoders):
+            packed_output = self.decoders(decoder_out)
+            if project_output_rotmats:
+                modality_dims = self.decoders.modality_dims
+                outputs = dict(
+                    zip(
+                        modality_dims.keys(),
+                        torch.split(packed_output, list(modality_dims.values()), -1),
+                    )
+                )
+                for key in ("body_rotmats", "hand_rotmats"):
+                    if key in outputs:
+                        outputs[key] = project_to_so3(
+                            outputs[key].reshape((-1, 3, 3))
+                        ).reshape(outputs[key].shape)
+                packed_output = torch.cat(list(outputs.values()), dim=-1)
+            assert packed_output.shape == (batch, time, self.get_d_state())
+            return packed_output.to(x_t_packed.dtype)
+
         packed_output = torch.cat(
             [
-                # Project rotation matrices for body_rotmats via SVD,
+                # Project rotation matrices to SO(3),
                 (
-                    project_rotmats_via_svd(
+                    project_to_so3(
                         modality_decoder(decoder_out).reshape((-1, 3, 3))
                     ).reshape(
                         (batch, time, {"body_rotmats": 21, "hand_rotmats": 30}[key] * 9)
@@ -555,6 +1036,28 @@ class EgoDenoiser(nn.Module):
         return packed_output
 
 
+class EgoDenoiserDecoderCache(TensorDataclass):
+    """Decoder inputs that depend only on the conditioning and the noise
+    level. Computed by `EgoDenoiser.precompute_decoder_cache()`."""
+
+    noise_emb: Float[Tensor, "*batch d_noise_emb"]
+    xattn_kv: tuple[Float[Tensor, "*batch 2 n_heads tokens d_head"], ...]
+    """Stacked cross-attention keys and values for each decoder layer."""
+    num_prefix_tokens: int
+    """Number of tokens that precede the timesteps. 1 if we use a noise
+    embedding token, otherwise 0."""
+
+    def truncate(self, time: int) -> EgoDenoiserDecoderCache:
+        """Drop keys and values for timesteps after `time`."""
+        return EgoDenoiserDecoderCache(
+            noise_emb=self.noise_emb,
+            xattn_kv=tuple(
+                kv[..., : self.num_prefix_tokens + time, :] for kv in self.xattn_kv
+            ),
+            num_prefix_tokens=self.num_prefix_tokens,
+        )
+
+
 @cache
 def make_positional_encoding(
     d_latent: int, length: int, dtype: torch.dtype
@@ -587,6 +1090,62 @@ def fourier_encode(
     )
 
 
+@dataclass(frozen=True)
+class _LocalAttentionLayout:
+    """Token layout for `EgoDenoiser.local_attention`. Sequences are split into
+    blocks along the batch axis, and each block has `num_prefix_tokens`
+    followed by its timesteps."""
+
+    num_blocks: int
+    """Number of blocks per sequence."""
+    num_prefix_tokens: int
+    context_size: int
+
+    def gather_context(
+        self, x: Float[Tensor, "batch_blocks tokens d"]
+    ) -> Float[Tensor, "batch_blocks keys d"]:
+        """Gather keys for each block: its prefix tokens, `context_size`
+        timesteps from the previous block, its own timesteps, then
+        `context_size` timesteps from the next block. Context from outside
+        of the sequence is zero."""
+        (batch_blocks, tokens, d) = x.shape
+        num_prefix = self.num_prefix_tokens
+        context_size = self.context_size
+        block_size = tokens - num_prefix
+
+        blocks = x.reshape(
+            (batch_blocks // self.num_blocks, self.num_blocks, tokens, d)
+        )
+        timesteps = blocks[:, :, num_prefix:, :]
+        # Pad the block axis so each block has a previous and next block.
+        padded = nn.functional.pad(timesteps, (0, 0, 0, 0, 1, 1))
+        out = torch.cat(
+            [
+                blocks[:, :, :num_prefix, :],
+                padded[:, :-2, block_size - context_size :, :],
+                timesteps,
+                padded[:, 2:, :context_size, :],
+            ],
+            dim=2,
+        )
+        num_keys = num_prefix + 2 * context_size + block_size
+        return out.reshape((batch_blocks, num_keys, d))
+
+    def rotate_queries(
+        self, rotary_emb: RotaryEmbedding, q: Float[Tensor, "b nh tokens dh"]
+    ) -> Float[Tensor, "b nh tokens dh"]:
+        """Apply rotary embeddings to queries, at positions that match the
+        keys from `gather_context()`."""
+        num_prefix = self.num_prefix_tokens
+        q_timesteps = rotary_emb.rotate_queries_or_keys(
+            q[..., num_prefix:, :], seq_dim=-2, offset=num_prefix + self.context_size
+        )
+        if num_prefix == 0:
+            return q_timesteps
+        q_prefix = rotary_emb.rotate_queries_or_keys(q[..., :num_prefix, :], seq_dim=-2)
+        return torch.cat([q_prefix, q_timesteps], dim=-2)
+
+
 @dataclass(frozen=True)
 class TransformerBlockConfig:
     d_latent: int
@@ -654,18 +1213,28 @@ class TransformerBlock(nn.Module):
         attn_mask: Bool[Tensor, "batch 1 tokens tokens"] | None,
         noise_emb: Float[Tensor, "batch d_noise_emb"],
         cond: Float[Tensor, "batch tokens d_latent"] | None = None,
+        cond_kv: tuple[Tensor, Tensor] | None = None,
+        local_layout: _LocalAttentionLayout | None = None,
     ) -> Float[Tensor, "batch tokens d_latent"]:
+        """If `local_layout` is set, `x` and `cond` are blocks of tokens,
+        and `attn_mask` is a key mask for the output of
+        `local_layout.gather_context()`."""
         config = self.config
         (batch, time, d_latent) = x.shape
 
         # Self-attention.
         # We put layer normalization after the residual connection.
-        x = self.layernorm1(x + self._sattn(x, attn_mask))
+        x = self.layernorm1(x + self._sattn(x, attn_mask, local_layout))
 
         # Include conditioning.
         if config.include_xattn:
-            assert cond is not None
-            x = self.xattn_layernorm(x + self._xattn(x, attn_mask, cond=cond))
+            assert cond is not None or cond_kv is not None
+            x = self.xattn_layernorm(
+                x
+                + self._xattn(
+                    x, attn_mask, cond=cond, cond_kv=cond_kv, local_layout=local_layout
+                )
+            )
 
         mlp_out = x
         mlp_out = self.mlp0(mlp_out)
@@ -689,58 +1258,107 @@ class TransformerBlock(nn.Module):
         assert x.shape == (batch, time, d_latent)
         return x
 
-    def _sattn(self, x: Tensor, attn_mask: Tensor | None) -> Tensor:
+    def _sattn(
+        self,
+        x: Tensor,
+        attn_mask: Tensor | None,
+        local_layout: _LocalAttentionLayout | None = None,
+    ) -> Tensor:
         """Multi-head self-attention."""
         config = self.config
-        q, k, v = rearrange(
-            self.sattn_qkv_proj(x),
-            "b t (qkv nh dh) -> qkv b nh t dh",
-            qkv=3,
-            nh=config.n_heads,
-        )
+        if local_layout is None:
+            q, k, v = rearrange(
+                self.sattn_qkv_proj(x),
+                "b t (qkv nh dh) -> qkv b nh t dh",
+                qkv=3,
+                nh=config.n_heads,
+            )
+        else:
+            # Queries come from each block, keys and values from its context.
+            q, kv = torch.split(
+                self.sattn_qkv_proj(x), [config.d_latent, 2 * config.d_latent], dim=-1
+            )
+            q = rearrange(q, "b t (nh dh) -> b nh t dh", nh=config.n_heads)
+            k, v = rearrange(
+                local_layout.gather_context(kv),
+                "b t (kv nh dh) -> kv b nh t dh",
+                kv=2,
+                nh=config.n_heads,
+            )
         if self.rotary_emb is not None:
-            q = self.rotary_emb.rotate_queries_or_keys(q, seq_dim=-2)
+            q = (
+                self.rotary_emb.rotate_queries_or_keys(q, seq_dim=-2)
+                if local_layout is None
+                else local_layout.rotate_queries(self.rotary_emb, q)
+            )
             k = self.rotary_emb.rotate_queries_or_keys(k, seq_dim=-2)
         x = torch.nn.functional.scaled_dot_product_attention(
             q, k, v, dropout_p=config.dropout_p, attn_mask=attn_mask
         )
         x = self.dropout(x)
         x = rearrange(x, "b nh t dh -> b t (nh dh)", nh=config.n_heads)
-        x = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, dropout_p=config.dropout_p
-        )
-        x = self.dropout(x)
-        x = rearrange(x, "b nh t dh -> b t (nh dh)", nh=config.n_heads)
         x = self.sattn_out_proj(x)
         return x
 
-    def _xattn(self, x: Tensor, attn_mask: Tensor | None, cond: Tensor) -> Tensor:
-        """Multi-head cross-attention."""
+    def project_xattn_kv(
+        self, kv_source: Tensor, local_layout: _LocalAttentionLayout | None = None
+    ) -> tuple[Tensor, Tensor]:
+        """Cross-attention keys and values, with rotary embeddings applied to
+        the keys."""
         config = self.config
+        kv = self.xattn_kv_proj(kv_source)
+        if local_layout is not None:
+            kv = local_layout.gather_context(kv)
         k, v = rearrange(
-            self.xattn_kv_proj(
-                {
-                    "kv_from_cond_q_from_x": cond,
-                    "kv_from_x_q_from_cond": x,
-                }[self.config.xattn_mode]
-            ),
+            kv,
             "b t (qk nh dh) -> qk b nh t dh",
             qk=2,
             nh=config.n_heads,
         )
-        q = rearrange(
-            self.xattn_q_proj(
+        if self.rotary_emb is not None:
+            k = self.rotary_emb.rotate_queries_or_keys(k, seq_dim=-2)
+        return k, v
+
+    def _xattn(
+        self,
+        x: Tensor,
+        attn_mask: Tensor | None,
+        cond: Tensor | None,
+        cond_kv: tuple[Tensor, Tensor] | None = None,
+        local_layout: _LocalAttentionLayout | None = None,
+    ) -> Tensor:
+        """Multi-head cross-attention. Keys and values can be passed in
+        directly via `cond_kv`, which should come from `project_xattn_kv()`."""
+        config = self.config
+        if cond_kv is not None:
+            assert self.config.xattn_mode == "kv_from_cond_q_from_x"
+            assert local_layout is None
+            k, v = cond_kv
+        else:
+            assert cond is not None
+            k, v = self.project_xattn_kv(
                 {
-                    "kv_from_cond_q_from_x": x,
-                    "kv_from_x_q_from_cond": cond,
-                }[self.config.xattn_mode]
-            ),
+                    "kv_from_cond_q_from_x": cond,
+                    "kv_from_x_q_from_cond": x,
+                }[self.config.xattn_mode],
+                local_layout,
+            )
+        q_source = {
+            "kv_from_cond_q_from_x": x,
+            "kv_from_x_q_from_cond": cond,
+        }[self.config.xattn_mode]
+        assert q_source is not None
+        q = rearrange(
+            self.xattn_q_proj(q_source),
             "b t (nh dh) -> b nh t dh",
             nh=config.n_heads,
         )
         if self.rotary_emb is not None:
-            q = self.rotary_emb.rotate_queries_or_keys(q, seq_dim=-2)
-            k = self.rotary_emb.rotate_queries_or_keys(k, seq_dim=-2)
+            q = (
+                self.rotary_emb.rotate_queries_or_keys(q, seq_dim=-2)
+                if local_layout is None
+                else local_layout.rotate_queries(self.rotary_emb, q)
+            )
         x = torch.nn.functional.scaled_dot_product_attention(
             q, k, v, dropout_p=config.dropout_p, attn_mask=attn_mask
         )
@@ -750,6 +1368,173 @@ class TransformerBlock(nn.Module):
         return x
 
 
+def _init_linear_layers(
+    num_layers: int, d_in: int, d_out: int
+) -> tuple[Float[Tensor, "num_layers d_out d_in"], Float[Tensor, "num_layers d_out"]]:
+    """Stacked weights and biases for `num_layers` freshly initialized
+    `nn.Linear(d_in, d_out)` layers. Used to initialize fused layers the same
+    way as the unfused ones."""
+    layers = [nn.Linear(d_in, d_out) for _ in range(num_layers)]
+    return (
+        torch.stack([layer.weight.detach() for layer in layers]),
+        torch.stack([layer.bias.detach() for layer in layers]),
+    )
+
+
+class FusedModalityEncoders(nn.Module):
+    """The per-modality MLP encoders in `EgoDenoiser`, with layers that have
+    the same shape for every modality fused together. Takes a packed
+    trajectory and returns the sum of each modality's encoding.
+
+    - The first layer has a different input size for each modality, so it
+      stays separate.
+    - The second layer is a batched matrix multiply over modalities.
+    - The third layer and the sum over modalities are a single linear layer.
+
+    This does the same arithmetic as the unfused encoders, with fewer and
+    larger kernels."""
+
+    def __init__(
+        self,
+        modality_dims: dict[str, int],
+        d_latent: int,
+        activation: Literal["gelu", "relu"],
+    ) -> None:
+        super().__init__()
+        num_modalities = len(modality_dims)
+        self.modality_dims = modality_dims
+        self.in_projs = nn.ModuleDict(
+            {k: nn.Linear(dim, d_latent) for k, dim in modality_dims.items()}
+        )
+        hidden_weight, hidden_bias = _init_linear_layers(
+            num_modalities, d_latent, d_latent
+        )
+        self.hidden_weight = nn.Parameter(hidden_weight.transpose(1, 2).contiguous())
+        """Transposed weights for each modality's second layer."""
+        self.hidden_bias = nn.Parameter(hidden_bias[:, None, :])
+        # The fused output layer has a larger fan-in than the per-modality
+        # layers, so its default initialization would be narrower.
+        self.out_proj = nn.Linear(num_modalities * d_latent, d_latent)
+        out_weight, out_bias = _init_linear_layers(num_modalities, d_latent, d_latent)
+        with torch.no_grad():
+            self.out_proj.weight.copy_(torch.cat(list(out_weight), dim=1))
+            self.out_proj.bias.copy_(torch.sum(out_bias, dim=0))
+        self.activation = {"gelu": nn.GELU, "relu": nn.ReLU}[activation]()
+
+    def forward(
+        self, x_packed: Float[Tensor, "*batch d_state"]
+    ) -> Float[Tensor, "*batch d_latent"]:
+        *batch, _ = x_packed.shape
+        num_modalities, _, d_latent = self.hidden_bias.shape
+        h = torch.stack(
+            [
+                in_proj(x.reshape((-1, x.shape[-1])))
+                for in_proj, x in zip(
+                    self.in_projs.values(),
+                    torch.split(x_packed, list(self.modality_dims.values()), -1),
+                )
+            ]
+        )
+        h = self.activation(
+            torch.baddbmm(self.hidden_bias, self.activation(h), self.hidden_weight)
+        )
+        h = h.transpose(0, 1).reshape((*batch, num_modalities * d_latent))
+        return self.out_proj(h)
+
+
+class FusedModalityDecoders(nn.Module):
+    """The per-modality MLP decoders in `EgoDenoiser`, with layers that have
+    the same shape for every modality fused together. Returns a packed
+    trajectory.
+
+    - The first layer is a single linear layer for all modalities, followed
+      by a batched layer norm.
+    - The second layer is a batched matrix multiply over modalities.
+    - The third layer has a different output size for each modality, so it
+      stays separate."""
+
+    def __init__(
+        self,
+        modality_dims: dict[str, int],
+        d_latent: int,
+        activation: Literal["gelu", "relu"],
+    ) -> None:
+        super().__init__()
+        num_modalities = len(modality_dims)
+        self.modality_dims = modality_dims
+        self.in_proj = nn.Linear(d_latent, num_modalities * d_latent)
+        self.layernorm_weight = nn.Parameter(torch.ones((num_modalities, d_latent)))
+        self.layernorm_bias = nn.Parameter(torch.zeros((num_modalities, d_latent)))
+        hidden_weight, hidden_bias = _init_linear_layers(
+            num_modalities, d_latent, d_latent
+        )
+        self.hidden_weight = nn.Parameter(hidden_weight.transpose(1, 2).contiguous())
+        """Transposed weights for each modality's second layer."""
+        self.hidden_bias = nn.Parameter(hidden_bias[:, None, :])
+        self.out_projs = nn.ModuleDict(
+            {k: nn.Linear(d_latent, dim) for k, dim in modality_dims.items()}
+        )
+        self.activation = {"gelu": nn.GELU, "relu": nn.ReLU}[activation]()
+
+    def forward(
+        self, x: Float[Tensor, "*batch d_latent"]
+    ) -> Float[Tensor, "*batch d_state"]:
+        *batch, d_latent = x.shape
+        num_modalities = self.hidden_bias.shape[0]
+        h = self.in_proj(x).reshape((-1, num_modalities, d_latent))
+        h = (
+            nn.functional.layer_norm(h, (d_latent,)) * self.layernorm_weight
+            + self.layernorm_bias
+        )
+        h = self.activation(h).transpose(0, 1)
+        h = self.activation(torch.baddbmm(self.hidden_bias, h, self.hidden_weight))
+        return torch.cat(
+            [out_proj(h_k) for out_proj, h_k in zip(self.out_projs.values(), h)],
+            dim=-1,
+        ).reshape((*batch, -1))
+
+
+def fuse_modality_heads_state_dict(
+    state_dict: dict[str, Tensor], include_hands: bool
+) -> dict[str, Tensor]:
+    """Convert an `EgoDenoiser` state dict with per-modality encoders and
+    decoders to one for `EgoDenoiser(config, fused_modality_heads=True)`.
+    Other entries are passed through."""
+    modality_dims = get_modality_dims(include_hands)
+    out = {
+        k: v
+        for k, v in state_dict.items()
+        if not k.startswith("encoders.") and not k.startswith("decoders.")
+    }
+
+    def stack(fmt: str) -> Tensor:
+        return torch.stack([state_dict[fmt.format(key)] for key in modality_dims])
+
+    def cat(fmt: str, dim: int = 0) -> Tensor:
+        return torch.cat([state_dict[fmt.format(key)] for key in modality_dims], dim)
+
+    for key in modality_dims:
+        for param in ("weight", "bias"):
+            out[f"encoders.in_projs.{key}.{param}"] = state_dict[
+                f"encoders.{key}.0.{param}"
+            ]
+            out[f"decoders.out_projs.{key}.{param}"] = state_dict[
+                f"decoders.{key}.5.{param}"
+            ]
+    out["encoders.hidden_weight"] = stack("encoders.{}.2.weight").transpose(1, 2)
+    out["encoders.hidden_bias"] = stack("encoders.{}.2.bias")[:, None, :]
+    out["encoders.out_proj.weight"] = cat("encoders.{}.4.weight", dim=1)
+    out["encoders.out_proj.bias"] = torch.sum(stack("encoders.{}.4.bias"), dim=0)
+
+    out["decoders.in_proj.weight"] = cat("decoders.{}.0.weight")
+    out["decoders.in_proj.bias"] = cat("decoders.{}.0.bias")
+    out["decoders.layernorm_weight"] = stack("decoders.{}.1.weight")
+    out["decoders.layernorm_bias"] = stack("decoders.{}.1.bias")
+    out["decoders.hidden_weight"] = stack("decoders.{}.3.weight").transpose(1, 2)
+    out["decoders.hidden_bias"] = stack("decoders.{}.3.bias")[:, None, :]
+    return out
+
+
 def zero_module(module):
     """Zero out the parameters of a module and return it."""
     for p in module.parameters():
@@ -0,0 +1,103 @@
+"""Exporting the denoiser to ONNX, for `onnx_sampling`.
+
+This needs PyTorch and `onnx`. Sampling from the exported model doesn't.
+"""
+
+from __future__ import annotations
+
+import warnings
+from pathlib import Path
+
+import torch
+from jaxtyping import Float
+from torch import Tensor, nn
+
+from . import network
+from .compiled_denoiser import _WindowForward
+from .onnx_sampling import ONNX_COND_FILENAME, ONNX_FORWARD_FILENAME
+
+
+class _EncodeCond(nn.Module):
+    """`EgoDenoiser.encode_cond()`, restricted to the arguments used for sampling."""
+
+    def __init__(self, denoiser: network.EgoDenoiser) -> None:
+        super().__init__()
+        self.denoiser = denoiser
+
+    def forward(
+        self,
+        T_world_cpf: Float[Tensor, "batch time 7"],
+        T_cpf_tm1_cpf_t: Float[Tensor, "batch time 7"],
+    ) -> Float[Tensor, "batch time d_latent"]:
+        return self.denoiser.encode_cond(
+            T_world_cpf=T_world_cpf,
+            T_cpf_tm1_cpf_t=T_cpf_tm1_cpf_t,
+            hand_positions_wrt_cpf=None,
+        )
+
+
+def export_denoiser_onnx(
+    denoiser: network.EgoDenoiser,
+    output_dir: Path,
+    window_size: int = 128,
+    opset_version: int = 17,
+) -> None:
+    """Export a denoiser to two ONNX graphs in `output_dir`:
+    - `encode_cond()`, which maps CPF poses to latent conditioning.
+    - `forward()` with precomputed latent conditioning, for one batch of
+      windows at a noise level.
+
+    The batch axis is dynamic. The forward pass is exported for a static
+    window length, since the positional encoding is traced for a fixed
+    sequence length; shorter windows are padded and masked at runtime.
+
+    Only float32 denoisers can be exported.
+    """
+    assert denoiser.inference_precision == "float32", (
+        "Reduced precision autocast can't be exported."
+    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+    denoiser = denoiser.eval()
+    device = next(denoiser.parameters()).device
+
+    with torch.no_grad(), warnings.catch_warnings():
+        # Tracing warns about shape assertions, which aren't part of the graph.
+        warnings.filterwarnings("ignore", message=".*trace")
+        torch.onnx.export(
+            _EncodeCond(denoiser),
+            (
+                torch.zeros((1, window_size, 7), device=device),
+                torch.zeros((1, window_size, 7), device=device),
+            ),
+            str(output_dir / ONNX_COND_FILENAME),
+            input_names=["T_world_cpf", "T_cpf_tm1_cpf_t"],
+            output_names=["cond_latent"],
+            dynamic_axes={
+                "T_world_cpf": {0: "batch", 1: "time"},
+                "T_cpf_tm1_cpf_t": {0: "batch", 1: "time"},
+                "cond_latent": {0: "batch", 1: "time"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+        torch.onnx.export(
+            _WindowForward(denoiser),
+            (
+                torch.zeros((1, window_size, denoiser.get_d_state()), device=device),
+                torch.ones((1,), dtype=torch.int64, device=device),
+                torch.zeros((1, window_size, denoiser.config.d_latent), device=device),
+                torch.ones((1, window_size), dtype=torch.bool, device=device),
+            ),
+            str(output_dir / ONNX_FORWARD_FILENAME),
+            input_names=["x_t_packed", "t", "cond_latent", "mask"],
+            output_names=["x_0_packed"],
+            dynamic_axes={
+                "x_t_packed": {0: "batch"},
+                "t": {0: "batch"},
+                "cond_latent": {0: "batch"},
+                "mask": {0: "batch"},
+                "x_0_packed": {0: "batch"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
@@ -0,0 +1,436 @@
+"""Sampling with a denoiser exported to ONNX, and run with ONNX Runtime.
+
+This is for CPU workers without PyTorch. The DDIM loop, window stitching, and
+SVD projection run in NumPy, and the denoiser runs in ONNX Runtime. Models are
+exported with `onnx_export`, which needs PyTorch.
+
+Guidance runs in JAX, via `guidance_optimizer_core`, which doesn't import
+PyTorch either.
+
+`onnxruntime` isn't required by the rest of the codebase, so it's imported
+only when needed.
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from typing import Callable, Literal, Sequence
+
+import jaxlie
+import numpy as np
+from jax import numpy as jnp
+from jaxtyping import Bool, Float, Int
+from tqdm.auto import tqdm
+
+from . import fncsmpl_jax
+from .guidance_optimizer_core import GuidanceMode, do_guidance_optimization_numpy
+
+ONNX_COND_FILENAME = "denoiser_encode_cond.onnx"
+"""Filename for the exported conditioning encoder."""
+ONNX_FORWARD_FILENAME = "denoiser_forward.onnx"
+"""Filename for the exported windowed forward pass."""
+
+
+class OnnxDenoiser:
+    """Denoiser exported with `onnx_export.export_denoiser_onnx()`, run with
+    ONNX Runtime. Inputs and outputs are NumPy arrays."""
+
+    def __init__(
+        self,
+        onnx_dir: Path,
+        providers: Sequence[str] = ("CPUExecutionProvider",),
+        num_threads: int | None = None,
+    ) -> None:
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self._cond_session = ort.InferenceSession(
+            str(onnx_dir / ONNX_COND_FILENAME), options, providers=list(providers)
+        )
+        self._forward_session = ort.InferenceSession(
+            str(onnx_dir / ONNX_FORWARD_FILENAME), options, providers=list(providers)
+        )
+
+        (_, window_size, d_state) = self._forward_session.get_inputs()[0].shape
+        assert isinstance(window_size, int) and isinstance(d_state, int)
+        self.window_size = window_size
+        """Static window length that the forward pass was exported for."""
+        self.d_state = d_state
+        # See `EgoDenoiseTraj.get_packed_dim()`.
+        self.include_hands = d_state == 16 + 21 * 9 + 21 + 30 * 9
+
+    def encode_cond(
+        self,
+        T_world_cpf: Float[np.ndarray, "batch time 7"],
+        T_cpf_tm1_cpf_t: Float[np.ndarray, "batch time 7"],
+    ) -> Float[np.ndarray, "batch time d_latent"]:
+        (cond_latent,) = self._cond_session.run(
+            None,
+            {
+                "T_world_cpf": T_world_cpf.astype(np.float32),
+                "T_cpf_tm1_cpf_t": T_cpf_tm1_cpf_t.astype(np.float32),
+            },
+        )
+        return np.asarray(cond_latent)
+
+    def forward(
+        self,
+        x_t_packed: Float[np.ndarray, "batch time d_state"],
+        t: Int[np.ndarray, "batch"],
+        cond_latent: Float[np.ndarray, "batch time d_latent"],
+        mask: Bool[np.ndarray, "batch time"],
+    ) -> Float[np.ndarray, "batch time d_state"]:
+        """Predict clean windows. Windows shorter than `window_size` are padded
+        and masked."""
+        (batch, time, d_state) = x_t_packed.shape
+        assert time <= self.window_size
+        pad_time = ((0, 0), (0, self.window_size - time))
+        (x_0_packed,) = self._forward_session.run(
+            None,
+            {
+                "x_t_packed": np.pad(x_t_packed, pad_time + ((0, 0),)).astype(
+                    np.float32
+                ),
+                "t": t.astype(np.int64),
+                "cond_latent": np.pad(cond_latent, pad_time + ((0, 0),)).astype(
+                    np.float32
+                ),
+                "mask": np.pad(mask, pad_time, constant_values=False),
+            },
+        )
+        return np.asarray(x_0_packed)[:, :time, :]
+
+
+class OnnxStitchedWindows:
+    """NumPy counterpart of `sampling.StitchedWindows`. Windows are kept
+    unpadded, since they're contiguous slices of the sequence."""
+
+    def __init__(
+        self,
+        denoiser: OnnxDenoiser,
+        T_cpf_tm1_cpf_t: Float[np.ndarray, "seq_len 7"],
+        T_world_cpf: Float[np.ndarray, "seq_len 7"],
+        window_size: int,
+        overlap_size: int,
+    ) -> None:
+        (seq_len, _) = T_cpf_tm1_cpf_t.shape
+        assert T_world_cpf.shape == (seq_len, 7)
+        assert window_size <= denoiser.window_size
+
+        self.starts = tuple(range(0, seq_len, window_size - overlap_size))
+        self.lengths = tuple(
+            min(start + window_size, seq_len) - start for start in self.starts
+        )
+        canonical_overlap_weights = (
+            np.minimum(
+                overlap_size,
+                np.minimum(np.arange(1, seq_len + 1), np.arange(1, seq_len + 1)[::-1]),
+            )
+            / overlap_size
+            if overlap_size > 0
+            else np.ones(seq_len)
+        ).astype(np.float32)
+        self.weights = [canonical_overlap_weights[:length] for length in self.lengths]
+        self.weight_sum = np.zeros((seq_len,), dtype=np.float32)
+        for start, weights in zip(self.starts, self.weights):
+            self.weight_sum[start : start + len(weights)] += weights
+
+        # Conditioning is computed per window, since some parameterizations
+        # (eg "canonicalized") depend on the first frame of each window.
+        self.cond_latents = [
+            denoiser.encode_cond(
+                T_world_cpf[None, start : start + length],
+                T_cpf_tm1_cpf_t[None, start : start + length],
+            )[0]
+            for start, length in zip(self.starts, self.lengths)
+        ]
+
+
+def denoise_with_stitching_onnx(
+    denoiser: OnnxDenoiser,
+    x_t_packed: Float[np.ndarray, "num_samples seq_len d_state"],
+    t: int,
+    windows: OnnxStitchedWindows,
+    windows_per_batch: int | None,
+) -> Float[np.ndarray, "num_samples seq_len d_state"]:
+    """NumPy counterpart of `sampling.denoise_with_stitching()`."""
+    (num_samples, seq_len, d_state) = x_t_packed.shape
+    assert windows.weight_sum.shape == (seq_len,)
+    num_windows = len(windows.starts)
+    if windows_per_batch is None:
+        windows_per_batch = num_windows
+
+    x_0_packed_pred = np.zeros_like(x_t_packed)
+    for window_start in range(0, num_windows, windows_per_batch):
+        window_indices = range(
+            window_start, min(window_start + windows_per_batch, num_windows)
+        )
+        padded_size = max(windows.lengths[w] for w in window_indices)
+
+        # Windows are flattened into the batch axis, with shape
+        # (num_samples, chunk_windows) -> (num_samples * chunk_windows,).
+        def stack_windows(get: Callable[[int, int], np.ndarray]) -> np.ndarray:
+            out = list[np.ndarray]()
+            for s in range(num_samples):
+                for w in window_indices:
+                    x = get(w, s)
+                    out.append(
+                        np.pad(
+                            x, ((0, padded_size - len(x)),) + ((0, 0),) * (x.ndim - 1)
+                        )
+                    )
+            return np.stack(out)
+
+        x_0_windows = denoiser.forward(
+            stack_windows(
+                lambda w, s: x_t_packed[
+                    s, windows.starts[w] : windows.starts[w] + windows.lengths[w]
+                ]
+            ),
+            np.full((num_samples * len(window_indices),), t, dtype=np.int64),
+            cond_latent=stack_windows(lambda w, s: windows.cond_latents[w]),
+            mask=stack_windows(lambda w, s: np.ones(windows.lengths[w], dtype=bool)),
+        ).reshape((num_samples, len(window_indices), padded_size, d_state))
+
+        # Add weighted window predictions back into the sequence.
+        for i, w in enumerate(window_indices):
+            start = windows.starts[w]
+            length = windows.lengths[w]
+            x_0_packed_pred[:, start : start + length, :] += (
+                x_0_windows[:, i, :length, :] * windows.weights[w][None, :, None]
+            )
+
+    # Take the mean for overlapping regions.
+    return x_0_packed_pred / windows.weight_sum[None, :, None]
+
+
+def project_body_rotmats_numpy(
+    x_packed: Float[np.ndarray, "*batch d_state"],
+) -> Float[np.ndarray, "*batch d_state"]:
+    """Project the body rotation matrices in a packed trajectory to SO(3) via
+    SVD. NumPy counterpart of `EgoDenoiseTraj.unpack(project_rotmats=True)`."""
+    body_rotmats = x_packed[..., 16 : 16 + 21 * 9].reshape(
+        (*x_packed.shape[:-1], 21, 3, 3)
+    )
+    u, _, vh = np.linalg.svd(body_rotmats)
+    # Avoid reflections, like `network.project_to_so3()`.
+    u[..., 2] *= np.sign(np.linalg.det(u @ vh))[..., None]
+    out = x_packed.copy()
+    out[..., 16 : 16 + 21 * 9] = (u @ vh).reshape((*x_packed.shape[:-1], 21 * 9))
+    return out
+
+
+def _guidance_numpy(
+    x_0_packed: Float[np.ndarray, "num_samples seq_len d_state"],
+    Ts_world_cpf: Float[np.ndarray, "seq_len 7"],
+    body_model: fncsmpl_jax.SmplhModel,
+    guidance_mode: GuidanceMode,
+    phase: Literal["inner", "post"],
+    hamer_detections: dict | None,
+    aria_detections: dict | None,
+    verbose: bool,
+) -> Float[np.ndarray, "num_samples seq_len d_state"]:
+    """Apply guidance to a packed trajectory with hands."""
+    (num_samples, seq_len, _) = x_0_packed.shape
+    betas, body_rotmats_flat, contacts, hand_rotmats_flat = np.split(
+        x_0_packed, np.cumsum([16, 21 * 9, 21]), axis=-1
+    )
+    quats, _ = do_guidance_optimization_numpy(
+        Ts_world_cpf=Ts_world_cpf,
+        betas=betas,
+        body_rotmats=body_rotmats_flat.reshape((num_samples, seq_len, 21, 3, 3)),
+        hand_rotmats=hand_rotmats_flat.reshape((num_samples, seq_len, 30, 3, 3)),
+        contacts=contacts,
+        body=body_model,
+        guidance_mode=guidance_mode,
+        phase=phase,
+        hamer_detections=hamer_detections,
+        aria_detections=aria_detections,
+        verbose=verbose,
+    )
+    rotmats = np.asarray(
+        jaxlie.SO3(jnp.asarray(quats)).as_matrix(), dtype=x_0_packed.dtype
+    )
+    return np.concatenate(
+        [
+            betas,
+            rotmats[:, :, :21].reshape((num_samples, seq_len, 21 * 9)),
+            contacts,
+            rotmats[:, :, 21:].reshape((num_samples, seq_len, 30 * 9)),
+        ],
+        axis=-1,
+    )
+
+
+def compute_cosine_noise_schedule(
+    timesteps: int, s: float = 0.008
+) -> tuple[Float[np.ndarray, "T"], Float[np.ndarray, "T+1"]]:
+    """NumPy counterpart of `CosineNoiseScheduleConstants.compute()`. Returns
+    `alpha_t` and `alpha_bar_t`, in float64."""
+    x = np.linspace(0.0, 1.0, timesteps + 1, dtype=np.float64)
+    alphas_cumprod = np.cos((x + s) / (1 + s) * np.pi * 0.5) ** 2
+    alphas_cumprod = alphas_cumprod / alphas_cumprod[0]
+    betas = np.clip(1.0 - (alphas_cumprod[1:] / alphas_cumprod[:-1]), 0, 0.999)
+    alpha_t = 1.0 - betas
+    alpha_bar_t = np.concatenate([np.ones((1,)), np.cumprod(alpha_t)])
+    return alpha_t, alpha_bar_t
+
+
+def run_sampling_onnx(
+    denoiser: OnnxDenoiser,
+    body_model: fncsmpl_jax.SmplhModel | None,
+    guidance_mode: GuidanceMode,
+    guidance_post: bool,
+    guidance_inner: bool,
+    Ts_world_cpf: Float[np.ndarray, "time 7"],
+    floor_z: float,
+    hamer_detections: dict | None,
+    aria_detections: dict | None,
+    num_samples: int,
+    ts: Int[np.ndarray, "steps+1"],
+    guidance_verbose: bool = True,
+    eta: float = 0.8,
+    window_size: int | None = None,
+    overlap_size: int = 32,
+    windows_per_batch: int | None = None,
+    seed: int = 0,
+    initial_noise: Float[np.ndarray, "num_samples time-1 d_state"] | None = None,
+    step_noise: Float[np.ndarray, "steps num_samples time-1 d_state"] | None = None,
+) -> Float[np.ndarray, "num_samples time-1 d_state"]:
+    """Sample a body motion trajectory, conditioned on CPF poses. This mirrors
+    `run_sampling_with_stitching()`, but runs the denoiser with ONNX Runtime
+    and everything else in NumPy and JAX.
+
+    Returns a packed trajectory; use `EgoDenoiseTraj.unpack()` to split it.
+    Steps are taken with DDIM, between the timesteps in `ts`, which go from
+    1000 down to 0; see `SamplerConfig.get_ts()`. Windows and batches work
+    like `StitchingPlan`, and `window_size` defaults to the exported window
+    length. Hand detections should be nested dictionaries, as returned by
+    `as_nested_dict(numpy=True)`, and the body model is only needed for
+    guidance.
+
+    Noise is drawn from a NumPy generator seeded with `seed`, so samples
+    won't match the PyTorch path for the same seed. To compare the two, pass
+    in the noise that the PyTorch path draws: `initial_noise` for the start
+    of sampling, and `step_noise` for each DDIM step.
+    """
+    assert ts[0] == 1000 and ts[-1] == 0
+    if guidance_mode != "off" and (guidance_inner or guidance_post):
+        assert body_model is not None
+        assert denoiser.include_hands, "Guidance needs a model with hands."
+    if window_size is None:
+        window_size = denoiser.window_size
+    rng = np.random.default_rng(seed)
+
+    # DDIM constants. We compute these in float64, and cast scalars to float32
+    # before they touch the state. This matches `sampling.Sampler`.
+    alpha_t, alpha_bar_t = compute_cosine_noise_schedule(timesteps=1000)
+    ddim_sigma_t = np.concatenate(
+        [
+            np.zeros((1,)),
+            np.sqrt((1.0 - alpha_bar_t[:-1]) / (1 - alpha_bar_t[1:]) * (1 - alpha_t))
+            * eta,
+        ]
+    )
+
+    # Offset the T_world_cpf transform to place the floor at z=0 for the
+    # denoiser network. All of the network outputs are local, so we don't need to
+    # unoffset when returning.
+    Ts_world_cpf = Ts_world_cpf.astype(np.float32)
+    Ts_world_cpf_shifted = Ts_world_cpf.copy()
+    Ts_world_cpf_shifted[..., 6] -= floor_z
+    T_cpf_tm1_cpf_t = np.asarray(
+        (
+            jaxlie.SE3(jnp.asarray(Ts_world_cpf[:-1, :])).inverse()
+            @ jaxlie.SE3(jnp.asarray(Ts_world_cpf[1:, :]))
+        ).wxyz_xyz
+    )
+    windows = OnnxStitchedWindows(
+        denoiser,
+        T_cpf_tm1_cpf_t,
+        T_world_cpf=Ts_world_cpf_shifted[1:, :],
+        window_size=window_size,
+        overlap_size=overlap_size,
+    )
+
+    seq_len = Ts_world_cpf.shape[0] - 1
+    if initial_noise is None:
+        x_t_packed = rng.standard_normal(
+            (num_samples, seq_len, denoiser.d_state), dtype=np.float32
+        )
+    else:
+        assert initial_noise.shape == (num_samples, seq_len, denoiser.d_state)
+        x_t_packed = initial_noise.astype(np.float32)
+    if step_noise is not None:
+        assert step_noise.shape == (len(ts) - 1, *x_t_packed.shape)
+
+    start_time = None
+    for i in tqdm(range(len(ts) - 1)):
+        t = ts[i]
+        t_next = ts[i + 1]
+
+        x_0_packed_pred = project_body_rotmats_numpy(
+            denoise_with_stitching_onnx(
+                denoiser,
+                x_t_packed,
+                t,
+                windows,
+                windows_per_batch=windows_per_batch,
+            )
+        )
+        if np.any(np.isnan(x_0_packed_pred)):
+            print("found nan", i)
+
+        if guidance_mode != "off" and guidance_inner:
+            assert body_model is not None
+            x_0_packed_pred = _guidance_numpy(
+                x_0_packed_pred,
+                # It's important that we _don't_ use the shifted transforms here.
+                Ts_world_cpf=Ts_world_cpf[1:, :],
+                body_model=body_model,
+                guidance_mode=guidance_mode,
+                phase="inner",
+                hamer_detections=hamer_detections,
+                aria_detections=aria_detections,
+                verbose=guidance_verbose,
+            )
+
+        if start_time is None:
+            start_time = time.time()
+
+        # DDIM update; see `Sampler.step()`.
+        sigma = min(ddim_sigma_t[t], np.sqrt(1 - alpha_bar_t[t_next]))
+        x_t_packed = (
+            np.float32(np.sqrt(alpha_bar_t[t_next])) * x_0_packed_pred
+            + (
+                np.float32(np.sqrt(max(1 - alpha_bar_t[t_next] - sigma**2, 0.0)))
+                * (x_t_packed - np.float32(np.sqrt(alpha_bar_t[t])) * x_0_packed_pred)
+                / np.float32(np.sqrt(1 - alpha_bar_t[t] + 1e-1))
+            )
+            + np.float32(sigma)
+            * (
+                rng.standard_normal(x_t_packed.shape, dtype=np.float32)
+                if step_noise is None
+                else step_noise[i].astype(np.float32)
+            )
+        )
+
+    if guidance_mode != "off" and guidance_post:
+        assert body_model is not None
+        x_t_packed = _guidance_numpy(
+            x_t_packed,
+            # It's important that we _don't_ use the shifted transforms here.
+            Ts_world_cpf=Ts_world_cpf[1:, :],
+            body_model=body_model,
+            guidance_mode=guidance_mode,
+            phase="post",
+            hamer_detections=hamer_detections,
+            aria_detections=aria_detections,
+            verbose=guidance_verbose,
+        )
+    assert start_time is not None
+    print("RUNTIME (exclude first optimization)", time.time() - start_time)
+    return x_t_packed
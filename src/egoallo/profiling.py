@@ -0,0 +1,124 @@
+"""Timing and profiling hooks for sampling."""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import time
+from pathlib import Path
+from typing import Any, ContextManager, Generator
+
+import jax.profiler
+import numpy as np
+import torch
+import torch.profiler
+
+
+class SamplingProfiler:
+    """Records wall-clock time for each phase of sampling.
+
+    Pass an instance as `profiler=` to `run_sampling_with_stitching()` or
+    `run_sampling_batched()`. Each phase (denoiser forward pass, unpacking and
+    rotation projection, guidance, etc) is recorded as a span, with the
+    denoising step index when applicable. CUDA is synchronized at span
+    boundaries so timings are accurate; this adds some overhead, which is why
+    profiling is opt-in.
+
+    Spans are also annotated in `torch.profiler` and `jax.profiler` traces,
+    which can be recorded by wrapping sampling in `trace()`.
+    """
+
+    def __init__(
+        self,
+        torch_trace_path: Path | None = None,
+        jax_trace_dir: Path | None = None,
+    ) -> None:
+        self.torch_trace_path = torch_trace_path
+        """If set, `trace()` will write a Chrome trace from `torch.profiler` here."""
+        self.jax_trace_dir = jax_trace_dir
+        """If set, `trace()` will write a `jax.profiler` trace to this directory."""
+        self.spans = list[tuple[str, int | None, float]]()
+        """Recorded spans, as (phase name, step index, seconds)."""
+
+    @contextlib.contextmanager
+    def span(self, name: str, step: int | None = None) -> Generator[None, None, None]:
+        """Time a phase of sampling."""
+        _synchronize()
+        start_time = time.perf_counter()
+        with torch.profiler.record_function(name), jax.profiler.TraceAnnotation(name):
+            yield
+        _synchronize()
+        self.spans.append((name, step, time.perf_counter() - start_time))
+
+    @contextlib.contextmanager
+    def trace(self) -> Generator[None, None, None]:
+        """Record `torch.profiler` and `jax.profiler` traces, if their output
+        paths are set. Otherwise, this does nothing."""
+        with contextlib.ExitStack() as stack:
+            torch_profile = None
+            if self.torch_trace_path is not None:
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                torch_profile = stack.enter_context(
+                    torch.profiler.profile(activities=activities)
+                )
+            if self.jax_trace_dir is not None:
+                stack.enter_context(jax.profiler.trace(str(self.jax_trace_dir)))
+            yield
+        if torch_profile is not None:
+            assert self.torch_trace_path is not None
+            self.torch_trace_path.parent.mkdir(parents=True, exist_ok=True)
+            torch_profile.export_chrome_trace(str(self.torch_trace_path))
+
+    def summary(self) -> dict[str, Any]:
+        """Summarize recorded spans, grouped by phase. Phases are ordered by
+        when they first ran."""
+        phases: dict[str, dict[str, Any]] = {}
+        for name, step, seconds in self.spans:
+            phase = phases.setdefault(name, {"steps": [], "seconds": []})
+            phase["steps"].append(step)
+            phase["seconds"].append(seconds)
+
+        out: dict[str, Any] = {}
+        for name, phase in phases.items():
+            seconds = np.array(phase["seconds"])
+            out[name] = {
+                "count": len(seconds),
+                "total_s": float(np.sum(seconds)),
+                "mean_s": float(np.mean(seconds)),
+                "max_s": float(np.max(seconds)),
+            }
+            if any(step is not None for step in phase["steps"]):
+                out[name]["per_step_s"] = seconds.tolist()
+        return {
+            "phases": out,
+            "total_s": float(sum(seconds for _, _, seconds in self.spans)),
+        }
+
+    def print_summary(self) -> None:
+        summary = self.summary()
+        print(f"{'phase':>16} {'count':>6} {'total (s)':>10} {'mean (s)':>10}")
+        for name, phase in summary["phases"].items():
+            print(
+                f"{name:>16} {phase['count']:>6} {phase['total_s']:>10.3f}"
+                f" {phase['mean_s']:>10.4f}"
+            )
+        print(f"{'total':>16} {'':>6} {summary['total_s']:>10.3f}")
+
+    def save_json(self, path: Path) -> None:
+        path.write_text(json.dumps(self.summary(), indent=2))
+
+
+def profile_span(
+    profiler: SamplingProfiler | None, name: str, step: int | None = None
+) -> ContextManager[None]:
+    """Time a phase of sampling if a profiler is passed in. Otherwise, a no-op."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.span(name, step)
+
+
+def _synchronize() -> None:
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
@@ -1,30 +1,56 @@
 from __future__ import annotations
 
+import dataclasses
+import itertools
 import time
+from pathlib import Path
+from typing import Callable, Literal, Sequence, assert_never
 
 import numpy as np
 import torch
-from jaxtyping import Float
+import yaml
+from jaxtyping import Bool, Float, Int
 from torch import Tensor
 from tqdm.auto import tqdm
 
 from . import fncsmpl, network
-from .guidance_optimizer_jax import GuidanceMode, do_guidance_optimization
+from .compiled_denoiser import StaticShapeDenoiser
+from .guidance_optimizer_jax import (
+    GuidanceMode,
+    GuidanceSession,
+    JaxGuidanceParams,
+    do_guidance_optimization,
+)
 from .hand_detection_structs import (
     CorrespondedAriaHandWristPoseDetections,
     CorrespondedHamerDetections,
 )
+from .profiling import SamplingProfiler, profile_span
+from .stitching_plan import StitchingPlan
 from .tensor_dataclass import TensorDataclass
-from .transforms import SE3
+from .transforms import SE3, SO3
+
 
+Denoiser = network.EgoDenoiser | StaticShapeDenoiser
+"""Denoisers that can be used for sampling."""
 
-def quadratic_ts() -> np.ndarray:
-    """DDIM sampling schedule."""
+
+def quadratic_ts(num_steps: int | None = None) -> np.ndarray:
+    """DDIM sampling schedule. Returns `num_steps + 1` timesteps, from 1000
+    down to 0. If `num_steps` is None, we use the original 30-step schedule."""
     end_step = 0
     start_step = 1000
-    x = np.arange(end_step, int(np.sqrt(start_step))) ** 2
-    x[-1] = start_step
-    return x[::-1]
+    if num_steps is None:
+        x = np.arange(end_step, int(np.sqrt(start_step))) ** 2
+        x[-1] = start_step
+        return x[::-1]
+
+    assert num_steps >= 1
+    x = np.round(np.linspace(0.0, 1.0, num_steps + 1) ** 2 * start_step).astype(
+        np.int64
+    )
+    # Very large step counts can round to duplicate timesteps.
+    return np.unique(x)[::-1]
 
 
 class CosineNoiseScheduleConstants(TensorDataclass):
@@ -56,8 +82,666 @@ class CosineNoiseScheduleConstants(TensorDataclass):
         )
 
 
+@dataclasses.dataclass(frozen=True)
+class SamplerConfig:
+    """Which update rule to use for going from one noise level to the next."""
+
+    method: Literal["ddim", "dpmpp_2m", "euler_ancestral"] = "ddim"
+    """Sampler type. `ddim` matches the original EgoAllo sampler;
+    `dpmpp_2m` (DPM-Solver++ 2M) is deterministic and tends to hold up better at
+    low step counts; `euler_ancestral` is stochastic."""
+    num_steps: int | None = None
+    """Number of denoising steps, each of which requires one denoiser forward
+    pass. If None, we use the original 30-step quadratic schedule."""
+    eta: float = 0.8
+    """Scale for the noise injected at each step. Ignored by `dpmpp_2m`."""
+    ts: tuple[int, ...] | None = None
+    """Explicit timesteps, from 1000 down to 0. Overrides `num_steps`. Used
+    for distilled students, which are trained for a specific schedule; see
+    `load_distilled_sampler_config()`."""
+
+    def get_ts(self) -> np.ndarray:
+        if self.ts is not None:
+            assert self.ts[0] == 1000 and self.ts[-1] == 0
+            assert all(t > t_next for t, t_next in zip(self.ts[:-1], self.ts[1:]))
+            return np.array(self.ts, dtype=np.int64)
+        return quadratic_ts(self.num_steps)
+
+    def make(self, noise_constants: CosineNoiseScheduleConstants) -> Sampler:
+        return Sampler(self, noise_constants, self.get_ts())
+
+
+DISTILLED_SAMPLER_CONFIG_FILENAME = "sampler_config.yaml"
+"""Filename for the sampler that a distilled student was trained for. This is
+placed next to `model_config.yaml`."""
+
+
+def make_distilled_sampler_config(ts: np.ndarray) -> SamplerConfig:
+    """Sampler for a student distilled by `1b_distill_motion_prior.py`. Students
+    are trained to take deterministic DDIM steps between the timesteps in
+    `ts`."""
+    return SamplerConfig(method="ddim", eta=0.0, ts=tuple(int(t) for t in ts))
+
+
+def load_distilled_sampler_config(checkpoint_dir: Path) -> SamplerConfig | None:
+    """Load the sampler that a distilled student checkpoint was trained for.
+    Returns None if the checkpoint isn't from a distilled student."""
+    path = checkpoint_dir.absolute().parent / DISTILLED_SAMPLER_CONFIG_FILENAME
+    if not path.exists():
+        return None
+    config = yaml.load(path.read_text(), Loader=yaml.Loader)
+    assert isinstance(config, SamplerConfig)
+    return config
+
+
+class Sampler:
+    """Sampler state. Created via `SamplerConfig.make()`.
+
+    `step()` should be called in order for each step index `i`. It takes the
+    noisy state at `ts[i]` and the denoiser's clean prediction, and returns the
+    noisy state at `ts[i + 1]`."""
+
+    def __init__(
+        self,
+        config: SamplerConfig,
+        noise_constants: CosineNoiseScheduleConstants,
+        ts: np.ndarray,
+    ) -> None:
+        self.config = config
+        self.ts = ts
+        self.alpha_bar_t = noise_constants.alpha_bar_t
+        self._ddim_sigma_t = torch.cat(
+            [
+                torch.zeros((1,), device=self.alpha_bar_t.device),
+                torch.sqrt(
+                    (1.0 - self.alpha_bar_t[:-1])
+                    / (1 - self.alpha_bar_t[1:])
+                    * (1 - noise_constants.alpha_t)
+                )
+                * config.eta,
+            ]
+        )
+        self._prev_x_0_pred: Tensor | None = None
+
+    def step(
+        self,
+        i: int,
+        x_t: Float[Tensor, "*batch d_state"],
+        x_0_pred: Float[Tensor, "*batch d_state"],
+    ) -> Float[Tensor, "*batch d_state"]:
+        t = self.ts[i]
+        t_next = self.ts[i + 1]
+        alpha_bar_t = self.alpha_bar_t
+        method = self.config.method
+
+        if method == "ddim":
+            # This is the update rule used by the original EgoAllo sampler,
+            # which uses the single-step posterior variance and damps the
+            # noise direction slightly. With large steps, sigma can exceed the
+            # noise level we're stepping to; this doesn't happen for the
+            # default schedule.
+            sigma = torch.minimum(
+                self._ddim_sigma_t[t], torch.sqrt(1 - alpha_bar_t[t_next])
+            )
+            return (
+                torch.sqrt(alpha_bar_t[t_next]) * x_0_pred
+                + (
+                    torch.sqrt(torch.clamp(1 - alpha_bar_t[t_next] - sigma**2, min=0.0))
+                    * (x_t - torch.sqrt(alpha_bar_t[t]) * x_0_pred)
+                    / torch.sqrt(1 - alpha_bar_t[t] + 1e-1)
+                )
+                + sigma * torch.randn(x_0_pred.shape, device=x_t.device)
+            )
+
+        elif method == "dpmpp_2m":
+            # DPM-Solver++(2M), from Lu et al. 2022. Works in terms of
+            # lambda = log(alpha / sigma), using the previous step's clean
+            # prediction for a second-order correction.
+            prev_x_0_pred = self._prev_x_0_pred
+            self._prev_x_0_pred = x_0_pred
+            if t_next == 0:
+                return x_0_pred
+
+            def lambda_(t: int) -> Tensor:
+                return 0.5 * torch.log(alpha_bar_t[t] / (1.0 - alpha_bar_t[t]))
+
+            h = lambda_(t_next) - lambda_(t)
+            if prev_x_0_pred is None:
+                denoised = x_0_pred
+            else:
+                h_prev = lambda_(t) - lambda_(self.ts[i - 1])
+                r = h_prev / h
+                denoised = (1.0 + 1.0 / (2.0 * r)) * x_0_pred - (
+                    1.0 / (2.0 * r)
+                ) * prev_x_0_pred
+            return (
+                torch.sqrt((1.0 - alpha_bar_t[t_next]) / (1.0 - alpha_bar_t[t])) * x_t
+                - torch.sqrt(alpha_bar_t[t_next]) * torch.expm1(-h) * denoised
+            ).to(x_t.dtype)
+
+        elif method == "euler_ancestral":
+            # Euler-ancestral in variance-exploding coordinates, where
+            # x_ve = x / sqrt(alpha_bar) and sigma = sqrt((1 - alpha_bar) / alpha_bar).
+            # Coefficients are folded back into variance-preserving coordinates
+            # to avoid dividing by a near-zero alpha_bar at t=1000.
+            sigma = torch.sqrt((1.0 - alpha_bar_t[t]) / alpha_bar_t[t])
+            sigma_next = torch.sqrt((1.0 - alpha_bar_t[t_next]) / alpha_bar_t[t_next])
+            sigma_up = torch.minimum(
+                sigma_next,
+                self.config.eta
+                * torch.sqrt(sigma_next**2 * (sigma**2 - sigma_next**2) / sigma**2),
+            )
+            sigma_down = torch.sqrt(sigma_next**2 - sigma_up**2)
+            sqrt_alpha_bar_next = torch.sqrt(alpha_bar_t[t_next])
+            return (
+                sqrt_alpha_bar_next
+                * sigma_down
+                / torch.sqrt(1.0 - alpha_bar_t[t])
+                * x_t
+                + sqrt_alpha_bar_next * (1.0 - sigma_down / sigma) * x_0_pred
+                + sqrt_alpha_bar_next
+                * sigma_up
+                * torch.randn(x_0_pred.shape, device=x_t.device)
+            ).to(x_t.dtype)
+
+        else:
+            assert_never(method)
+
+
+class StitchedWindows(TensorDataclass):
+    """Overlapping windows that we denoise separately and then stitch together.
+
+    Windows are padded to the length of the longest window; padded entries have
+    `mask=False` and zero weight. This lets us run all windows through the
+    denoiser in a single batched forward pass, or slice out unpadded windows
+    one at a time.
+    """
+
+    starts: tuple[int, ...]
+    lengths: tuple[int, ...]
+    indices: Int[Tensor, "num_windows window_size"]
+    """Timestep index for each window entry. Clamped to be valid for padding."""
+    mask: Bool[Tensor, "num_windows window_size"]
+    """False for padded entries."""
+    weights: Float[Tensor, "num_windows window_size"]
+    """Overlap weights for blending windows. Zero for padded entries."""
+    weight_sum: Float[Tensor, "seq_len"]
+    """Sum of overlap weights for each timestep, for normalization."""
+
+    cond_latent: Float[Tensor, "num_windows window_size d_latent"]
+    """Latent conditioning for each window. This doesn't change between
+    denoising steps, so we compute it once when the windows are made."""
+
+    @staticmethod
+    def make(
+        denoiser_network: Denoiser,
+        T_cpf_tm1_cpf_t: Float[Tensor, "seq_len 7"],
+        T_world_cpf: Float[Tensor, "seq_len 7"],
+        window_size: int,
+        overlap_size: int,
+    ) -> StitchedWindows:
+        """Chop a sequence into overlapping windows. `T_world_cpf` should
+        already be offset by one timestep relative to the full input
+        trajectory, so that it's aligned with `T_cpf_tm1_cpf_t`.
+
+        If `overlap_size` is 0, windows don't overlap and aren't blended. This
+        is useful for sequences that fit in a single window."""
+        (seq_len, _) = T_cpf_tm1_cpf_t.shape
+        assert T_world_cpf.shape == (seq_len, 7)
+        device = T_cpf_tm1_cpf_t.device
+
+        starts = tuple(range(0, seq_len, window_size - overlap_size))
+        lengths = tuple(min(start + window_size, seq_len) - start for start in starts)
+        assert all(length > 0 for length in lengths)
+
+        canonical_overlap_weights = (
+            torch.from_numpy(
+                np.minimum(
+                    # Make this shape /```\
+                    overlap_size,
+                    np.minimum(
+                        # Make this shape: /
+                        np.arange(1, seq_len + 1),
+                        # Make this shape: \
+                        np.arange(1, seq_len + 1)[::-1],
+                    ),
+                )
+                / overlap_size
+                if overlap_size > 0
+                else np.ones(seq_len),
+            )
+            .to(device)
+            .to(torch.float32)
+        )
+
+        # Pad every window to the length of the longest one.
+        padded_size = max(lengths)
+        offsets = torch.arange(padded_size, device=device)
+        mask = offsets[None, :] < torch.tensor(lengths, device=device)[:, None]
+        indices = torch.clamp(
+            torch.tensor(starts, device=device)[:, None] + offsets[None, :],
+            max=seq_len - 1,
+        )
+        weights = torch.where(mask, canonical_overlap_weights[None, :padded_size], 0.0)
+        weight_sum = torch.zeros((seq_len,), device=device).index_add_(
+            0, indices.flatten(), weights.flatten()
+        )
+
+        # Conditioning is computed per window, since some parameterizations
+        # (eg "canonicalized") depend on the first frame of each window.
+        with torch.no_grad():
+            cond_latent = denoiser_network.encode_cond(
+                T_world_cpf=T_world_cpf[indices],
+                T_cpf_tm1_cpf_t=T_cpf_tm1_cpf_t[indices],
+                hand_positions_wrt_cpf=None,  # TODO: this should be filled in!!
+            )
+
+        return StitchedWindows(
+            starts=starts,
+            lengths=lengths,
+            indices=indices,
+            mask=mask,
+            weights=weights,
+            weight_sum=weight_sum,
+            cond_latent=cond_latent,
+        )
+
+    @staticmethod
+    def concatenate(windows_list: Sequence[StitchedWindows]) -> StitchedWindows:
+        """Concatenate windows from several sequences. The result treats the
+        sequences as one long sequence, laid out back-to-back, with no windows
+        spanning two sequences. Windows are re-padded to the longest one."""
+        padded_size = max(w.indices.shape[1] for w in windows_list)
+        offsets = np.cumsum([0] + [w.weight_sum.shape[0] for w in windows_list])
+
+        def pad(x: Tensor, value: float | bool) -> Tensor:
+            return torch.nn.functional.pad(
+                x,
+                (*((0, 0) * (x.dim() - 2)), 0, padded_size - x.shape[1]),
+                value=value,
+            )
+
+        return StitchedWindows(
+            starts=tuple(
+                int(offset) + start
+                for w, offset in zip(windows_list, offsets)
+                for start in w.starts
+            ),
+            lengths=tuple(length for w in windows_list for length in w.lengths),
+            indices=torch.cat(
+                [
+                    # Padded entries need valid indices; we repeat the last one.
+                    torch.cat(
+                        [
+                            w.indices,
+                            w.indices[:, -1:].expand(
+                                (-1, padded_size - w.indices.shape[1])
+                            ),
+                        ],
+                        dim=1,
+                    )
+                    + int(offset)
+                    for w, offset in zip(windows_list, offsets)
+                ]
+            ),
+            mask=torch.cat([pad(w.mask, False) for w in windows_list]),
+            weights=torch.cat([pad(w.weights, 0.0) for w in windows_list]),
+            weight_sum=torch.cat([w.weight_sum for w in windows_list]),
+            cond_latent=torch.cat([pad(w.cond_latent, 0.0) for w in windows_list]),
+        )
+
+
+class WarmStart(TensorDataclass):
+    """A previous sampling result to warm-start from, aligned to the frames of
+    the sequence being sampled.
+
+    Instead of sampling from pure noise, frames covered by the previous
+    result are re-noised to an intermediate noise level, and only the
+    remaining denoising steps are run (SDEdit). Frames that aren't covered
+    are sampled from scratch, with covered frames held at the re-noised
+    previous result until the intermediate noise level is reached.
+    """
+
+    x_0_packed: Float[Tensor, "num_samples seq_len d_state"]
+    """Previous result. `num_samples` can be 1, which is shared by every
+    sample. Zero for frames that aren't covered."""
+    mask: Bool[Tensor, "seq_len"]
+    """True for frames covered by the previous result."""
+
+    @staticmethod
+    def make(
+        traj: network.EgoDenoiseTraj,
+        traj_frame_nums: Int[np.ndarray, "traj_len"],
+        frame_nums: Int[np.ndarray, "seq_len"],
+    ) -> WarmStart:
+        """Align a previous result to a new sequence. Frame numbers are used
+        to match timesteps, for example indices into the input trajectory."""
+        x_0_packed_prev = traj.pack()
+        (num_samples, traj_len, d_state) = x_0_packed_prev.shape
+        assert traj_frame_nums.shape == (traj_len,)
+
+        _, seq_indices, traj_indices = np.intersect1d(
+            frame_nums, traj_frame_nums, return_indices=True
+        )
+        device = x_0_packed_prev.device
+        seq_indices = torch.from_numpy(seq_indices).to(device)
+        traj_indices = torch.from_numpy(traj_indices).to(device)
+
+        x_0_packed = x_0_packed_prev.new_zeros((num_samples, len(frame_nums), d_state))
+        x_0_packed[:, seq_indices, :] = x_0_packed_prev[:, traj_indices, :]
+        mask = torch.zeros((len(frame_nums),), dtype=torch.bool, device=device)
+        mask[seq_indices] = True
+        return WarmStart(x_0_packed=x_0_packed, mask=mask)
+
+    @staticmethod
+    def load(
+        npz_path: Path,
+        frame_nums: Int[np.ndarray, "seq_len"],
+        include_hands: bool,
+    ) -> WarmStart:
+        """Load a result saved by `3_aria_inference.py`, and align it to a new
+        sequence using the saved frame numbers."""
+        outputs = np.load(npz_path)
+        assert "contacts" in outputs, f"{npz_path} was saved without contacts."
+
+        def as_rotmats(quats: np.ndarray) -> Tensor:
+            return SO3(torch.from_numpy(quats)).as_matrix().to(torch.float32)
+
+        traj = network.EgoDenoiseTraj(
+            betas=torch.from_numpy(outputs["betas"]).to(torch.float32),
+            body_rotmats=as_rotmats(outputs["body_quats"]),
+            contacts=torch.from_numpy(outputs["contacts"]).to(torch.float32),
+            hand_rotmats=as_rotmats(
+                np.concatenate(
+                    [outputs["left_hand_quats"], outputs["right_hand_quats"]], axis=-2
+                )
+            )
+            if include_hands
+            else None,
+        )
+        warm_start = WarmStart.make(traj, outputs["frame_nums"], frame_nums)
+        print(
+            f"Warm-starting {int(warm_start.mask.sum())}/{len(frame_nums)} frames"
+            f" from {npz_path}"
+        )
+        return warm_start
+
+
+class AdaptiveStepSkipping:
+    """Skips denoiser forward passes for windows whose clean predictions have
+    converged. Pass an instance as `step_skipping=` to
+    `run_sampling_with_stitching()` or `run_sampling_batched()`.
+
+    After each denoising step, we compute the RMS change in each window's
+    predicted `x_0` since the previous step, and take the max over samples.
+    Windows where this falls below `tolerance` are frozen: their last
+    prediction is reused for the remaining steps, instead of running the
+    denoiser. Once every window is frozen, the remaining steps can't change
+    the clean prediction, so we jump straight to the final step, which
+    returns it. Inner guidance is also skipped for sequences whose clean
+    prediction didn't change.
+
+    Predictions for every (sample, window) pair are kept in memory, which is
+    about as large as the noisy state itself. Counters accumulate over
+    sampling runs, so one instance can be used for a whole evaluation.
+    """
+
+    def __init__(self, tolerance: float = 1e-2) -> None:
+        self.tolerance = tolerance
+        """Threshold for the RMS change in packed `x_0` values, which are
+        mostly rotation matrix entries."""
+        self.forwards_run = 0
+        """Number of (sample, window) forward passes that were run."""
+        self.forwards_total = 0
+        """Number of (sample, window) forward passes without skipping."""
+        self.guidance_solves_run = 0
+        self.guidance_solves_skipped = 0
+
+        self._window_preds: Tensor | None = None
+        self._has_pred: Tensor | None = None
+        self._step_changes: Tensor | None = None
+        self._frozen: Tensor | None = None
+
+    @property
+    def forwards_saved(self) -> int:
+        return self.forwards_total - self.forwards_run
+
+    def start(
+        self,
+        windows: StitchedWindows,
+        num_samples: int,
+        d_state: int,
+        num_steps: int,
+    ) -> None:
+        """Reset per-run state. Called at the start of sampling."""
+        (num_windows, window_size) = windows.mask.shape
+        device = windows.mask.device
+        self._window_preds = torch.zeros(
+            (num_samples, num_windows, window_size, d_state), device=device
+        )
+        self._has_pred = torch.zeros((num_windows,), dtype=torch.bool, device=device)
+        self._step_changes = torch.full((num_windows,), -torch.inf, device=device)
+        self._frozen = torch.zeros((num_windows,), dtype=torch.bool, device=device)
+        self.forwards_total += num_steps * num_windows * num_samples
+
+    def get_window_ids(self, frozen: bool) -> list[int]:
+        assert self._frozen is not None
+        return torch.nonzero(self._frozen == frozen).flatten().tolist()
+
+    def all_frozen(self) -> bool:
+        assert self._frozen is not None
+        return bool(torch.all(self._frozen))
+
+    def get_window_preds(
+        self, window_ids: Int[Tensor, "chunk_windows"]
+    ) -> Float[Tensor, "num_samples chunk_windows window_size d_state"]:
+        assert self._window_preds is not None
+        return self._window_preds[:, window_ids]
+
+    def record(
+        self,
+        windows: StitchedWindows,
+        window_ids: Int[Tensor, "chunk_windows"],
+        sample_slice: slice,
+        x_0_windows: Float[Tensor, "chunk_samples chunk_windows padded_size d_state"],
+    ) -> None:
+        """Record new predictions for some windows and samples."""
+        assert self._window_preds is not None
+        assert self._has_pred is not None
+        assert self._step_changes is not None
+        (chunk_samples, chunk_windows, padded_size, d_state) = x_0_windows.shape
+        self.forwards_run += chunk_samples * chunk_windows
+
+        # RMS change over unpadded entries.
+        x_0_windows = x_0_windows.to(self._window_preds.dtype)
+        mask = windows.mask[window_ids, :padded_size]
+        prev_x_0_windows = self._window_preds[sample_slice, window_ids, :padded_size]
+        rms_change = torch.sqrt(
+            torch.sum(
+                torch.sum((x_0_windows - prev_x_0_windows) ** 2, dim=-1) * mask,
+                dim=-1,
+            )
+            / (torch.sum(mask, dim=-1) * d_state)
+        )
+        self._step_changes[window_ids] = torch.maximum(
+            self._step_changes[window_ids],
+            torch.where(
+                self._has_pred[window_ids], torch.amax(rms_change, dim=0), torch.inf
+            ),
+        )
+        self._window_preds[sample_slice, window_ids, :padded_size] = x_0_windows
+
+    def end_step(self) -> None:
+        """Freeze windows that have converged. Called after each denoising step."""
+        assert self._has_pred is not None
+        assert self._step_changes is not None
+        assert self._frozen is not None
+        # Windows that weren't run have a change of -inf.
+        was_run = self._step_changes > -torch.inf
+        self._has_pred |= was_run
+        self._frozen |= was_run & (self._step_changes < self.tolerance)
+        self._step_changes.fill_(-torch.inf)
+
+
+def denoise_with_stitching(
+    denoiser_network: Denoiser,
+    x_t_packed: Float[Tensor, "num_samples seq_len d_state"],
+    t: int,
+    windows: StitchedWindows,
+    windows_per_batch: int | None,
+    decoder_cache: network.EgoDenoiserDecoderCache | None = None,
+    samples_per_batch: int | None = None,
+    step_skipping: AdaptiveStepSkipping | None = None,
+    window_ids: Sequence[int] | None = None,
+) -> Float[Tensor, "num_samples seq_len d_state"]:
+    """Predict a clean trajectory by denoising each window and blending the
+    overlapping regions.
+
+    Windows are padded and run through the denoiser `windows_per_batch` at a
+    time, or all in a single forward pass if `windows_per_batch` is None.
+    Similarly, samples can be split across forward passes with
+    `samples_per_batch` to bound peak memory.
+
+    If `decoder_cache` is passed in, it should contain precomputed encoder
+    outputs for noise level `t`, with a leading window axis. Only the decoder
+    is then run.
+
+    If `step_skipping` is passed in, only windows that haven't converged are
+    run; frozen windows reuse their last prediction.
+
+    If `window_ids` is passed in, only those windows are run. Outputs for
+    frames that are also covered by other windows are then only partially
+    weighted, so the caller should overwrite them.
+    """
+    (num_samples, seq_len, d_state) = x_t_packed.shape
+    assert windows.weight_sum.shape == (seq_len,)
+    num_windows = len(windows.starts)
+    device = x_t_packed.device
+
+    active_window_ids = list(range(num_windows)) if window_ids is None else window_ids
+    frozen_window_ids: set[int] = set()
+    if step_skipping is not None:
+        frozen_window_ids = set(step_skipping.get_window_ids(frozen=True))
+        active_window_ids = [i for i in active_window_ids if i not in frozen_window_ids]
+    if windows_per_batch is None:
+        windows_per_batch = num_windows
+    if samples_per_batch is None:
+        samples_per_batch = num_samples
+
+    x_0_packed_pred = torch.zeros_like(x_t_packed)
+
+    def add_windows(
+        window_index: Int[Tensor, "chunk_windows"],
+        sample_slice: slice,
+        x_0_windows: Float[Tensor, "chunk_samples chunk_windows padded_size d_state"],
+    ) -> None:
+        """Scatter-add weighted window predictions back into the sequence."""
+        (chunk_samples, chunk_windows, padded_size, _) = x_0_windows.shape
+        x_0_packed_pred[sample_slice].index_add_(
+            1,
+            windows.indices[window_index, :padded_size].flatten(),
+            (
+                x_0_windows
+                * windows.weights[window_index, :padded_size][None, :, :, None]
+            ).reshape((chunk_samples, chunk_windows * padded_size, d_state)),
+        )
+
+    for chunk_window_ids, sample_slice in itertools.product(
+        [
+            active_window_ids[i : i + windows_per_batch]
+            for i in range(0, len(active_window_ids), windows_per_batch)
+        ],
+        [
+            slice(i, min(i + samples_per_batch, num_samples))
+            for i in range(0, num_samples, samples_per_batch)
+        ],
+    ):
+        # Windows are flattened into the batch axis, with shape
+        # (chunk_samples, chunk_windows) -> (chunk_samples * chunk_windows,).
+        # Padding is trimmed to the longest window in the chunk.
+        window_index = torch.tensor(chunk_window_ids, device=device)
+        chunk_lengths = [windows.lengths[i] for i in chunk_window_ids]
+        chunk_windows = len(chunk_lengths)
+        chunk_samples = sample_slice.stop - sample_slice.start
+        padded_size = max(chunk_lengths)
+
+        def flatten_windows(x: Tensor) -> Tensor:
+            x = x[window_index]
+            return (
+                x[None]
+                .expand((chunk_samples, *x.shape))
+                .reshape((chunk_samples * chunk_windows, *x.shape[1:]))
+            )
+
+        indices = windows.indices[window_index, :padded_size]
+        x_t_windows = x_t_packed[sample_slice, indices, :].reshape(
+            (chunk_samples * chunk_windows, padded_size, d_state)
+        )
+        mask = (
+            None
+            if all(length == padded_size for length in chunk_lengths)
+            else flatten_windows(windows.mask[:, :padded_size])
+        )
+        if decoder_cache is None:
+            x_0_windows = denoiser_network.forward(
+                x_t_windows,
+                torch.tensor([t], device=device).expand(
+                    (chunk_samples * chunk_windows,)
+                ),
+                T_cpf_tm1_cpf_t=None,
+                T_world_cpf=None,
+                project_output_rotmats=False,
+                hand_positions_wrt_cpf=None,
+                mask=mask,
+                cond_latent=flatten_windows(windows.cond_latent[:, :padded_size, :]),
+            )
+        else:
+            x_0_windows = denoiser_network.forward_decoder(
+                x_t_windows,
+                decoder_cache.map(flatten_windows),
+                project_output_rotmats=False,
+                mask=mask,
+            )
+        x_0_windows = x_0_windows.reshape(
+            (chunk_samples, chunk_windows, padded_size, d_state)
+        )
+        if step_skipping is not None:
+            step_skipping.record(windows, window_index, sample_slice, x_0_windows)
+        add_windows(window_index, sample_slice, x_0_windows)
+
+    if step_skipping is not None:
+        if len(frozen_window_ids) > 0:
+            window_index = torch.tensor(sorted(frozen_window_ids), device=device)
+            add_windows(
+                window_index,
+                slice(0, num_samples),
+                step_skipping.get_window_preds(window_index).to(x_0_packed_pred.dtype),
+            )
+        step_skipping.end_step()
+
+    # Take the mean for overlapping regions.
+    return x_0_packed_pred / windows.weight_sum[None, :, None]
+
+
+class TrajectoryHistory:
+    """Step callback for `run_sampling_with_stitching()` that records noisy
+    states every `stride` denoising steps. States are moved to the CPU, so GPU
+    memory use isn't affected. Useful for debugging and visualization."""
+
+    def __init__(self, stride: int = 1) -> None:
+        assert stride >= 1
+        self.stride = stride
+        self.steps = list[int]()
+        self.trajs = list[network.EgoDenoiseTraj]()
+
+    def __call__(self, i: int, traj: network.EgoDenoiseTraj) -> None:
+        if i % self.stride == 0:
+            self.steps.append(i)
+            self.trajs.append(traj.map(lambda x: x.cpu()))
+
+
 def run_sampling_with_stitching(
-    denoiser_network: network.EgoDenoiser,
+    denoiser_network: Denoiser,
     body_model: fncsmpl.SmplhModel,
     guidance_mode: GuidanceMode,
     guidance_post: bool,
@@ -69,166 +753,412 @@ def run_sampling_with_stitching(
     num_samples: int,
     device: torch.device,
     guidance_verbose: bool = True,
+    batch_windows: bool = False,
+    cache_encoder: bool = False,
+    sampler: SamplerConfig = SamplerConfig(),
+    step_callback: Callable[[int, network.EgoDenoiseTraj], None] | None = None,
+    profiler: SamplingProfiler | None = None,
+    plan: StitchingPlan | None = None,
+    step_skipping: AdaptiveStepSkipping | None = None,
+    warm_start: WarmStart | None = None,
+    warm_start_noise_level: int = 100,
+    persistent_guidance: bool = False,
+    guidance_chunk_size: int | None = None,
 ) -> network.EgoDenoiseTraj:
-    # Offset the T_world_cpf transform to place the floor at z=0 for the
-    # denoiser network. All of the network outputs are local, so we don't need to
-    # unoffset when returning.
-    Ts_world_cpf_shifted = Ts_world_cpf.clone()
-    Ts_world_cpf_shifted[..., 6] -= floor_z
+    """Sample a body motion trajectory, conditioned on CPF poses.
+
+    Sequences longer than the denoiser's window size are chopped into
+    overlapping windows, which are blended together at each denoising step.
+    Setting `batch_windows=True` denoises all windows in a single batched
+    forward pass instead of looping over them; this is much faster for long
+    sequences.
+
+    Setting `cache_encoder=True` runs the denoiser's encoder once per window
+    for all noise levels before sampling, so each denoising step only runs the
+    decoder. The cache holds cross-attention keys and values for every
+    (noise level, window, decoder layer), so memory grows linearly with
+    sequence length. The encoder is shared across samples, so this helps most
+    when `num_samples > 1`.
+
+    `sampler` selects the update rule and number of denoising steps; the
+    default reproduces the original 30-step DDIM sampler.
+
+    Only the current noisy state is kept during sampling. To inspect
+    intermediate states, pass in a `step_callback`, which is called after each
+    denoising step with the step index and the new noisy state. See
+    `TrajectoryHistory` for a callback that records them.
+
+    If a `profiler` is passed in, wall-clock time is recorded for each phase
+    of sampling.
+
+    `plan` sets the window size, overlap, and how many windows and samples
+    are run in each forward pass; see `StitchingPlanner` for choosing one
+    from a memory budget. If set, `batch_windows` is ignored. Otherwise, we
+    use 128-frame windows with 32 frames of overlap.
+
+    If `step_skipping` is passed in, windows stop being denoised once their
+    clean predictions converge, and sampling ends early once every window has
+    converged. See `AdaptiveStepSkipping`.
+
+    If `warm_start` is passed in, frames covered by a previous result are
+    re-noised to `warm_start_noise_level`, and only the denoising steps below
+    that level are run for them; see `WarmStart`. With the default 30-step
+    schedule, a noise level of 100 leaves 10 steps.
+
+    With `persistent_guidance=True`, inner guidance keeps a
+    `GuidanceSession` for the sequence, so each denoising step's optimization
+    is warm-started from the previous one and can stop early.
+
+    If `guidance_chunk_size` is set, guidance for longer sequences is solved
+    in overlapping chunks of this many timesteps, in parallel; see
+    `JaxGuidanceParams.chunk_size`.
+    """
+    (traj,) = run_sampling_batched(
+        denoiser_network,
+        body_model=body_model,
+        guidance_mode=guidance_mode,
+        guidance_post=guidance_post,
+        guidance_inner=guidance_inner,
+        Ts_world_cpf=[Ts_world_cpf],
+        floor_z=[floor_z],
+        hamer_detections=[hamer_detections],
+        aria_detections=[aria_detections],
+        num_samples=num_samples,
+        device=device,
+        guidance_verbose=guidance_verbose,
+        batch_windows=batch_windows,
+        cache_encoder=cache_encoder,
+        sampler=sampler,
+        step_callback=None
+        if step_callback is None
+        else lambda i, trajs: step_callback(i, trajs[0]),
+        profiler=profiler,
+        plan=plan,
+        step_skipping=step_skipping,
+        warm_start=[warm_start],
+        warm_start_noise_level=warm_start_noise_level,
+        persistent_guidance=persistent_guidance,
+        guidance_chunk_size=guidance_chunk_size,
+    )
+    return traj
+
+
+def run_sampling_batched(
+    denoiser_network: Denoiser,
+    body_model: fncsmpl.SmplhModel,
+    guidance_mode: GuidanceMode,
+    guidance_post: bool,
+    guidance_inner: bool,
+    Ts_world_cpf: Sequence[Float[Tensor, "_ 7"]],
+    floor_z: Sequence[float],
+    hamer_detections: Sequence[None | CorrespondedHamerDetections] | None,
+    aria_detections: Sequence[None | CorrespondedAriaHandWristPoseDetections] | None,
+    num_samples: int,
+    device: torch.device,
+    guidance_verbose: bool = True,
+    batch_windows: bool = True,
+    cache_encoder: bool = False,
+    sampler: SamplerConfig = SamplerConfig(),
+    step_callback: Callable[[int, list[network.EgoDenoiseTraj]], None] | None = None,
+    profiler: SamplingProfiler | None = None,
+    plan: StitchingPlan | None = None,
+    step_skipping: AdaptiveStepSkipping | None = None,
+    warm_start: Sequence[WarmStart | None] | None = None,
+    warm_start_noise_level: int = 100,
+    persistent_guidance: bool = False,
+    guidance_chunk_size: int | None = None,
+) -> list[network.EgoDenoiseTraj]:
+    """Sample body motion for several trajectories at once, which can have
+    different lengths. Returns one trajectory per input.
+
+    Windows from all sequences are packed together and padded, so with
+    `batch_windows=True` each denoising step is a single forward pass over
+    every window of every sequence. Guidance is still run separately for
+    each sequence. `step_callback` receives one noisy state per sequence. See
+    `run_sampling_with_stitching()` for other arguments.
+    """
+    num_sequences = len(Ts_world_cpf)
+    assert len(floor_z) == num_sequences
+    if hamer_detections is None:
+        hamer_detections = [None] * num_sequences
+    if aria_detections is None:
+        aria_detections = [None] * num_sequences
+    assert len(hamer_detections) == len(aria_detections) == num_sequences
 
     noise_constants = CosineNoiseScheduleConstants.compute(timesteps=1000).to(
         device=device
     )
-    alpha_bar_t = noise_constants.alpha_bar_t
-    alpha_t = noise_constants.alpha_t
+    sampler_state = sampler.make(noise_constants)
+
+    if plan is None:
+        plan = StitchingPlan(windows_per_batch=None if batch_windows else 1)
 
-    T_cpf_tm1_cpf_t = (
-        SE3(Ts_world_cpf[..., :-1, :]).inverse() @ SE3(Ts_world_cpf[..., 1:, :])
-    ).wxyz_xyz
+    windows_list = list[StitchedWindows]()
+    for Ts, z in zip(Ts_world_cpf, floor_z):
+        # Offset the T_world_cpf transform to place the floor at z=0 for the
+        # denoiser network. All of the network outputs are local, so we don't need to
+        # unoffset when returning.
+        Ts_world_cpf_shifted = Ts.clone()
+        Ts_world_cpf_shifted[..., 6] -= z
+        T_cpf_tm1_cpf_t = (
+            SE3(Ts[..., :-1, :]).inverse() @ SE3(Ts[..., 1:, :])
+        ).wxyz_xyz
+        with profile_span(profiler, "make_windows"):
+            windows_list.append(
+                StitchedWindows.make(
+                    denoiser_network,
+                    T_cpf_tm1_cpf_t,
+                    T_world_cpf=Ts_world_cpf_shifted[1:, :],
+                    window_size=plan.window_size,
+                    overlap_size=plan.overlap_size,
+                )
+            )
+    windows = (
+        windows_list[0]
+        if num_sequences == 1
+        else StitchedWindows.concatenate(windows_list)
+    )
+
+    # Sequences are laid out back-to-back along the time axis.
+    seq_lens = [Ts.shape[0] - 1 for Ts in Ts_world_cpf]
+    seq_slices = [
+        slice(start, start + seq_len)
+        for start, seq_len in zip(np.cumsum([0] + seq_lens[:-1]).tolist(), seq_lens)
+    ]
 
     x_t_packed = torch.randn(
-        (num_samples, Ts_world_cpf.shape[0] - 1, denoiser_network.get_d_state()),
+        (num_samples, sum(seq_lens), denoiser_network.get_d_state()),
         device=device,
     )
-    x_t_list = [
-        network.EgoDenoiseTraj.unpack(
-            x_t_packed, include_hands=denoiser_network.config.include_hands
+    ts = sampler_state.ts
+
+    def get_guidance_params(
+        phase: Literal["inner", "post"], session: bool = False
+    ) -> JaxGuidanceParams | None:
+        if guidance_chunk_size is None:
+            return None
+        return dataclasses.replace(
+            JaxGuidanceParams.session_defaults(guidance_mode, phase)
+            if session
+            else JaxGuidanceParams.defaults(guidance_mode, phase),
+            chunk_size=guidance_chunk_size,
         )
-    ]
-    ts = quadratic_ts()
 
-    seq_len = x_t_packed.shape[1]
+    guidance_sessions = (
+        [
+            GuidanceSession(
+                # It's important that we _don't_ use the shifted transforms here.
+                Ts_world_cpf=Ts_world_cpf[j][1:, :],
+                body_model=body_model,
+                guidance_mode=guidance_mode,
+                phase="inner",
+                hamer_detections=hamer_detections[j],
+                aria_detections=aria_detections[j],
+                verbose=guidance_verbose,
+                guidance_params=get_guidance_params("inner", session=True),
+            )
+            for j in range(num_sequences)
+        ]
+        if persistent_guidance and guidance_mode != "off" and guidance_inner
+        else None
+    )
+
+    # For step skipping: the last clean prediction for each sequence before
+    # and after inner guidance. Guidance is deterministic, so if the input
+    # doesn't change, we can reuse the output.
+    guidance_inner_cache: list[tuple[Tensor, Tensor] | None] = [None] * num_sequences
+
+    # For warm starts: previous results for all sequences, laid out
+    # back-to-back like `x_t_packed`.
+    warm_x_0_packed = None
+    warm_mask = torch.zeros((sum(seq_lens),), dtype=torch.bool, device=device)
+    warm_t = 0
+    cold_window_ids = list(range(len(windows.starts)))
+    if warm_start is not None and any(w is not None for w in warm_start):
+        assert len(warm_start) == num_sequences
+        warm_x_0_packed = torch.zeros_like(x_t_packed)
+        for w, seq_slice in zip(warm_start, seq_slices):
+            if w is None:
+                continue
+            assert w.mask.shape == (seq_slice.stop - seq_slice.start,)
+            assert w.x_0_packed.shape[0] in (1, num_samples)
+            warm_x_0_packed[:, seq_slice, :] = w.x_0_packed.to(device)
+            warm_mask[seq_slice] = w.mask.to(device)
+
+        # Snap to the sampling schedule.
+        warm_t = int(np.max(ts[ts <= warm_start_noise_level]))
+        # Windows with frames that aren't covered need to be denoised at every
+        # noise level.
+        cold_window_ids = [
+            i
+            for i in range(len(windows.starts))
+            if torch.any(~warm_mask[windows.indices[i]] & windows.mask[i])
+        ]
+    if step_skipping is not None:
+        step_skipping.start(
+            windows,
+            num_samples=num_samples,
+            d_state=denoiser_network.get_d_state(),
+            num_steps=len(ts) - 1,
+        )
 
     start_time = None
 
-    window_size = 128
-    overlap_size = 32
-    canonical_overlap_weights = (
-        torch.from_numpy(
-            np.minimum(
-                # Make this shape /```\
-                overlap_size,
-                np.minimum(
-                    # Make this shape: /
-                    np.arange(1, seq_len + 1),
-                    # Make this shape: \
-                    np.arange(1, seq_len + 1)[::-1],
-                ),
+    decoder_cache = None
+    if cache_encoder:
+        with torch.inference_mode(), profile_span(profiler, "encoder_cache"):
+            decoder_cache = denoiser_network.precompute_decoder_cache(
+                torch.from_numpy(ts[:-1].copy()).to(device),
+                cond_latent=windows.cond_latent,
+                mask=windows.mask,
             )
-            / overlap_size,
-        )
-        .to(device)
-        .to(torch.float32)
-    )
+
     for i in tqdm(range(len(ts) - 1)):
         print(f"Sampling {i}/{len(ts) - 1}")
         t = ts[i]
-        t_next = ts[i + 1]
+
+        # Above the warm start noise level, warm-started frames are replaced
+        # with the re-noised previous result, and only windows with other
+        # frames are denoised.
+        warm_phase = warm_x_0_packed is not None and t > warm_t
+        if warm_x_0_packed is not None and t >= warm_t:
+            alpha_bar_t = noise_constants.alpha_bar_t[t].to(x_t_packed.dtype)
+            x_t_packed = torch.where(
+                warm_mask[None, :, None],
+                torch.sqrt(alpha_bar_t) * warm_x_0_packed
+                + torch.sqrt(1.0 - alpha_bar_t) * torch.randn_like(x_t_packed),
+                x_t_packed,
+            )
+            if warm_phase and len(cold_window_ids) == 0:
+                continue
 
         with torch.inference_mode():
-            # Chop everything into windows.
-            x_0_packed_pred = torch.zeros_like(x_t_packed)
-            overlap_weights = torch.zeros((1, seq_len, 1), device=x_t_packed.device)
-
-            # Denoise each window.
-            for start_t in range(0, seq_len, window_size - overlap_size):
-                end_t = min(start_t + window_size, seq_len)
-                assert end_t - start_t > 0
-                overlap_weights_slice = canonical_overlap_weights[
-                    None, : end_t - start_t, None
-                ]
-                overlap_weights[:, start_t:end_t, :] += overlap_weights_slice
-                x_0_packed_pred[:, start_t:end_t, :] += (
-                    denoiser_network.forward(
-                        x_t_packed[:, start_t:end_t, :],
-                        torch.tensor([t], device=device).expand((num_samples,)),
-                        T_cpf_tm1_cpf_t=T_cpf_tm1_cpf_t[None, start_t:end_t, :].repeat(
-                            (num_samples, 1, 1)
-                        ),
-                        T_world_cpf=Ts_world_cpf_shifted[
-                            None, start_t + 1 : end_t + 1, :
-                        ].repeat((num_samples, 1, 1)),
-                        project_output_rotmats=False,
-                        hand_positions_wrt_cpf=None,  # TODO: this should be filled in!!
-                        mask=None,
-                    )
-                    * overlap_weights_slice
+            with profile_span(profiler, "denoise", step=i):
+                x_0_packed_pred = denoise_with_stitching(
+                    denoiser_network,
+                    x_t_packed,
+                    t,
+                    windows,
+                    windows_per_batch=plan.windows_per_batch,
+                    decoder_cache=None
+                    if decoder_cache is None
+                    else decoder_cache.map(lambda x: x[i]),
+                    samples_per_batch=plan.samples_per_batch,
+                    step_skipping=step_skipping,
+                    window_ids=cold_window_ids if warm_phase else None,
+                )
+            with profile_span(profiler, "unpack_project", step=i):
+                x_0_packed_pred = network.EgoDenoiseTraj.unpack(
+                    x_0_packed_pred,
+                    include_hands=denoiser_network.config.include_hands,
+                    project_rotmats=True,
+                ).pack()
+            if warm_phase:
+                assert warm_x_0_packed is not None
+                x_0_packed_pred = torch.where(
+                    warm_mask[None, :, None], warm_x_0_packed, x_0_packed_pred
                 )
-
-            # Take the mean for overlapping regions.
-            x_0_packed_pred /= overlap_weights
-
-            x_0_packed_pred = network.EgoDenoiseTraj.unpack(
-                x_0_packed_pred,
-                include_hands=denoiser_network.config.include_hands,
-                project_rotmats=True,
-            ).pack()
 
         if torch.any(torch.isnan(x_0_packed_pred)):
             print("found nan", i)
-        sigma_t = torch.cat(
-            [
-                torch.zeros((1,), device=device),
-                torch.sqrt(
-                    (1.0 - alpha_bar_t[:-1]) / (1 - alpha_bar_t[1:]) * (1 - alpha_t)
-                )
-                * 0.8,
-            ]
-        )
 
         if guidance_mode != "off" and guidance_inner:
-            x_0_pred, _ = do_guidance_optimization(
-                # It's important that we _don't_ use the shifted transforms here.
-                Ts_world_cpf=Ts_world_cpf[1:, :],
-                traj=network.EgoDenoiseTraj.unpack(
-                    x_0_packed_pred, include_hands=denoiser_network.config.include_hands
-                ),
-                body_model=body_model,
-                guidance_mode=guidance_mode,
-                phase="inner",
-                hamer_detections=hamer_detections,
-                aria_detections=aria_detections,
-                verbose=guidance_verbose,
-            )
-            x_0_packed_pred = x_0_pred.pack()
-            del x_0_pred
+            x_0_packed_pred_parts = list[Tensor]()
+            for j in range(num_sequences):
+                if warm_phase and torch.all(warm_mask[seq_slices[j]]):
+                    # Fully warm-started sequences aren't being denoised yet.
+                    x_0_packed_pred_parts.append(x_0_packed_pred[:, seq_slices[j], :])
+                    continue
+                cached = guidance_inner_cache[j]
+                if cached is not None and torch.equal(
+                    cached[0], x_0_packed_pred[:, seq_slices[j], :]
+                ):
+                    assert step_skipping is not None
+                    step_skipping.guidance_solves_skipped += 1
+                    x_0_packed_pred_parts.append(cached[1])
+                    continue
+                traj_pred = network.EgoDenoiseTraj.unpack(
+                    x_0_packed_pred[:, seq_slices[j], :],
+                    include_hands=denoiser_network.config.include_hands,
+                )
+                with profile_span(profiler, "guidance_inner", step=i):
+                    if guidance_sessions is not None:
+                        x_0_pred, _ = guidance_sessions[j](traj_pred)
+                    else:
+                        x_0_pred, _ = do_guidance_optimization(
+                            # It's important that we _don't_ use the shifted transforms here.
+                            Ts_world_cpf=Ts_world_cpf[j][1:, :],
+                            traj=traj_pred,
+                            body_model=body_model,
+                            guidance_mode=guidance_mode,
+                            phase="inner",
+                            hamer_detections=hamer_detections[j],
+                            aria_detections=aria_detections[j],
+                            verbose=guidance_verbose,
+                            guidance_params=get_guidance_params("inner"),
+                        )
+                del traj_pred
+                x_0_packed_pred_parts.append(x_0_pred.pack())
+                del x_0_pred
+                if step_skipping is not None:
+                    step_skipping.guidance_solves_run += 1
+                    guidance_inner_cache[j] = (
+                        x_0_packed_pred[:, seq_slices[j], :],
+                        x_0_packed_pred_parts[-1],
+                    )
+            x_0_packed_pred = torch.cat(x_0_packed_pred_parts, dim=1)
 
         if start_time is None:
             start_time = time.time()
 
-        # print(sigma_t)
-        x_t_packed = (
-            torch.sqrt(alpha_bar_t[t_next]) * x_0_packed_pred
-            + (
-                torch.sqrt(1 - alpha_bar_t[t_next] - sigma_t[t] ** 2)
-                * (x_t_packed - torch.sqrt(alpha_bar_t[t]) * x_0_packed_pred)
-                / torch.sqrt(1 - alpha_bar_t[t] + 1e-1)
-            )
-            + sigma_t[t] * torch.randn(x_0_packed_pred.shape, device=device)
-        )
-        x_t_list.append(
-            network.EgoDenoiseTraj.unpack(
-                x_t_packed, include_hands=denoiser_network.config.include_hands
+        # Once every window has converged, the clean prediction can't change,
+        # so we jump to the final step. Every sampler returns the clean
+        # prediction at t=0.
+        jump_to_end = step_skipping is not None and step_skipping.all_frozen()
+        with profile_span(profiler, "sampler_step", step=i):
+            if jump_to_end:
+                assert ts[-1] == 0
+                x_t_packed = x_0_packed_pred
+            else:
+                x_t_packed = sampler_state.step(i, x_t_packed, x_0_packed_pred)
+        del x_0_packed_pred
+        if step_callback is not None:
+            step_callback(
+                i,
+                [
+                    network.EgoDenoiseTraj.unpack(
+                        x_t_packed[:, seq_slice, :],
+                        include_hands=denoiser_network.config.include_hands,
+                    )
+                    for seq_slice in seq_slices
+                ],
             )
-        )
+        if jump_to_end:
+            print(f"All windows converged, skipping {len(ts) - 2 - i} steps")
+            break
 
+    trajs = [
+        network.EgoDenoiseTraj.unpack(
+            x_t_packed[:, seq_slice, :],
+            include_hands=denoiser_network.config.include_hands,
+        )
+        for seq_slice in seq_slices
+    ]
     if guidance_mode != "off" and guidance_post:
-        constrained_traj = x_t_list[-1]
-        constrained_traj, _ = do_guidance_optimization(
-            # It's important that we _don't_ use the shifted transforms here.
-            Ts_world_cpf=Ts_world_cpf[1:, :],
-            traj=constrained_traj,
-            body_model=body_model,
-            guidance_mode=guidance_mode,
-            phase="post",
-            hamer_detections=hamer_detections,
-            aria_detections=aria_detections,
-            verbose=guidance_verbose,
-        )
-        assert start_time is not None
-        print("RUNTIME (exclude first optimization)", time.time() - start_time)
-        return constrained_traj
-    else:
-        assert start_time is not None
-        print("RUNTIME (exclude first optimization)", time.time() - start_time)
-        return x_t_list[-1]
+        for j in range(num_sequences):
+            with profile_span(profiler, "guidance_post"):
+                trajs[j], _ = do_guidance_optimization(
+                    # It's important that we _don't_ use the shifted transforms here.
+                    Ts_world_cpf=Ts_world_cpf[j][1:, :],
+                    traj=trajs[j],
+                    body_model=body_model,
+                    guidance_mode=guidance_mode,
+                    phase="post",
+                    hamer_detections=hamer_detections[j],
+                    aria_detections=aria_detections[j],
+                    verbose=guidance_verbose,
+                    guidance_params=get_guidance_params("post"),
+                )
+    assert start_time is not None
+    print("RUNTIME (exclude first optimization)", time.time() - start_time)
+    return trajs
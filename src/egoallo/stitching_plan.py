@@ -0,0 +1,261 @@
+"""Choosing window sizes and batch sizes for stitched sampling."""
+
+from __future__ import annotations
+
+import dataclasses
+import os
+from typing import Sequence
+
+import torch
+
+from . import network
+
+
+@dataclasses.dataclass(frozen=True)
+class StitchingPlan:
+    """How a sequence is chopped into windows, and how windows are batched
+    during sampling. The defaults match the original EgoAllo settings."""
+
+    window_size: int = 128
+    """Maximum length of each window."""
+    overlap_size: int = 32
+    """Number of timesteps shared by consecutive windows. If 0, windows are
+    not blended."""
+    windows_per_batch: int | None = None
+    """Number of windows per denoiser forward pass. None for all windows."""
+    samples_per_batch: int | None = None
+    """Number of samples per denoiser forward pass. None for all samples."""
+
+    def __post_init__(self) -> None:
+        assert 0 <= self.overlap_size < self.window_size
+        assert self.windows_per_batch is None or self.windows_per_batch >= 1
+        assert self.samples_per_batch is None or self.samples_per_batch >= 1
+
+    def count_windows(self, seq_len: int) -> int:
+        """Number of windows that a sequence of length `seq_len` is split into.
+        Matches `StitchedWindows.make()`."""
+        return len(range(0, seq_len, self.window_size - self.overlap_size))
+
+    def get_forward_batch_size(self, seq_lens: Sequence[int], num_samples: int) -> int:
+        """Largest batch size passed to the denoiser during sampling, where
+        each batch entry is one window of one sample."""
+        num_windows = sum(self.count_windows(n) for n in seq_lens)
+        return min(num_samples, self.samples_per_batch or num_samples) * min(
+            num_windows, self.windows_per_batch or num_windows
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class StitchingPlanner:
+    """Picks a `StitchingPlan` that fits in a memory budget.
+
+    We prefer windows as long as the ones the denoiser was trained on, and
+    batch as many windows and samples into each forward pass as the budget
+    allows. Windows are only shortened if a single window with a single
+    sample doesn't fit. Sequences that are no longer than `max_window_size`
+    are denoised in a single un-stitched pass.
+
+    Memory use is estimated analytically from the denoiser config. The
+    estimate is conservative: it assumes attention weights are materialized,
+    which isn't true for fused attention kernels. With `cache_encoder=True`,
+    the decoder cache holds keys and values for every window, decoder layer,
+    and denoising step, so it's counted for every window. Building it also
+    runs the encoder batched over denoising steps, which has to fit too.
+    """
+
+    memory_budget_gb: float | None = None
+    """Memory budget for sampling, excluding model weights. If None, we use a
+    fraction of the memory that's currently free on the device."""
+    free_memory_fraction: float = 0.8
+    """Fraction of free device memory to use if `memory_budget_gb` is None."""
+    max_window_size: int = 128
+    """Longest window to use. This should be the sequence length the
+    denoiser was trained on."""
+    min_window_size: int = 32
+    """Shortest window to use if we run out of memory."""
+    overlap_ratio: float = 0.25
+    """Overlap between consecutive windows, as a fraction of window size."""
+
+    def get_memory_budget(self, device: torch.device) -> float:
+        """Memory budget in bytes. Infinite if it can't be determined."""
+        if self.memory_budget_gb is not None:
+            return self.memory_budget_gb * 1024**3
+        if device.type == "cuda":
+            free_bytes, _ = torch.cuda.mem_get_info(device)
+            return free_bytes * self.free_memory_fraction
+        if device.type == "cpu" and hasattr(os, "sysconf"):
+            try:
+                free_bytes = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+            except (ValueError, OSError):
+                return float("inf")
+            return free_bytes * self.free_memory_fraction
+        return float("inf")
+
+    def plan(
+        self,
+        denoiser_network: network.EgoDenoiser,
+        seq_lens: Sequence[int],
+        num_samples: int,
+        device: torch.device,
+        cache_encoder: bool = False,
+        num_steps: int = 30,
+    ) -> StitchingPlan:
+        """Choose a plan for sampling sequences with the given lengths. The
+        lengths here exclude the extra first CPF pose. `num_steps` is the
+        number of denoising steps, which is only used for estimating the size
+        of the encoder cache."""
+        budget = self.get_memory_budget(device)
+        itemsize = next(denoiser_network.parameters()).element_size()
+
+        def estimate_bytes(candidate: StitchingPlan) -> tuple[int, int, int, int]:
+            """Returns window count, fixed memory, memory per window (per
+            sample) in each forward pass, and peak memory while building the
+            decoder cache."""
+            config = denoiser_network.config
+            num_windows = sum(candidate.count_windows(n) for n in seq_lens)
+            padded_size = min(candidate.window_size, max(seq_lens))
+            fixed_bytes = itemsize * _estimate_fixed_numel(
+                config,
+                total_len=sum(seq_lens),
+                num_windows=num_windows,
+                padded_size=padded_size,
+                num_samples=num_samples,
+            )
+            per_window_bytes = itemsize * _estimate_forward_numel_per_window(
+                config, padded_size, cache_encoder=cache_encoder
+            )
+            cache_build_bytes = 0
+            if cache_encoder:
+                cache_bytes = (
+                    itemsize
+                    * num_windows
+                    * _estimate_decoder_cache_numel_per_window(
+                        config, padded_size, num_steps
+                    )
+                )
+                # The cache is built one window at a time, with the encoder
+                # batched over noise levels.
+                fixed_bytes += cache_bytes
+                cache_build_bytes = (
+                    fixed_bytes
+                    + num_steps
+                    * itemsize
+                    * _estimate_forward_numel_per_window(
+                        config, padded_size, cache_encoder=False
+                    )
+                )
+            return num_windows, fixed_bytes, per_window_bytes, cache_build_bytes
+
+        # Sequences that fit in a single window don't need stitching.
+        if max(seq_lens) <= self.max_window_size:
+            candidates = [StitchingPlan(self.max_window_size, overlap_size=0)]
+        else:
+            candidates = list[StitchingPlan]()
+            window_size = self.max_window_size
+            while window_size >= self.min_window_size:
+                candidates.append(
+                    StitchingPlan(
+                        window_size,
+                        overlap_size=max(1, round(window_size * self.overlap_ratio)),
+                    )
+                )
+                window_size //= 2
+
+        for candidate in candidates:
+            num_windows, fixed_bytes, per_window_bytes, cache_build_bytes = (
+                estimate_bytes(candidate)
+            )
+            max_batch = int((budget - fixed_bytes) // per_window_bytes)
+            if max_batch >= 1 and cache_build_bytes <= budget:
+                break
+        else:
+            # Nothing fits. Shorter windows won't help, so we stick to the
+            # window size that the denoiser was trained on.
+            candidate = candidates[0]
+            num_windows, fixed_bytes, per_window_bytes, cache_build_bytes = (
+                estimate_bytes(candidate)
+            )
+            max_batch = 1
+            print(
+                "Warning: sampling is unlikely to fit in the memory budget of"
+                f" {budget / 1024**3:.2f} GB"
+                + ("; consider disabling the encoder cache." if cache_encoder else ".")
+            )
+
+        samples_per_batch = min(num_samples, max_batch)
+        windows_per_batch = min(num_windows, max_batch // samples_per_batch)
+        plan = StitchingPlan(
+            window_size=candidate.window_size,
+            overlap_size=candidate.overlap_size,
+            windows_per_batch=None
+            if windows_per_batch == num_windows
+            else windows_per_batch,
+            samples_per_batch=None
+            if samples_per_batch == num_samples
+            else samples_per_batch,
+        )
+
+        estimated_bytes = max(
+            fixed_bytes + per_window_bytes * samples_per_batch * windows_per_batch,
+            cache_build_bytes,
+        )
+        print(
+            f"Stitching plan: {plan}\n"
+            f"\t{num_windows} window(s) for {len(seq_lens)} sequence(s)"
+            + (" (single pass, no stitching)" if num_windows == len(seq_lens) else "")
+            + f"; {samples_per_batch} sample(s) x {windows_per_batch} window(s)"
+            f" per forward pass\n"
+            f"\testimated memory {estimated_bytes / 1024**3:.2f} GB, budget"
+            f" {budget / 1024**3:.2f} GB ({device.type})"
+        )
+        return plan
+
+
+def _estimate_fixed_numel(
+    config: network.EgoDenoiserConfig,
+    total_len: int,
+    num_windows: int,
+    padded_size: int,
+    num_samples: int,
+) -> int:
+    """Number of elements held for the duration of sampling, excluding the
+    decoder cache: noisy states, predictions, and per-window conditioning."""
+    d_state = network.EgoDenoiseTraj.get_packed_dim(config.include_hands)
+    # Noisy state, blended prediction, and temporaries for rotation projection.
+    numel = 4 * num_samples * total_len * d_state
+    numel += num_windows * padded_size * config.d_latent
+    return numel
+
+
+def _estimate_decoder_cache_numel_per_window(
+    config: network.EgoDenoiserConfig, padded_size: int, num_steps: int
+) -> int:
+    """Number of elements in `EgoDenoiser.precompute_decoder_cache()` outputs
+    for one window: cross-attention keys and values for every decoder layer,
+    and a noise embedding, at every denoising step."""
+    tokens = padded_size + 1
+    return num_steps * (
+        config.d_noise_emb + config.decoder_layers * 2 * tokens * config.d_latent
+    )
+
+
+def _estimate_forward_numel_per_window(
+    config: network.EgoDenoiserConfig, padded_size: int, cache_encoder: bool
+) -> int:
+    """Peak number of activation elements for one window of one sample in a
+    denoiser forward pass. Layers run one after another, so this is dominated
+    by a single transformer block."""
+    d_state = network.EgoDenoiseTraj.get_packed_dim(config.include_hands)
+    tokens = padded_size + 1
+    # Residual stream, attention inputs and outputs, and the MLP hidden layer.
+    per_token = 6 * config.d_latent + 2 * config.d_feedforward
+    # Attention weights and the boolean mask, if they're materialized.
+    attention = 2 * config.num_heads * tokens * tokens + tokens * tokens
+    # Encoder outputs (or cached keys/values for this window) stay alive while
+    # the decoder runs.
+    cond = (
+        config.decoder_layers * 2 * tokens * config.d_latent
+        if cache_encoder
+        else tokens * config.d_latent
+    )
+    return tokens * per_token + attention + cond + 3 * padded_size * d_state
@@ -0,0 +1,301 @@
+"""Online sampling for CPF pose streams that arrive incrementally.
+
+`run_sampling_with_stitching()` needs the full trajectory up front. Here, we
+instead sample one window at a time as soon as enough poses have arrived, and
+emit frames once no future window overlaps them.
+"""
+
+from __future__ import annotations
+
+import torch
+from jaxtyping import Float
+from torch import Tensor
+
+from . import fncsmpl, network
+from .guidance_optimizer_jax import GuidanceMode, do_guidance_optimization
+from .hand_detection_structs import (
+    CorrespondedAriaHandWristPoseDetections,
+    CorrespondedHamerDetections,
+)
+from .sampling import CosineNoiseScheduleConstants, SamplerConfig
+from .transforms import SE3
+
+
+class StreamingSampler:
+    """Incremental version of `run_sampling_with_stitching()`.
+
+    Windows start every `window_size - overlap_size` frames, like in offline
+    stitching. Each window is sampled once all of its frames have arrived. At
+    each denoising step, predictions in the overlap region are blended with the
+    previous window's final output, using the same `/```\\` overlap weights as
+    offline stitching. The previous window is frozen at this point, so outputs
+    are close to but not identical to offline sampling.
+
+    Frames are emitted once they leave the overlap region, which bounds latency
+    to roughly one window. Only poses and detections for the current window are
+    buffered.
+
+    Usage:
+
+        streaming_sampler = StreamingSampler(...)
+        for Ts_world_cpf in pose_chunks:
+            traj = streaming_sampler.push(Ts_world_cpf)
+            if traj is not None:
+                ...  # Newly finalized frames.
+        traj = streaming_sampler.flush()
+
+    As in offline sampling, the first CPF pose is only used for computing
+    relative transforms, so the output has one fewer frame than the input.
+    Hand detections are aligned with output frames: if used, they should be
+    passed in with every call to `push()`, with one timestep for each new
+    output frame.
+    """
+
+    def __init__(
+        self,
+        denoiser_network: network.EgoDenoiser,
+        body_model: fncsmpl.SmplhModel,
+        guidance_mode: GuidanceMode,
+        guidance_post: bool,
+        guidance_inner: bool,
+        floor_z: float,
+        num_samples: int,
+        device: torch.device,
+        guidance_verbose: bool = False,
+        sampler: SamplerConfig = SamplerConfig(),
+        window_size: int = 128,
+        overlap_size: int = 32,
+    ) -> None:
+        assert 0 < overlap_size < window_size
+        self.denoiser_network = denoiser_network
+        self.body_model = body_model
+        self.guidance_mode: GuidanceMode = guidance_mode
+        self.guidance_post = guidance_post
+        self.guidance_inner = guidance_inner
+        self.guidance_verbose = guidance_verbose
+        self.floor_z = floor_z
+        self.num_samples = num_samples
+        self.device = device
+        self.sampler = sampler
+        self.window_size = window_size
+        self.overlap_size = overlap_size
+
+        self._noise_constants = CosineNoiseScheduleConstants.compute(timesteps=1000).to(
+            device=device
+        )
+
+        # Buffered inputs. Pose `i` in the buffer is pose
+        # `num_frames_emitted + i` in the stream, and detection timestep `i` is
+        # output frame `num_frames_emitted + i`.
+        self._Ts_world_cpf = torch.zeros((0, 7), device=device)
+        self._hamer_detections: CorrespondedHamerDetections | None = None
+        self._aria_detections: CorrespondedAriaHandWristPoseDetections | None = None
+
+        # Output frames from the previous window that overlap with the next
+        # one, along with the previous window's overlap weights.
+        self._overlap_x_0: Float[Tensor, "num_samples overlap d_state"] | None = None
+        self._overlap_weights: Float[Tensor, "overlap"] | None = None
+
+        self.num_frames_emitted = 0
+        """Number of output frames emitted so far. This is also the index of
+        the next window's first frame."""
+
+    def _num_buffered_frames(self) -> int:
+        return max(self._Ts_world_cpf.shape[0] - 1, 0)
+
+    def push(
+        self,
+        Ts_world_cpf: Float[Tensor, "time 7"],
+        hamer_detections: None | CorrespondedHamerDetections = None,
+        aria_detections: None | CorrespondedAriaHandWristPoseDetections = None,
+    ) -> network.EgoDenoiseTraj | None:
+        """Add new CPF poses. Returns newly finalized frames, if any."""
+        Ts_world_cpf = Ts_world_cpf.to(self.device)
+        num_new_frames = (
+            Ts_world_cpf.shape[0] - 1
+            if self._Ts_world_cpf.shape[0] == 0
+            else Ts_world_cpf.shape[0]
+        )
+        num_old_frames = self._num_buffered_frames()
+        self._Ts_world_cpf = torch.cat([self._Ts_world_cpf, Ts_world_cpf], dim=0)
+
+        if hamer_detections is not None:
+            assert hamer_detections.get_length() == num_new_frames
+            self._hamer_detections = (
+                hamer_detections
+                if self._hamer_detections is None
+                else CorrespondedHamerDetections.concatenate(
+                    [self._hamer_detections, hamer_detections]
+                )
+            )
+        if aria_detections is not None:
+            self._aria_detections = (
+                aria_detections
+                if self._aria_detections is None
+                else CorrespondedAriaHandWristPoseDetections.concatenate(
+                    [self._aria_detections, aria_detections],
+                    lengths=[num_old_frames, num_new_frames],
+                )
+            )
+
+        outputs = list[Tensor]()
+        while self._num_buffered_frames() >= self.window_size:
+            outputs.append(self._sample_window(self.window_size, is_last=False))
+        return self._unpack_outputs(outputs)
+
+    def flush(self) -> network.EgoDenoiseTraj | None:
+        """Sample and return all remaining frames. This should be called once
+        at the end of the stream."""
+        outputs = list[Tensor]()
+        while self._num_buffered_frames() > 0:
+            length = min(self.window_size, self._num_buffered_frames())
+            outputs.append(
+                self._sample_window(
+                    length,
+                    is_last=length <= self.window_size - self.overlap_size,
+                )
+            )
+        return self._unpack_outputs(outputs)
+
+    def _unpack_outputs(self, outputs: list[Tensor]) -> network.EgoDenoiseTraj | None:
+        if len(outputs) == 0:
+            return None
+        return network.EgoDenoiseTraj.unpack(
+            torch.cat(outputs, dim=1),
+            include_hands=self.denoiser_network.config.include_hands,
+        )
+
+    def _sample_window(
+        self, length: int, is_last: bool
+    ) -> Float[Tensor, "num_samples emitted d_state"]:
+        """Sample the window starting at the first buffered frame. Returns
+        finalized frames, and drops them from the buffer."""
+        device = self.device
+        include_hands = self.denoiser_network.config.include_hands
+        Ts_world_cpf = self._Ts_world_cpf[: length + 1]
+        Ts_world_cpf_shifted = Ts_world_cpf.clone()
+        Ts_world_cpf_shifted[..., 6] -= self.floor_z
+        T_cpf_tm1_cpf_t = (
+            SE3(Ts_world_cpf[:-1, :]).inverse() @ SE3(Ts_world_cpf[1:, :])
+        ).wxyz_xyz
+        hamer_detections = (
+            None
+            if self._hamer_detections is None
+            else self._hamer_detections.slice(0, length)
+        )
+        aria_detections = (
+            None
+            if self._aria_detections is None
+            else self._aria_detections.slice(0, length)
+        )
+
+        # Same `/```\` weights as `StitchedWindows`, which only ramp down for
+        # sequences shorter than `window_size + overlap_size`.
+        weights = torch.clamp(
+            torch.arange(1, length + 1, device=device) / self.overlap_size, max=1.0
+        )
+        overlap_x_0 = None
+        overlap_weights = None
+        if self._overlap_x_0 is not None:
+            assert self._overlap_weights is not None
+            overlap_x_0 = self._overlap_x_0[:, :length, :]
+            overlap_weights = self._overlap_weights[:length, None]
+
+        with torch.inference_mode():
+            cond_latent = self.denoiser_network.encode_cond(
+                T_world_cpf=Ts_world_cpf_shifted[None, 1:, :],
+                T_cpf_tm1_cpf_t=T_cpf_tm1_cpf_t[None],
+                hand_positions_wrt_cpf=None,
+            ).expand((self.num_samples, length, -1))
+
+        sampler_state = self.sampler.make(self._noise_constants)
+        ts = sampler_state.ts
+        x_t_packed = torch.randn(
+            (self.num_samples, length, self.denoiser_network.get_d_state()),
+            device=device,
+        )
+        for i in range(len(ts) - 1):
+            with torch.inference_mode():
+                x_0_packed_pred = self.denoiser_network.forward(
+                    x_t_packed,
+                    torch.tensor([ts[i]], device=device).expand((self.num_samples,)),
+                    T_cpf_tm1_cpf_t=None,
+                    T_world_cpf=None,
+                    project_output_rotmats=False,
+                    hand_positions_wrt_cpf=None,
+                    mask=None,
+                    cond_latent=cond_latent,
+                )
+                if overlap_x_0 is not None:
+                    assert overlap_weights is not None
+                    num_overlap = overlap_x_0.shape[1]
+                    x_0_packed_pred[:, :num_overlap, :] = (
+                        overlap_weights * overlap_x_0
+                        + weights[:num_overlap, None]
+                        * x_0_packed_pred[:, :num_overlap, :]
+                    ) / (overlap_weights + weights[:num_overlap, None])
+                x_0_packed_pred = network.EgoDenoiseTraj.unpack(
+                    x_0_packed_pred, include_hands=include_hands, project_rotmats=True
+                ).pack()
+
+            if self.guidance_mode != "off" and self.guidance_inner:
+                x_0_pred, _ = do_guidance_optimization(
+                    # It's important that we _don't_ use the shifted transforms here.
+                    Ts_world_cpf=Ts_world_cpf[1:, :],
+                    traj=network.EgoDenoiseTraj.unpack(
+                        x_0_packed_pred, include_hands=include_hands
+                    ),
+                    body_model=self.body_model,
+                    guidance_mode=self.guidance_mode,
+                    phase="inner",
+                    hamer_detections=hamer_detections,
+                    aria_detections=aria_detections,
+                    verbose=self.guidance_verbose,
+                )
+                x_0_packed_pred = x_0_pred.pack()
+                del x_0_pred
+
+            x_t_packed = sampler_state.step(i, x_t_packed, x_0_packed_pred)
+
+        if self.guidance_mode != "off" and self.guidance_post:
+            traj, _ = do_guidance_optimization(
+                Ts_world_cpf=Ts_world_cpf[1:, :],
+                traj=network.EgoDenoiseTraj.unpack(
+                    x_t_packed, include_hands=include_hands
+                ),
+                body_model=self.body_model,
+                guidance_mode=self.guidance_mode,
+                phase="post",
+                hamer_detections=hamer_detections,
+                aria_detections=aria_detections,
+                verbose=self.guidance_verbose,
+            )
+            x_t_packed = traj.pack()
+
+        # Frames are final once the next window no longer overlaps them.
+        num_final = length if is_last else self.window_size - self.overlap_size
+        if num_final < length:
+            self._overlap_x_0 = x_t_packed[:, num_final:, :]
+            self._overlap_weights = weights[num_final:]
+        else:
+            self._overlap_x_0 = None
+            self._overlap_weights = None
+
+        self._Ts_world_cpf = self._Ts_world_cpf[num_final:]
+        num_remaining = self._num_buffered_frames()
+        if self._hamer_detections is not None:
+            self._hamer_detections = (
+                None
+                if num_remaining == 0
+                else self._hamer_detections.slice(
+                    num_final, self._hamer_detections.get_length()
+                )
+            )
+        if self._aria_detections is not None:
+            self._aria_detections = (
+                None
+                if num_remaining == 0
+                else self._aria_detections.slice(num_final, num_final + num_remaining)
+            )
+        self.num_frames_emitted += num_final
+        return x_t_packed[:, :num_final, :]
@@ -3,6 +3,7 @@
 import dataclasses
 from typing import Literal
 
+import numpy as np
 import torch.utils.data
 from jaxtyping import Bool, Float, Int
 from torch import Tensor
@@ -30,11 +31,18 @@ class TrainingLossConfig:
     )
     weight_loss_by_t: Literal["emulate_eps_pred"] = "emulate_eps_pred"
     """Weights to apply to the loss at each noise level."""
+    distillation_min_denominator: float = 0.1
+    """Lower bound on how much a distillation target is divided by. Near
+    t=1000 with fine teacher schedules, the clean prediction that lands on the
+    teacher's output is an amplified difference of noisy states. Below this
+    bound, we instead compare the student's single step against the teacher's
+    two steps, scaled by `1 / distillation_min_denominator`."""
 
 
 class TrainingLossComputer:
-    """Helper class for computing the training loss. Contains a single method
-    for computing a training loss."""
+    """Helper class for computing the training loss. Contains methods for
+    computing the denoising loss, and a loss for distilling a teacher
+    denoiser into a student that needs half as many sampling steps."""
 
     def __init__(self, config: TrainingLossConfig, device: torch.device) -> None:
         self.config = config
@@ -67,26 +75,10 @@ class TrainingLossComputer:
         Returns:
             A tuple (loss tensor, dictionary of things to log).
         """
-        log_outputs: dict[str, Tensor | float] = {}
-
-        batch, time, num_joints, _ = train_batch.body_quats.shape
-        assert num_joints == 21
-        if unwrapped_model.config.include_hands:
-            assert train_batch.hand_quats is not None
-            x_0 = network.EgoDenoiseTraj(
-                betas=train_batch.betas.expand((batch, time, 16)),
-                body_rotmats=SO3(train_batch.body_quats).as_matrix(),
-                contacts=train_batch.contacts,
-                hand_rotmats=SO3(train_batch.hand_quats).as_matrix(),
-            )
-        else:
-            x_0 = network.EgoDenoiseTraj(
-                betas=train_batch.betas.expand((batch, time, 16)),
-                body_rotmats=SO3(train_batch.body_quats).as_matrix(),
-                contacts=train_batch.contacts,
-                hand_rotmats=None,
-            )
+        include_hands = unwrapped_model.config.include_hands
+        x_0 = self._make_x_0(train_batch, include_hands)
         x_0_packed = x_0.pack()
+        batch, time, _ = x_0_packed.shape
         device = x_0_packed.device
         assert x_0_packed.shape == (batch, time, unwrapped_model.get_d_state())
 
@@ -97,35 +89,10 @@ class TrainingLossComputer:
             size=(batch,),
             device=device,
         )
-        eps = torch.randn(x_0_packed.shape, dtype=x_0_packed.dtype, device=device)
         assert self.noise_constants.alpha_bar_t.shape == (
             unwrapped_model.config.max_t + 1,
         )
-        alpha_bar_t = self.noise_constants.alpha_bar_t[t, None, None]
-        assert alpha_bar_t.shape == (batch, 1, 1)
-        x_t_packed = (
-            torch.sqrt(alpha_bar_t) * x_0_packed + torch.sqrt(1.0 - alpha_bar_t) * eps
-        )
-
-        hand_positions_wrt_cpf: Tensor | None = None
-        if unwrapped_model.config.include_hand_positions_cond:
-            # Joints 19 and 20 are the hand positions.
-            hand_positions_wrt_cpf = train_batch.joints_wrt_cpf[:, :, 19:21, :].reshape(
-                (batch, time, 6)
-            )
-
-            # Exclude hand positions for some items in the batch. We'll just do
-            # this by passing in zeros.
-            hand_positions_wrt_cpf = torch.where(
-                # Uniformly drop out with some uniformly sampled probability.
-                # :)
-                (
-                    torch.rand((batch, time, 1), device=device)
-                    < torch.rand((batch, 1, 1), device=device)
-                ),
-                hand_positions_wrt_cpf,
-                0.0,
-            )
+        x_t_packed = self._diffuse(x_0_packed, t)
 
         # Denoise.
         x_0_packed_pred = model.forward(
@@ -133,17 +100,233 @@ class TrainingLossComputer:
             t=t,
             T_world_cpf=train_batch.T_world_cpf,
             T_cpf_tm1_cpf_t=train_batch.T_cpf_tm1_cpf_t,
-            hand_positions_wrt_cpf=hand_positions_wrt_cpf,
+            hand_positions_wrt_cpf=self._get_hand_positions_cond(
+                train_batch, unwrapped_model
+            ),
             project_output_rotmats=False,
             mask=train_batch.mask,
-            cond_dropout_keep_mask=torch.rand((batch,), device=device)
-            > self.config.cond_dropout_prob
-            if self.config.cond_dropout_prob > 0.0
-            else None,
+            cond_dropout_keep_mask=self._get_cond_dropout_keep_mask(batch, device),
         )
         assert isinstance(x_0_packed_pred, torch.Tensor)
+        return self._compute_weighted_loss(
+            x_0_packed_pred, x_0, x_0, t, train_batch, include_hands
+        )
+
+    def compute_distillation_loss(
+        self,
+        model: network.EgoDenoiser | DistributedDataParallel | OptimizedModule,
+        unwrapped_model: network.EgoDenoiser,
+        teacher: network.EgoDenoiser,
+        teacher_ts: np.ndarray,
+        train_batch: EgoTrainingData,
+    ) -> tuple[Tensor, dict[str, Tensor | float]]:
+        """Compute a progressive distillation loss, from Salimans & Ho 2022.
+
+        `teacher_ts` is the teacher's sampling schedule, which we assume uses
+        deterministic DDIM updates. The student's schedule is
+        `teacher_ts[::2]`: it should take one step for every two teacher steps.
+        Targets are the clean predictions that make one student step land on
+        the output of two teacher steps; see
+        `TrainingLossConfig.distillation_min_denominator` for how we bound
+        them at high noise levels.
+
+        Returns:
+            A tuple (loss tensor, dictionary of things to log).
+        """
+        include_hands = unwrapped_model.config.include_hands
+        x_0 = self._make_x_0(train_batch, include_hands)
+        x_0_packed = x_0.pack()
+        batch, time, _ = x_0_packed.shape
+        device = x_0_packed.device
+        assert x_0_packed.shape == (batch, time, unwrapped_model.get_d_state())
+
+        num_teacher_steps = teacher_ts.shape[0] - 1
+        assert num_teacher_steps % 2 == 0
+        assert teacher_ts[0] <= unwrapped_model.config.max_t and teacher_ts[-1] == 0
+
+        # Diffuse to a timestep in the student's schedule.
+        ts = torch.from_numpy(teacher_ts.copy()).to(device)
+        i = 2 * torch.randint(
+            low=0, high=num_teacher_steps // 2, size=(batch,), device=device
+        )
+        t, t_mid, t_next = ts[i], ts[i + 1], ts[i + 2]
+        x_t_packed = self._diffuse(x_0_packed, t)
+
+        hand_positions_wrt_cpf = self._get_hand_positions_cond(
+            train_batch, unwrapped_model
+        )
+        cond_dropout_keep_mask = self._get_cond_dropout_keep_mask(batch, device)
+
+        def denoise(
+            denoiser: network.EgoDenoiser | DistributedDataParallel | OptimizedModule,
+            x_t_packed: Tensor,
+            t: Tensor,
+        ) -> Tensor:
+            x_0_packed_pred = denoiser.forward(
+                x_t_packed=x_t_packed,
+                t=t,
+                T_world_cpf=train_batch.T_world_cpf,
+                T_cpf_tm1_cpf_t=train_batch.T_cpf_tm1_cpf_t,
+                hand_positions_wrt_cpf=hand_positions_wrt_cpf,
+                project_output_rotmats=False,
+                mask=train_batch.mask,
+                cond_dropout_keep_mask=cond_dropout_keep_mask,
+            )
+            assert isinstance(x_0_packed_pred, Tensor)
+            return x_0_packed_pred
+
+        # Take two teacher steps, then solve for the clean prediction that
+        # takes a single student step from `t` to `t_next`.
+        with torch.no_grad():
+            x_t_mid_packed = self._ddim_step(
+                x_t_packed, denoise(teacher, x_t_packed, t), t, t_mid
+            )
+            x_t_next_packed = self._ddim_step(
+                x_t_mid_packed, denoise(teacher, x_t_mid_packed, t_mid), t_mid, t_next
+            )
+            coeff = self._ddim_noise_coeff(t, t_next)
+            alpha_bar_t = self.noise_constants.alpha_bar_t[t, None, None]
+            alpha_bar_t_next = self.noise_constants.alpha_bar_t[t_next, None, None]
+            denominator = torch.sqrt(alpha_bar_t_next) - coeff * torch.sqrt(alpha_bar_t)
+            # Where the denominator is clamped, scaling both the prediction and
+            # the target by `denominator / clamped_denominator` makes the
+            # error proportional to the student's step error, instead of
+            # dividing by a small number.
+            clamped_denominator = torch.clamp(
+                denominator, min=self.config.distillation_min_denominator
+            )
+            target_packed = (x_t_next_packed - coeff * x_t_packed) / clamped_denominator
+        target = network.EgoDenoiseTraj.unpack(
+            target_packed, include_hands=include_hands
+        )
+
+        x_0_packed_pred = denoise(model, x_t_packed, t)
+        loss, log_outputs = self._compute_weighted_loss(
+            x_0_packed_pred * (denominator / clamped_denominator),
+            target,
+            x_0,
+            t,
+            train_batch,
+            include_hands,
+        )
+        log_outputs["distillation_clamped_frac"] = torch.mean(
+            (denominator < clamped_denominator).float()
+        )
+        return loss, log_outputs
+
+    def _make_x_0(
+        self, train_batch: EgoTrainingData, include_hands: bool
+    ) -> network.EgoDenoiseTraj:
+        """Get clean trajectories from a training batch."""
+        batch, time, num_joints, _ = train_batch.body_quats.shape
+        assert num_joints == 21
+        if include_hands:
+            assert train_batch.hand_quats is not None
+            return network.EgoDenoiseTraj(
+                betas=train_batch.betas.expand((batch, time, 16)),
+                body_rotmats=SO3(train_batch.body_quats).as_matrix(),
+                contacts=train_batch.contacts,
+                hand_rotmats=SO3(train_batch.hand_quats).as_matrix(),
+            )
+        else:
+            return network.EgoDenoiseTraj(
+                betas=train_batch.betas.expand((batch, time, 16)),
+                body_rotmats=SO3(train_batch.body_quats).as_matrix(),
+                contacts=train_batch.contacts,
+                hand_rotmats=None,
+            )
+
+    def _diffuse(
+        self, x_0_packed: Float[Tensor, "b t d"], t: Int[Tensor, "b"]
+    ) -> Float[Tensor, "b t d"]:
+        """Sample from q(x_t | x_0)."""
+        eps = torch.randn(
+            x_0_packed.shape, dtype=x_0_packed.dtype, device=x_0_packed.device
+        )
+        alpha_bar_t = self.noise_constants.alpha_bar_t[t, None, None]
+        assert alpha_bar_t.shape == (x_0_packed.shape[0], 1, 1)
+        return (
+            torch.sqrt(alpha_bar_t) * x_0_packed + torch.sqrt(1.0 - alpha_bar_t) * eps
+        )
+
+    def _ddim_noise_coeff(
+        self, t: Int[Tensor, "b"], t_next: Int[Tensor, "b"]
+    ) -> Float[Tensor, "b 1 1"]:
+        """Scale applied to the noise direction by a deterministic DDIM step.
+        This matches `Sampler.step()` for the `ddim` method with `eta=0`."""
+        alpha_bar_t = self.noise_constants.alpha_bar_t[t, None, None]
+        alpha_bar_t_next = self.noise_constants.alpha_bar_t[t_next, None, None]
+        return torch.sqrt(1.0 - alpha_bar_t_next) / torch.sqrt(1.0 - alpha_bar_t + 1e-1)
+
+    def _ddim_step(
+        self,
+        x_t_packed: Float[Tensor, "b t d"],
+        x_0_packed_pred: Float[Tensor, "b t d"],
+        t: Int[Tensor, "b"],
+        t_next: Int[Tensor, "b"],
+    ) -> Float[Tensor, "b t d"]:
+        """Deterministic DDIM step from `t` to `t_next`."""
+        alpha_bar_t = self.noise_constants.alpha_bar_t[t, None, None]
+        alpha_bar_t_next = self.noise_constants.alpha_bar_t[t_next, None, None]
+        return torch.sqrt(alpha_bar_t_next) * x_0_packed_pred + self._ddim_noise_coeff(
+            t, t_next
+        ) * (x_t_packed - torch.sqrt(alpha_bar_t) * x_0_packed_pred)
+
+    def _get_hand_positions_cond(
+        self, train_batch: EgoTrainingData, unwrapped_model: network.EgoDenoiser
+    ) -> Tensor | None:
+        """Get hand position conditioning, with random dropout."""
+        if not unwrapped_model.config.include_hand_positions_cond:
+            return None
+
+        batch, time = train_batch.mask.shape
+        device = train_batch.mask.device
+
+        # Joints 19 and 20 are the hand positions.
+        hand_positions_wrt_cpf = train_batch.joints_wrt_cpf[:, :, 19:21, :].reshape(
+            (batch, time, 6)
+        )
+
+        # Exclude hand positions for some items in the batch. We'll just do
+        # this by passing in zeros.
+        return torch.where(
+            # Uniformly drop out with some uniformly sampled probability.
+            # :)
+            (
+                torch.rand((batch, time, 1), device=device)
+                < torch.rand((batch, 1, 1), device=device)
+            ),
+            hand_positions_wrt_cpf,
+            0.0,
+        )
+
+    def _get_cond_dropout_keep_mask(
+        self, batch: int, device: torch.device
+    ) -> Tensor | None:
+        return (
+            torch.rand((batch,), device=device) > self.config.cond_dropout_prob
+            if self.config.cond_dropout_prob > 0.0
+            else None
+        )
+
+    def _compute_weighted_loss(
+        self,
+        x_0_packed_pred: Float[Tensor, "b t d"],
+        target: network.EgoDenoiseTraj,
+        x_0: network.EgoDenoiseTraj,
+        t: Int[Tensor, "b"],
+        train_batch: EgoTrainingData,
+        include_hands: bool,
+    ) -> tuple[Tensor, dict[str, Tensor | float]]:
+        """Compute weighted losses between clean predictions and targets.
+        `x_0` is the ground-truth trajectory, which is used to decide which
+        hand sequences to supervise."""
+        log_outputs: dict[str, Tensor | float] = {}
+
+        batch, time, _ = x_0_packed_pred.shape
+        device = x_0_packed_pred.device
         x_0_pred = network.EgoDenoiseTraj.unpack(
-            x_0_packed_pred, include_hands=unwrapped_model.config.include_hands
+            x_0_packed_pred, include_hands=include_hands
         )
 
         weight_t = self.weight_t[t].to(device)
@@ -177,24 +360,27 @@ class TrainingLossComputer:
         loss_terms: dict[str, Tensor | float] = {
             "betas": weight_and_mask_loss(
                 # (b, t, 16)
-                (x_0_pred.betas - x_0.betas) ** 2
+                (x_0_pred.betas - target.betas) ** 2
                 # (16,)
                 * x_0.betas.new_tensor(self.config.beta_coeff_weights),
             ),
             "body_rotmats": weight_and_mask_loss(
                 # (b, t, 21 * 3 * 3)
-                (x_0_pred.body_rotmats - x_0.body_rotmats).reshape(
+                (x_0_pred.body_rotmats - target.body_rotmats).reshape(
                     (batch, time, 21 * 3 * 3)
                 )
                 ** 2,
             ),
-            "contacts": weight_and_mask_loss((x_0_pred.contacts - x_0.contacts) ** 2),
+            "contacts": weight_and_mask_loss(
+                (x_0_pred.contacts - target.contacts) ** 2
+            ),
         }
 
         # Include hand objective.
         # We didn't use this in the paper.
-        if unwrapped_model.config.include_hands:
+        if include_hands:
             assert x_0_pred.hand_rotmats is not None
+            assert target.hand_rotmats is not None
             assert x_0.hand_rotmats is not None
             assert x_0.hand_rotmats.shape == (batch, time, 30, 3, 3)
 
@@ -218,7 +404,7 @@ class TrainingLossComputer:
             hand_bt_mask = torch.logical_and(hand_motion[:, None], train_batch.mask)
             loss_terms["hand_rotmats"] = torch.sum(
                 weight_and_mask_loss(
-                    (x_0_pred.hand_rotmats - x_0.hand_rotmats).reshape(
+                    (x_0_pred.hand_rotmats - target.hand_rotmats).reshape(
                         batch, time, 30 * 3 * 3
                     )
                     ** 2,
@@ -178,3 +178,15 @@ def get_git_diff(cwd: Path | None = None) -> str:
         .decode("ascii")
         .strip()
     )
+
+
+def get_experiment_dir(
+    experiments_dir: Path, experiment_name: str, version: int = 0
+) -> Path:
+    """Creates a directory to put experiment files in, suffixed with a version
+    number. Similar to PyTorch lightning."""
+    experiment_dir = experiments_dir / experiment_name / f"v{version}"
+    if experiment_dir.exists():
+        return get_experiment_dir(experiments_dir, experiment_name, version + 1)
+    else:
+        return experiment_dir